@@ -0,0 +1,292 @@
+# coding: utf-8
+"""
+    Benchmarks of flask_weixin.
+
+    Run all benchmarks and save the results::
+
+        $ python bench_weixin.py -o bench.json
+
+    Compare with the results of a previous release::
+
+        $ python bench_weixin.py --compare old.json
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+
+from flask import Flask
+from flask_weixin import Weixin, ReplyRenderer, MemoizedReply
+from flask_weixin import (
+    text_reply, music_reply, news_reply, image_reply, voice_reply,
+    video_reply, transfer_customer_service_reply,
+)
+
+
+TOKEN = 'B0e8alq5ZmMjcnG5gwwLRPW2'
+SIGNATURE = '16f39f0c528790d3a448a8a7a65cc81ceddd82bb'
+TIMESTAMP = '1381389497'
+NONCE = '1381909961'
+SIGNATURE_URL = '/?signature=%s&timestamp=%s&nonce=%s' % (
+    SIGNATURE, TIMESTAMP, NONCE)
+
+MESSAGES = {
+    'text': (
+        '<xml>'
+        '<ToUserName><![CDATA[toUser]]></ToUserName>'
+        '<FromUserName><![CDATA[fromUser]]></FromUserName>'
+        '<CreateTime>1348831860</CreateTime>'
+        '<MsgType><![CDATA[text]]></MsgType>'
+        '<Content><![CDATA[%s]]></Content>'
+        '<MsgId>1234567890123456</MsgId>'
+        '</xml>'
+    ),
+    'image': (
+        '<xml>'
+        '<ToUserName><![CDATA[toUser]]></ToUserName>'
+        '<FromUserName><![CDATA[fromUser]]></FromUserName>'
+        '<CreateTime>1348831860</CreateTime>'
+        '<MsgType><![CDATA[image]]></MsgType>'
+        '<PicUrl><![CDATA[http://example.com/a.jpg]]></PicUrl>'
+        '<MediaId><![CDATA[media_id]]></MediaId>'
+        '<MsgId>1234567890123456</MsgId>'
+        '</xml>'
+    ),
+    'location': (
+        '<xml>'
+        '<ToUserName><![CDATA[toUser]]></ToUserName>'
+        '<FromUserName><![CDATA[fromUser]]></FromUserName>'
+        '<CreateTime>1351776360</CreateTime>'
+        '<MsgType><![CDATA[location]]></MsgType>'
+        '<Location_X>23.134521</Location_X>'
+        '<Location_Y>113.358803</Location_Y>'
+        '<Scale>20</Scale>'
+        '<Label><![CDATA[location]]></Label>'
+        '<MsgId>1234567890123456</MsgId>'
+        '</xml>'
+    ),
+    'link': (
+        '<xml>'
+        '<ToUserName><![CDATA[toUser]]></ToUserName>'
+        '<FromUserName><![CDATA[fromUser]]></FromUserName>'
+        '<CreateTime>1351776360</CreateTime>'
+        '<MsgType><![CDATA[link]]></MsgType>'
+        '<Title><![CDATA[title]]></Title>'
+        '<Description><![CDATA[description]]></Description>'
+        '<Url><![CDATA[url]]></Url>'
+        '<MsgId>1234567890123456</MsgId>'
+        '</xml>'
+    ),
+    'event': (
+        '<xml>'
+        '<ToUserName><![CDATA[toUser]]></ToUserName>'
+        '<FromUserName><![CDATA[fromUser]]></FromUserName>'
+        '<CreateTime>1348831860</CreateTime>'
+        '<MsgType><![CDATA[event]]></MsgType>'
+        '<Event><![CDATA[CLICK]]></Event>'
+        '<EventKey><![CDATA[key_%s]]></EventKey>'
+        '</xml>'
+    ),
+    'voice': (
+        '<xml>'
+        '<ToUserName><![CDATA[toUser]]></ToUserName>'
+        '<FromUserName><![CDATA[fromUser]]></FromUserName>'
+        '<CreateTime>1357290913</CreateTime>'
+        '<MsgType><![CDATA[voice]]></MsgType>'
+        '<MediaId><![CDATA[media_id]]></MediaId>'
+        '<Format><![CDATA[Format]]></Format>'
+        '<Recognition><![CDATA[腾讯微信团队]]></Recognition>'
+        '<MsgId>1234567890123456</MsgId>'
+        '</xml>'
+    ),
+}
+
+ARTICLE = {
+    'title': 'Weixin News',
+    'description': 'weixin description',
+    'picurl': 'http://example.com/a.jpg',
+    'url': 'http://example.com/',
+}
+
+
+def percentile(values, p):
+    """Returns the ``p`` percentile of sorted ``values``."""
+    if not values:
+        return 0.0
+    k = int(round(p / 100.0 * (len(values) - 1)))
+    return values[k]
+
+
+def measure(func, number, warmup=100):
+    """Call ``func`` for ``number`` times, returns the statistics."""
+    for _ in range(warmup):
+        func()
+
+    timer = time.perf_counter
+    durations = []
+    start = timer()
+    for _ in range(number):
+        t = timer()
+        func()
+        durations.append(timer() - t)
+    total = timer() - start
+
+    durations.sort()
+    return {
+        'number': number,
+        'ops': number / total,
+        'mean_us': total / number * 1e6,
+        'p50_us': percentile(durations, 50) * 1e6,
+        'p95_us': percentile(durations, 95) * 1e6,
+        'p99_us': percentile(durations, 99) * 1e6,
+    }
+
+
+def bench_validate(number):
+    weixin = Weixin({'WEIXIN_TOKEN': TOKEN})
+    yield 'validate', lambda: weixin.validate(SIGNATURE, TIMESTAMP, NONCE)
+
+
+def bench_parse(number):
+    weixin = Weixin({'WEIXIN_TOKEN': TOKEN})
+    for name, template in sorted(MESSAGES.items()):
+        data = template.replace('%s', 'hello').encode('utf-8')
+        yield 'parse.%s' % name, lambda data=data: weixin.parse(data)
+
+    # the same bodies with the other parsers
+    for parser in ('iterparse', 'fast'):
+        weixin = Weixin({'WEIXIN_TOKEN': TOKEN, 'WEIXIN_PARSER': parser})
+        for name, template in sorted(MESSAGES.items()):
+            data = template.replace('%s', 'hello').encode('utf-8')
+            yield 'parse.%s.%s' % (parser, name), \
+                lambda weixin=weixin, data=data: weixin._parse_chunks([data])
+
+
+def bench_reply(number):
+    args = ('toUser', 'fromUser')
+    yield 'reply.text', lambda: text_reply(*args, content='hello')
+    yield 'reply.music', lambda: music_reply(
+        *args, title='t', description='d', music_url='u', hq_music_url='hq')
+    yield 'reply.image', lambda: image_reply(*args, media_id='media_id')
+    yield 'reply.voice', lambda: voice_reply(*args, media_id='media_id')
+    yield 'reply.video', lambda: video_reply(
+        *args, media_id='media_id', title='t', description='d')
+    yield 'reply.customer_service', lambda: transfer_customer_service_reply(
+        *args, service_account='test@test')
+    for count in range(1, 9):
+        articles = [ARTICLE] * count
+        yield 'reply.news.%d' % count, \
+            lambda articles=articles: news_reply(*(args + tuple(articles)))
+
+    weixin = Weixin({'WEIXIN_TOKEN': TOKEN})
+    for count in (1, 8):
+        articles = [ARTICLE] * count
+        memoized = MemoizedReply(
+            weixin, lambda sender, receiver, articles=articles, **kwargs:
+            news_reply(sender, receiver, *articles))
+        yield 'memoized.news.%d' % count, \
+            lambda memoized=memoized: memoized(
+                {'sender': 'toUser', 'receiver': 'fromUser'})
+
+    renderer = ReplyRenderer()
+    yield 'compiled.text', lambda: renderer.render(
+        'toUser', sender='fromUser', content='hello')
+    for count in (1, 8):
+        articles = [ARTICLE] * count
+        yield 'compiled.news.%d' % count, \
+            lambda articles=articles: renderer.render(
+                'toUser', type='news', sender='fromUser', articles=articles)
+
+
+def create_app(rules):
+    app = Flask(__name__)
+    app.config['WEIXIN_TOKEN'] = TOKEN
+    weixin = Weixin(app)
+    app.add_url_rule('/', view_func=weixin.view_func)
+
+    def handler(sender, receiver, **kwargs):
+        return weixin.reply(sender, sender=receiver, content='hello')
+
+    for i in range(rules):
+        weixin.register(type='event', event='CLICK', event_key='key_%d' % i,
+                        func=handler)
+    weixin.register('help', handler)
+    weixin.register('*', handler)
+    return app
+
+
+def bench_view_func(number):
+    for rules in (1, 100, 1000):
+        client = create_app(rules).test_client()
+        text = MESSAGES['text'] % 'help'
+        event = MESSAGES['event'] % (rules - 1)
+        yield 'view_func.text.%d' % rules, \
+            lambda client=client: client.post(SIGNATURE_URL, data=text)
+        yield 'view_func.event.%d' % rules, \
+            lambda client=client, event=event: client.post(
+                SIGNATURE_URL, data=event)
+
+
+SUITES = [
+    ('validate', bench_validate, 20000),
+    ('parse', bench_parse, 10000),
+    ('reply', bench_reply, 10000),
+    ('view_func', bench_view_func, 1000),
+]
+
+
+def run(pattern=None, scale=1.0):
+    results = {}
+    for _, suite, number in SUITES:
+        number = max(1, int(number * scale))
+        for name, func in suite(number):
+            if pattern and pattern not in name:
+                continue
+            results[name] = measure(func, number)
+            yield name, results[name]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark flask_weixin.')
+    parser.add_argument('-k', dest='pattern', help='only run matched names')
+    parser.add_argument('-o', '--output', help='save results as JSON')
+    parser.add_argument('--compare', help='compare with a saved JSON')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='scale the number of iterations')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    header = '%-28s %12s %10s %10s %10s' % (
+        'name', 'ops/s', 'p50 us', 'p99 us', 'change')
+    print(header)
+    print('-' * len(header))
+    for name, stats in run(args.pattern, args.scale):
+        results[name] = stats
+        change = ''
+        if name in baseline:
+            change = '%+.1f%%' % (
+                (stats['ops'] / baseline[name]['ops'] - 1) * 100)
+        print('%-28s %12.0f %10.1f %10.1f %10s' % (
+            name, stats['ops'], stats['p50_us'], stats['p99_us'], change))
+        sys.stdout.flush()
+
+    if args.output:
+        data = {
+            'created_at': int(time.time()),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,24 +9,48 @@
     :license: BSD, see LICENSE for more detail.
 """
 
+import os
+import re
+import io
+import json
 import time
+import errno
+import pickle
+import socket
+import select
+import base64
+import struct
+import bisect
+import asyncio
+import binascii
 import hashlib
+import inspect
+import logging
+import functools
+import threading
 from datetime import datetime
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, ChainMap
+from collections.abc import MutableMapping
+from concurrent import futures
+
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from urllib.request import urlopen
+import http.client as http_client
 
 try:
     from lxml import etree
-except ImportError:
-    from xml.etree import cElementTree as etree
 except ImportError:
     from xml.etree import ElementTree as etree
 
 try:
     from flask import current_app, request, Response
+    from flask import has_request_context, copy_current_request_context
 except ImportError:
     current_app = None
     request = None
     Response = None
+    has_request_context = None
+    copy_current_request_context = None
 
 
 __all__ = ('Weixin',)
@@ -34,9 +58,136 @@ __version__ = '0.5.0'
 __author__ = 'Hsiaoming Yang <me@lepture.com>'
 
 
+log = logging.getLogger('flask_weixin')
+
+try:
+    _timer = time.perf_counter
+except AttributeError:
+    _timer = time.time
+
+API_BASE_URL = 'https://api.weixin.qq.com'
+
 StandaloneApplication = namedtuple('StandaloneApplication', ['config'])
 
 
+class AccountApplication(object):
+    """Config holder of an account added by :meth:`Weixin.add_account`.
+
+    Keys missing in its own config are looked up in the config of the
+    parent ``Weixin`` on every access. The chain is built once for each
+    parent config, which only changes when the parent is bound to
+    ``current_app``.
+    """
+
+    def __init__(self, parent, config):
+        self.parent = parent
+        self.overrides = dict(config)
+        self._config = None
+
+    @property
+    def config(self):
+        parent = self.parent.app.config
+        config = self._config
+        if config is None or config.maps[1] is not parent:
+            config = ChainMap(self.overrides, parent)
+            self._config = config
+        return config
+
+
+def _int(value):
+    return int(value or 0)
+
+
+#: Fields of the messages sent by weixin, per message type. Each field is
+#: ``(key, xml tag, converter)``. The ``parse_<type>`` methods of
+#: :class:`Weixin` and the typed message classes are compiled from it, so
+#: a new message type only needs a new entry here.
+MESSAGE_SCHEMA = {
+    'text': (
+        ('content', 'Content', None),
+    ),
+    'image': (
+        ('picurl', 'PicUrl', None),
+        ('media_id', 'MediaId', None),
+    ),
+    'location': (
+        ('location_x', 'Location_X', None),
+        ('location_y', 'Location_Y', None),
+        ('scale', 'Scale', _int),
+        ('label', 'Label', None),
+    ),
+    'link': (
+        ('title', 'Title', None),
+        ('description', 'Description', None),
+        ('url', 'Url', None),
+    ),
+    'event': (
+        ('event', 'Event', None),
+        ('event_key', 'EventKey', None),
+        ('ticket', 'Ticket', None),
+        ('latitude', 'Latitude', None),
+        ('longitude', 'Longitude', None),
+        ('precision', 'Precision', None),
+    ),
+    'voice': (
+        ('media_id', 'MediaId', None),
+        ('format', 'Format', None),
+        ('recognition', 'Recognition', None),
+    ),
+    'video': (
+        ('media_id', 'MediaId', None),
+        ('thumb_media_id', 'ThumbMediaId', None),
+    ),
+    'shortvideo': (
+        ('media_id', 'MediaId', None),
+        ('thumb_media_id', 'ThumbMediaId', None),
+    ),
+}
+
+
+def _compile_fields(fields, assign):
+    """Compile a function that reads the xml tags of ``fields``.
+
+    :param assign: A format string of one ``key: value`` statement or
+                   expression, with ``%(key)r`` and ``%(value)s``.
+    """
+    namespace = {}
+    lines = []
+    for i, (key, tag, convert) in enumerate(fields):
+        value = 'get(%r)' % tag
+        if convert is not None:
+            namespace['_convert%d' % i] = convert
+            value = '_convert%d(%s)' % (i, value)
+        lines.append(assign % {'key': key, 'value': value})
+    return namespace, lines
+
+
+def _compile_parser(msg_type):
+    """Compile the ``parse_<type>`` method of a message type."""
+    name = 'parse_%s' % msg_type
+    namespace, lines = _compile_fields(
+        MESSAGE_SCHEMA[msg_type], '        %(key)r: %(value)s,')
+    source = 'def %s(self, raw):\n    get = raw.get\n    return {\n%s\n    }\n'
+    source = source % (name, '\n'.join(lines))
+    exec(compile(source, '<schema %s>' % msg_type, 'exec'), namespace)
+    return namespace[name]
+
+
+def _compile_decoder(fields):
+    """Compile the function which sets ``fields`` as attributes."""
+    namespace, lines = _compile_fields(
+        fields, '    self.%(key)s = %(value)s')
+    source = 'def _decode(self, get):\n%s\n' % ('\n'.join(lines) or '    pass')
+    exec(compile(source, '<schema decoder>', 'exec'), namespace)
+    return namespace['_decode']
+
+
+#: Keys of the shared fields returned by :meth:`Weixin.format`
+_FORMAT_KEYS = frozenset(
+    ('id', 'timestamp', 'receiver', 'sender', 'type', 'time')
+)
+
+
 class Weixin(object):
     """Interface for mp.weixin.qq.com
 
@@ -46,6 +197,29 @@ class Weixin(object):
     def __init__(self, app=None):
         self._registry = {}
         self._registry_without_key = []
+        self._rule_index = None
+        self._keyword_rules = []
+        self._keyword_router = None
+        self.renderer = ReplyRenderer()
+        self.reply_cache = ReplyCache()
+        self._late_reply = None
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._dedup = None
+        self._crypto = None
+        self._token_manager = None
+        self._client = None
+        self._media = None
+        self._timing_hooks = []
+        self._coalescers = {}
+        self._parent = None
+        self._accounts = {}
+        self._account_senders = {}
+        # bound parsers of the known types, subclasses can override them
+        self._parsers = dict(
+            (t, getattr(self, 'parse_%s' % t)) for t in MESSAGE_SCHEMA
+        )
+        self._message_keys_cache = {}
 
         if isinstance(app, dict):
             # flask-weixin can be used without flask
@@ -61,6 +235,24 @@ class Weixin(object):
         app.config.setdefault('WEIXIN_TOKEN', None)
         app.config.setdefault('WEIXIN_SENDER', None)
         app.config.setdefault('WEIXIN_EXPIRES_IN', 0)
+        app.config.setdefault('WEIXIN_MAX_BODY_SIZE', 0)
+        app.config.setdefault('WEIXIN_PARSER', 'etree')
+        app.config.setdefault('WEIXIN_MESSAGE_MODE', 'dict')
+        app.config.setdefault('WEIXIN_COMPILED_REPLY', False)
+        app.config.setdefault('WEIXIN_NONCE_CACHE', None)
+        app.config.setdefault('WEIXIN_DEADLINE', 0)
+        app.config.setdefault('WEIXIN_WORKERS', 8)
+        app.config.setdefault('WEIXIN_MSG_CACHE', None)
+        app.config.setdefault('WEIXIN_MSG_CACHE_TIMEOUT', 30)
+        app.config.setdefault('WEIXIN_AES_KEY', None)
+        app.config.setdefault('WEIXIN_APPID', None)
+        app.config.setdefault('WEIXIN_CRYPTO_BACKEND', 'auto')
+        app.config.setdefault('WEIXIN_APP_SECRET', None)
+        app.config.setdefault('WEIXIN_API_BASE_URL', API_BASE_URL)
+        app.config.setdefault('WEIXIN_TOKEN_CACHE', None)
+        app.config.setdefault('WEIXIN_SESSION_CACHE', None)
+        app.config.setdefault('WEIXIN_SESSION_TIMEOUT', 1800)
+        app.config.setdefault('WEIXIN_MEDIA_CONCURRENCY', 4)
 
     @property
     def token(self):
@@ -74,17 +266,179 @@ class Weixin(object):
     def expires_in(self):
         return self.app.config['WEIXIN_EXPIRES_IN']
 
-    def validate(self, signature, timestamp, nonce):
+    @property
+    def max_body_size(self):
+        return self.app.config.get('WEIXIN_MAX_BODY_SIZE', 0)
+
+    @property
+    def parser(self):
+        return self.app.config.get('WEIXIN_PARSER', 'etree')
+
+    @property
+    def message_mode(self):
+        return self.app.config.get('WEIXIN_MESSAGE_MODE', 'dict')
+
+    @property
+    def compiled_reply(self):
+        return self.app.config.get('WEIXIN_COMPILED_REPLY', False)
+
+    @property
+    def nonce_cache(self):
+        return self.app.config.get('WEIXIN_NONCE_CACHE')
+
+    @property
+    def deadline(self):
+        return self.app.config.get('WEIXIN_DEADLINE', 0)
+
+    @property
+    def session_cache(self):
+        return self.app.config.get('WEIXIN_SESSION_CACHE')
+
+    def open_session(self, ret):
+        """Return the :class:`WeixinSession` of the sender of a message,
+        or ``None`` if ``WEIXIN_SESSION_CACHE`` is not configured.
+
+        Handlers get it as the ``session`` keyword argument::
+
+            @weixin.register('*')
+            def wizard(sender, receiver, content, session, **kwargs):
+                step = session.get('step', 0)
+                session['step'] = step + 1
+                ...
+
+        :param ret: A message returned by :meth:`parse`.
+        """
+        cache = self.session_cache
+        if cache is None:
+            return None
+        key = 'weixin:session:%s:%s' % (ret['receiver'], ret['sender'])
+        timeout = self.app.config.get('WEIXIN_SESSION_TIMEOUT', 1800)
+        return WeixinSession(cache, key, timeout)
+
+    @property
+    def dedup(self):
+        """The :class:`MessageDedup` on ``WEIXIN_MSG_CACHE``, or ``None``
+        if it is not configured.
+        """
+        cache = self.app.config.get('WEIXIN_MSG_CACHE')
+        if cache is None:
+            return None
+        dedup = self._dedup
+        if dedup is None or dedup.cache is not cache:
+            timeout = self.app.config.get('WEIXIN_MSG_CACHE_TIMEOUT', 30)
+            dedup = MessageDedup(cache, timeout)
+            self._dedup = dedup
+        return dedup
+
+    @property
+    def crypto(self):
+        """The :class:`MessageCrypto` of the safe mode, or ``None`` if
+        ``WEIXIN_AES_KEY`` is not configured.
+        """
+        config = self.app.config
+        aes_key = config.get('WEIXIN_AES_KEY')
+        if not aes_key:
+            return None
+
+        options = (
+            self.token, aes_key, config.get('WEIXIN_APPID'),
+            config.get('WEIXIN_CRYPTO_BACKEND', 'auto'),
+        )
+        if self._crypto is None or self._crypto[0] != options:
+            self._crypto = (options, MessageCrypto(*options))
+        return self._crypto[1]
+
+    @property
+    def token_manager(self):
+        """The :class:`TokenManager` of ``WEIXIN_APPID`` and
+        ``WEIXIN_APP_SECRET``, sharing tokens in ``WEIXIN_TOKEN_CACHE``.
+        """
+        if self._token_manager is None:
+            config = self.app.config
+            appid = config.get('WEIXIN_APPID')
+            secret = config.get('WEIXIN_APP_SECRET')
+            if not appid or not secret:
+                raise RuntimeError('WEIXIN_APPID or WEIXIN_APP_SECRET missing')
+            self._token_manager = TokenManager(
+                appid, secret,
+                cache=config.get('WEIXIN_TOKEN_CACHE'),
+                base_url=config.get('WEIXIN_API_BASE_URL', API_BASE_URL),
+            )
+        return self._token_manager
+
+    @property
+    def access_token(self):
+        return self.token_manager.get_token()
+
+    @property
+    def client(self):
+        """The :class:`WeixinClient` to send active messages."""
+        if self._client is None:
+            base_url = self.app.config.get('WEIXIN_API_BASE_URL', API_BASE_URL)
+            self._client = WeixinClient(self.token_manager, base_url)
+        return self._client
+
+    @property
+    def media(self):
+        """The :class:`MediaClient` to download and upload media, with at
+        most ``WEIXIN_MEDIA_CONCURRENCY`` transfers at the same time.
+        """
+        if self._media is None:
+            config = self.app.config
+            self._media = MediaClient(
+                self.token_manager,
+                config.get('WEIXIN_API_BASE_URL', API_BASE_URL),
+                config.get('WEIXIN_MEDIA_CONCURRENCY', 4),
+            )
+        return self._media
+
+    @property
+    def executor(self):
+        """The worker pool that handlers run on, with ``WEIXIN_WORKERS``
+        threads. It is created on first use.
+        """
+        if self._parent is not None:
+            # accounts share the worker pool of their parent
+            return self._parent.executor
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    workers = self.app.config.get('WEIXIN_WORKERS', 8)
+                    self._executor = futures.ThreadPoolExecutor(workers)
+        return self._executor
+
+    #: Seconds a request is accepted for with ``WEIXIN_NONCE_CACHE``, when
+    #: ``WEIXIN_EXPIRES_IN`` isn't set
+    nonce_window = 300
+
+    def validate(self, signature, timestamp, nonce,
+                 msg_signature=None, encrypt=None):
         """Validate request signature.
 
         :param signature: A string signature parameter sent by weixin.
         :param timestamp: A int timestamp parameter sent by weixin.
         :param nonce: A int nonce parameter sent by weixin.
+        :param msg_signature: A string signature of the encrypted message
+                              sent by weixin in safe mode, optional.
+        :param encrypt: The ``Encrypt`` text of the encrypted message,
+                        required with ``msg_signature``.
+
+        If ``WEIXIN_NONCE_CACHE`` is configured, a signed request is only
+        accepted once: the ``(timestamp, nonce, signature)`` is remembered
+        for ``WEIXIN_EXPIRES_IN`` seconds, or :attr:`nonce_window` if it
+        isn't set, and older timestamps are rejected. A timestamp from
+        before the last entry the cache evicted to make room is rejected
+        too, since a replay of it can't be told apart.
         """
         if not self.token:
             raise RuntimeError('WEIXIN_TOKEN is missing')
 
-        if self.expires_in:
+        cache = self.nonce_cache
+        expires_in = self.expires_in
+        if cache is not None and not expires_in:
+            expires_in = self.nonce_window
+
+        if expires_in:
             try:
                 timestamp = int(timestamp)
             except (ValueError, TypeError):
@@ -96,42 +450,142 @@ class Weixin(object):
                 # this is a fake timestamp
                 return False
 
-            if delta > self.expires_in:
+            if delta > expires_in:
                 # expired timestamp
                 return False
 
-        values = [self.token, str(timestamp), str(nonce)]
-        s = ''.join(sorted(values))
-        hsh = hashlib.sha1(s.encode('utf-8')).hexdigest()
-        return signature == hsh
+        if signature != _signature(self.token, timestamp, nonce):
+            return False
+
+        if msg_signature is not None:
+            if self.crypto is None:
+                raise RuntimeError('WEIXIN_AES_KEY is missing')
+            expected = self.crypto.signature(timestamp, nonce, encrypt or '')
+            if msg_signature != expected:
+                return False
+
+        if cache is not None:
+            if timestamp <= getattr(cache, 'evicted_at', 0):
+                # the nonce may have been evicted, a replay can't be ruled out
+                log.warning(
+                    'WEIXIN_NONCE_CACHE is too small to hold %d seconds of '
+                    'requests', expires_in)
+                return False
+            key = 'weixin:nonce:%s:%s:%s' % (timestamp, nonce, signature)
+            if not cache.add(key, 1, timeout=expires_in):
+                # replayed request
+                return False
+        return True
 
     def parse(self, content):
         """Parse xml body sent by weixin.
 
+        With ``WEIXIN_PARSER`` set to ``fast``, the flat xml weixin sends
+        is scanned without building an element tree.
+
         :param content: A text of xml body.
         """
-        raw = {}
+        if self.parser == 'fast':
+            return self._parse_raw(_scan_xml(content))
+        return self._parse_raw(_parse_xml(content))
 
-        try:
-            root = etree.fromstring(content)
-        except SyntaxError as e:
-            raise ValueError(*e.args)
+    def parse_encrypted(self, content, msg_signature, timestamp, nonce):
+        """Parse encrypted xml body sent by weixin in safe mode.
 
-        for child in root:
-            raw[child.tag] = child.text
+        The ``Encrypt`` text is checked against ``msg_signature``, then
+        decrypted and parsed like :meth:`parse`.
 
-        formatted = self.format(raw)
+        :param content: A text of encrypted xml body.
+        :param msg_signature: The ``msg_signature`` parameter.
+        :param timestamp: The ``timestamp`` parameter.
+        :param nonce: The ``nonce`` parameter.
+        """
+        crypto = self.crypto
+        if crypto is None:
+            raise RuntimeError('WEIXIN_AES_KEY is missing')
 
-        msg_type = formatted['type']
-        msg_parser = getattr(self, 'parse_%s' % msg_type, None)
-        if callable(msg_parser):
-            parsed = msg_parser(raw)
+        if self.parser == 'fast':
+            encrypt = _scan_xml(content).get('Encrypt')
         else:
-            parsed = self.parse_invalid_type(raw)
+            encrypt = _parse_xml(content).get('Encrypt')
+        if not encrypt:
+            raise ValueError('Encrypt is missing')
+        if crypto.signature(timestamp, nonce, encrypt) != msg_signature:
+            raise ValueError('Invalid msg_signature')
+        return self._parse_chunks([crypto.decrypt(encrypt)])
+
+    def parse_stream(self, stream, max_size=None):
+        """Parse xml body from a file-like object sent by weixin.
+
+        The body is read in chunks, and a :class:`BodyTooLarge`, which is
+        a ``ValueError``, is raised as soon as it grows over ``max_size``
+        bytes. With ``WEIXIN_PARSER`` set to ``iterparse``, chunks are fed
+        to an incremental parser while they are read, document type
+        declarations are refused and parsed elements are dropped, so
+        memory stays bounded per request.
+
+        :param stream: A file-like object of the xml body.
+        :param max_size: Max bytes to read, default is
+                         ``WEIXIN_MAX_BODY_SIZE``, 0 means no limit.
+        """
+        if max_size is None:
+            max_size = self.max_body_size
+
+        return self._parse_chunks(_read_chunks(stream, max_size))
+
+    def _parse_chunks(self, chunks):
+        if self.parser == 'iterparse':
+            return self._parse_raw(_iterparse(chunks))
+        return self.parse(b''.join(chunks))
+
+    def _parse_raw(self, raw):
+        mode = self.message_mode
+        if mode == 'lazy':
+            return LazyMessage(
+                raw, self.format, self._type_parser,
+                self._message_keys(raw.get('MsgType')),
+            )
+        if mode == 'typed':
+            cls = MESSAGE_CLASSES.get(raw.get('MsgType'), UnknownMessage)
+            return cls(raw)
 
+        formatted = self.format(raw)
+        parsed = self._type_parser(formatted['type'])(raw)
         formatted.update(parsed)
         return formatted
 
+    def _type_parser(self, msg_type):
+        msg_parser = self._parsers.get(msg_type)
+        if msg_parser is not None:
+            return msg_parser
+
+        msg_parser = getattr(self, 'parse_%s' % msg_type, None)
+        if callable(msg_parser):
+            return msg_parser
+        return self.parse_invalid_type
+
+    def _message_keys(self, msg_type):
+        """The keys of a message of ``msg_type``, or ``None`` when
+        ``format`` or its parser is overridden, so they are only known
+        after decoding.
+        """
+        cache = self._message_keys_cache
+        if msg_type in cache:
+            return cache[msg_type]
+
+        keys = None
+        fields = MESSAGE_SCHEMA.get(msg_type, ())
+        if fields:
+            default = getattr(Weixin, 'parse_%s' % msg_type)
+        else:
+            default = Weixin.parse_invalid_type
+        parser = self._type_parser(msg_type)
+        if type(self).format is Weixin.format and \
+                getattr(parser, '__func__', None) is default:
+            keys = _FORMAT_KEYS.union(key for key, _, _ in fields)
+        cache[msg_type] = keys
+        return keys
+
     def format(self, kwargs):
         timestamp = int(kwargs.get('CreateTime', 0))
         return {
@@ -143,43 +597,14 @@ class Weixin(object):
             'time': datetime.fromtimestamp(timestamp),
         }
 
-    def parse_text(self, raw):
-        return {'content': raw.get('Content')}
-
-    def parse_image(self, raw):
-        return {'picurl': raw.get('PicUrl')}
-
-    def parse_location(self, raw):
-        return {
-            'location_x': raw.get('Location_X'),
-            'location_y': raw.get('Location_Y'),
-            'scale': int(raw.get('Scale', 0)),
-            'label': raw.get('Label'),
-        }
-
-    def parse_link(self, raw):
-        return {
-            'title': raw.get('Title'),
-            'description': raw.get('Description'),
-            'url': raw.get('url'),
-        }
-
-    def parse_event(self, raw):
-        return {
-            'event': raw.get('Event'),
-            'event_key': raw.get('EventKey'),
-            'ticket': raw.get('Ticket'),
-            'latitude': raw.get('Latitude'),
-            'longitude': raw.get('Longitude'),
-            'precision': raw.get('Precision'),
-        }
-
-    def parse_voice(self, raw):
-        return {
-            'media_id': raw.get('MediaID'),
-            'format': raw.get('Format'),
-            'recognition': raw.get('Recognition'),
-        }
+    parse_text = _compile_parser('text')
+    parse_image = _compile_parser('image')
+    parse_location = _compile_parser('location')
+    parse_link = _compile_parser('link')
+    parse_event = _compile_parser('event')
+    parse_voice = _compile_parser('voice')
+    parse_video = _compile_parser('video')
+    parse_shortvideo = _compile_parser('shortvideo')
 
     def parse_invalid_type(self, raw):
         return {}
@@ -219,11 +644,17 @@ class Weixin(object):
             * media_id: A string for video `media_id`
             * title: A string for video title
             * description: A string for video description
+
+        With ``WEIXIN_COMPILED_REPLY`` enabled, the reply is rendered into
+        bytes by :class:`ReplyRenderer` instead.
         """
         sender = sender or self.sender
         if not sender:
             raise RuntimeError('WEIXIN_SENDER or sender argument is missing')
 
+        if self.compiled_reply:
+            return self.renderer.render(username, type, sender, **kwargs)
+
         if type == 'text':
             content = kwargs.get('content', '')
             return text_reply(username, sender, content)
@@ -257,7 +688,8 @@ class Weixin(object):
                 values[k] = kwargs.get(k)
             return video_reply(username, sender, **values)
 
-    def register(self, key=None, func=None, **kwargs):
+    def register(self, key=None, func=None, match='exact', cache=False,
+                 message=False, **kwargs):
         """Register a command helper function.
 
         You can register the function::
@@ -280,16 +712,61 @@ class Weixin(object):
                 return weixin.reply(
                     username, sender=sender, content='text reply'
                 )
+
+        A text command can also be matched by ``match='prefix'``, which
+        handles any content starting with ``key``, or ``match='contains'``,
+        which handles any content containing ``key``::
+
+            weixin.register(u'查询', query, match='prefix')
+            weixin.register(u'退订', unsubscribe, match='contains')
+
+        Exact keywords win over prefixes, the longest prefix wins over
+        shorter ones, and prefixes win over contained keywords, of which
+        the first registered one wins. Registering the same keyword again
+        replaces its function, like an exact keyword.
+
+        A rule that always gives the same reply, like a help text, can be
+        registered with ``cache=True``. Its reply is rendered once for
+        every receiver and kept in :attr:`reply_cache`, later messages only
+        get the ``ToUserName`` and ``CreateTime`` patched::
+
+            weixin.register('help', 'help text', cache=True)
+
+        With ``message=True`` the handler gets the message as its only
+        positional argument instead of keyword arguments. Together with
+        ``WEIXIN_MESSAGE_MODE = 'lazy'`` only the fields it reads are
+        decoded::
+
+            @weixin.register('help', message=True)
+            def print_help(message):
+                return weixin.reply(
+                    message['sender'], sender=message['receiver'],
+                    content='text reply'
+                )
         """
+        if match not in ('exact', 'prefix', 'contains'):
+            raise ValueError('Invalid match: %r' % match)
+
         if func:
+            rule = func
+            if message:
+                rule = MessageRule(rule)
+            if cache:
+                rule = MemoizedReply(self, rule)
             if key is None:
                 limitation = frozenset(kwargs.items())
-                self._registry_without_key.append((func, limitation))
+                self._registry_without_key.append((rule, limitation))
+                self._rule_index = None
+            elif match == 'exact':
+                self._registry[key] = rule
             else:
-                self._registry[key] = func
+                self._keyword_rules.append((match, key, rule))
+                self._keyword_router = None
             return func
 
-        return self.__call__(key, **kwargs)
+        return self.__call__(
+            key, match=match, cache=cache, message=message, **kwargs
+        )
 
     def __call__(self, key, **kwargs):
         """Register a reply function.
@@ -310,7 +787,102 @@ class Weixin(object):
 
         return wrapper
 
-    def view_func(self):
+    def match(self, ret):
+        """Find the registered handler for a parsed message.
+
+        Text messages are matched against the keyword registry first, then
+        the prefix and contained keywords, then the attribute rules are
+        checked in the order they were registered.
+        If nothing matches, the ``'*'`` handler is used. An account added
+        by :meth:`add_account` falls back to the rules of its parent, and
+        at last the plain text ``'failed'`` is used.
+
+        :param ret: A message dict returned by :meth:`parse`.
+        """
+        if ret['type'] == 'text':
+            content = ret['content']
+            if content in self._registry:
+                return self._registry[content]
+
+            if self._keyword_rules and content:
+                router = self._keyword_router
+                if router is None:
+                    router = KeywordRouter(self._keyword_rules)
+                    self._keyword_router = router
+                func = router.match(content)
+                if func is not None:
+                    return func
+
+        index = self._rule_index
+        if index is None or len(index) != len(self._registry_without_key):
+            index = RuleIndex(self._registry_without_key)
+            self._rule_index = index
+
+        func = index.match(ret)
+        if func is None:
+            func = self._registry.get('*')
+        if func is None:
+            if self._parent is not None:
+                return self._parent.match(ret)
+            func = 'failed'
+        return func
+
+    def add_account(self, name, config):
+        """Serve another public account from this instance.
+
+        The account is a :class:`Weixin` with its own rules, using the
+        ``WEIXIN_*`` keys in ``config`` over the config of this instance,
+        and sharing the worker pool, timing hooks and late reply sink::
+
+            shop = weixin.add_account('shop', {
+                'WEIXIN_TOKEN': 'shop-token',
+                'WEIXIN_SENDER': 'gh_7f083739789a',
+            })
+
+            @shop.register('*')
+            def reply_all(**kwargs):
+                ...
+
+        :meth:`view_func` serves the account named by the ``account`` URL
+        variable, e.g. ``/weixin/<account>``; without it, a message is
+        served by the account whose ``WEIXIN_SENDER`` is its
+        ``ToUserName``. Requests of no account are served by this
+        instance if ``WEIXIN_TOKEN`` is configured.
+
+        :param name: The name of the account in URLs.
+        :param config: A dict of config overriding this instance's.
+        """
+        account = type(self)()
+        account.app = AccountApplication(self, config)
+        account._parent = self
+        account._timing_hooks = self._timing_hooks
+
+        old = self._accounts.get(name)
+        if old is not None:
+            self._account_senders.pop(old.sender, None)
+        self._accounts[name] = account
+        sender = config.get('WEIXIN_SENDER')
+        if sender:
+            self._account_senders[sender] = account
+        return account
+
+    def get_account(self, name):
+        """Return the account added by :meth:`add_account` as ``name``,
+        or ``None``.
+        """
+        return self._accounts.get(name)
+
+    def _resolve_account(self, name, body):
+        if name is not None:
+            return self._accounts.get(name)
+        if body is None:
+            return None
+        m = _TO_USER_NAME.search(body)
+        if m is None:
+            return None
+        return self._account_senders.get(m.group(1).decode('utf-8'))
+
+    def view_func(self, account=None):
         """Default view function for Flask app.
 
         This is a simple implementation for view func, you can add it to
@@ -318,22 +890,74 @@ class Weixin(object):
 
             weixin = Weixin(app)
             app.add_url_rule('/', view_func=weixin.view_func)
+
+        With accounts added by :meth:`add_account`, name the account in
+        the URL::
+
+            app.add_url_rule('/weixin/<account>', view_func=weixin.view_func)
+
+        :param account: The name of the account to serve, optional.
         """
         if request is None:
             raise RuntimeError('view_func need Flask be installed')
 
+        if account is None and not self._accounts:
+            return self._view()
+
+        body = None
+        if account is None and request.method == 'POST':
+            try:
+                body = b''.join(
+                    _read_chunks(request.stream, self.max_body_size))
+            except BodyTooLarge:
+                return 'too large', 413
+
+        target = self._resolve_account(account, body)
+        if target is not None:
+            return target._view(body)
+        if account is None and self.token:
+            return self._view(body)
+        return 'unknown account', 404
+
+    view_func.methods = ['GET', 'POST']
+
+    def _view(self, body=None):
+        timer = PhaseTimer() if self._timing_hooks else None
+
         signature = request.args.get('signature')
         timestamp = request.args.get('timestamp')
         nonce = request.args.get('nonce')
         if not self.validate(signature, timestamp, nonce):
             return 'signature failed', 400
+        if timer is not None:
+            timer.mark('validate')
 
         if request.method == 'GET':
             echostr = request.args.get('echostr', '')
             return echostr
 
+        max_size = self.max_body_size
+        if max_size and (request.content_length or 0) > max_size:
+            return 'too large', 413
+
+        encrypted = request.args.get('encrypt_type') == 'aes'
         try:
-            ret = self.parse(request.data)
+            if encrypted:
+                if body is None:
+                    body = b''.join(_read_chunks(request.stream, max_size))
+                msg_signature = request.args.get('msg_signature')
+                ret = self.parse_encrypted(
+                    body, msg_signature, timestamp, nonce)
+            elif body is not None:
+                if max_size and len(body) > max_size:
+                    raise BodyTooLarge('Body is too large')
+                ret = self._parse_chunks([body])
+            elif max_size or self.parser != 'etree':
+                ret = self.parse_stream(request.stream, max_size)
+            else:
+                ret = self.parse(request.data)
+        except BodyTooLarge:
+            return 'too large', 413
         except ValueError:
             return 'invalid', 400
 
@@ -341,69 +965,1725 @@ class Weixin(object):
             # not a valid message
             return 'invalid', 400
 
-        if ret['type'] == 'text' and ret['content'] in self._registry:
-            func = self._registry[ret['content']]
+        if timer is None:
+            return self._respond(ret, encrypted)
+
+        timer.mark('parse')
+        response = self._respond(ret, encrypted, timer)
+        timer.emit(self._timing_hooks, ret.get('type'))
+        return response
+
+    def _respond(self, ret, encrypted, timer=None):
+        if self._coalesce(ret):
+            return Response('success', content_type='text/plain')
+
+        dedup = self.dedup
+        if dedup is None:
+            return self._handle_message(ret, None, encrypted, timer)
+
+        key = dedup.key(ret)
+        if not dedup.begin(key):
+            # a retry of the message, wait for the first one
+            reply = dedup.wait(key, self.deadline or 5)
+            return Response(reply or 'success',
+                            content_type='text/xml; charset=utf-8')
+
+        try:
+            return self._handle_message(ret, key, encrypted, timer)
+        except Exception:
+            dedup.abort(key)
+            raise
+
+    def _handle_message(self, ret, dedup_key=None, encrypted=False,
+                        timer=None):
+        func = self.match(ret)
+        if timer is not None:
+            timer.mark('match')
+            timer.rule = func
+
+        if not callable(func):
+            text = self._reply_plain(ret, func)
+        elif not self.deadline:
+            text = _call_handler(func, ret, self.open_session(ret))
         else:
-            ret_set = frozenset(ret.items())
-            matched_rules = (
-                _func for _func, _limitation in self._registry_without_key
-                if _limitation.issubset(ret_set))
-            func = next(matched_rules, None)  # first matched rule
+            call = functools.partial(
+                _call_handler, func, ret, self.open_session(ret))
+            if has_request_context():
+                call = copy_current_request_context(call)
 
-        if func is None:
-            if '*' in self._registry:
-                func = self._registry['*']
+            future = self.executor.submit(call)
+            try:
+                text = future.result(timeout=self.deadline)
+            except futures.TimeoutError:
+                future.add_done_callback(functools.partial(
+                    self._deliver_late_reply, ret, dedup_key, encrypted))
+                return Response('success', content_type='text/plain')
+
+        if timer is not None and callable(func):
+            timer.mark('handler')
+
+        if encrypted and text:
+            text = self.crypto.wrap(text)
+        if dedup_key is not None:
+            self.dedup.finish(dedup_key, text)
+        response = Response(text, content_type='text/xml; charset=utf-8')
+        if timer is not None:
+            timer.mark('render')
+        return response
+
+    def late_reply(self, func):
+        """Register a function to receive replies that missed the deadline.
+
+        When ``WEIXIN_DEADLINE`` is set, a handler that is still running
+        after so many seconds gets a ``success`` response for weixin
+        instead, and its reply is sent to this function later. It gets the
+        parsed message and the reply the handler returned: the rendered
+        passive reply xml, as ``str`` or as ``bytes`` with
+        ``WEIXIN_COMPILED_REPLY`` or ``cache=True``, or an empty value.
+        :meth:`WeixinClient.send_reply` delivers it as a customer service
+        message::
+
+            @weixin.late_reply
+            def send_late_reply(message, reply):
+                weixin.client.send_reply(reply)
+        """
+        self._late_reply = func
+        return func
+
+    def coalesce(self, event, max_size=1024, interval=5.0):
+        """Register a bulk handler of a high-frequency event.
+
+        The events are acknowledged at once without a reply, and only the
+        latest one of every user is kept. They are flushed to the handler
+        as a list when ``max_size`` users are waiting, or ``interval``
+        seconds after the first one arrived::
+
+            @weixin.coalesce('LOCATION', max_size=500, interval=10)
+            def save_locations(messages):
+                db.save_locations([
+                    (m['sender'], m['latitude'], m['longitude'])
+                    for m in messages
+                ])
+
+        The handler runs in :attr:`executor` or a timer thread, outside of
+        any request. Call :meth:`flush_events` to flush the waiting events
+        on shutdown.
+
+        :param event: The ``Event`` of the messages, like ``LOCATION``.
+        :param max_size: Number of users to flush at.
+        :param interval: Max seconds to keep an event.
+        """
+        def wrapper(func):
+            self._coalescers[event.lower()] = EventCoalescer(
+                func, max_size, interval, self._submit)
+            return func
+
+        return wrapper
+
+    def flush_events(self):
+        """Flush the events waiting in every :meth:`coalesce` handler,
+        including the ones of the accounts.
+        """
+        for coalescer in self._coalescers.values():
+            coalescer.flush()
+        for account in self._accounts.values():
+            account.flush_events()
+
+    def _submit(self, func, *args):
+        return self.executor.submit(func, *args)
+
+    def _coalescer(self, event):
+        coalescer = self._coalescers.get(event.lower())
+        if coalescer is None and self._parent is not None:
+            return self._parent._coalescer(event)
+        return coalescer
+
+    def _coalesce(self, ret):
+        if ret['type'] != 'event' or not ret.get('event'):
+            return False
+        coalescer = self._coalescer(ret['event'])
+        if coalescer is None:
+            return False
+        coalescer.add(ret)
+        return True
+
+    def on_timing(self, func):
+        """Subscribe a function to the timings of every message.
+
+        It is called with a dict of seconds spent in each phase:
+        ``validate``, ``parse``, ``match``, ``handler`` (including the
+        replies rendered by the handler) and ``render``, the message type
+        and the matched rule, which is the handler or the plain text::
+
+            @weixin.on_timing
+            def log_timings(timings, message_type, rule):
+                ...
+
+        Phases that didn't run are missing. With nothing subscribed,
+        nothing is timed. :class:`TimingHistogram` collects them in
+        memory::
+
+            histogram = weixin.on_timing(TimingHistogram())
+        """
+        self._timing_hooks.append(func)
+        return func
+
+    def _deliver_late_reply(self, ret, dedup_key, encrypted, future):
+        dedup = dedup_key is not None and self.dedup
+        try:
+            text = future.result()
+        except Exception:
+            log.exception('Handler failed after the deadline')
+            if dedup:
+                dedup.abort(dedup_key)
+            return
+
+        sink = self._late_reply
+        if sink is None and self._parent is not None:
+            sink = self._parent._late_reply
+        if sink is None:
+            log.warning('Reply of %r missed the deadline', ret.get('id'))
+            if dedup:
+                # a retry can still take it as the passive reply
+                if encrypted and text:
+                    text = self.crypto.wrap(text)
+                dedup.finish(dedup_key, text)
+            return
+
+        if dedup:
+            # delivered by the late reply, retries only need an ack
+            dedup.finish(dedup_key, b'success')
+        try:
+            sink(ret, text)
+        except Exception:
+            log.exception('Failed to deliver the late reply')
+
+    def dispatch(self, ret):
+        """Run a parsed message through the matched rule like
+        :meth:`view_func` does, without a request, a deadline or the
+        deduplication. Returns the rule and the reply.
+
+        :param ret: A message returned by :meth:`parse`.
+        """
+        if self._coalesce(ret):
+            return self._coalescer(ret['event']), 'success'
+
+        func = self.match(ret)
+        if not callable(func):
+            return func, self._reply_plain(ret, func)
+        return func, _call_handler(func, ret, self.open_session(ret))
+
+    def _reply_plain(self, ret, content):
+        return self.reply(
+            username=ret['sender'],
+            sender=ret['receiver'],
+            content=content,
+        )
+
+    async def asgi_app(self, scope, receive, send):
+        """ASGI application of the default view function.
+
+        It works like :meth:`view_func`, but handlers can be defined with
+        ``async def``; plain functions are run in :attr:`executor`, so
+        they don't block other messages::
+
+            weixin = Weixin({'WEIXIN_TOKEN': 'token'})
+
+            @weixin.register('*')
+            async def reply_all(**kwargs):
+                ...
+
+            app = weixin.asgi_app
+
+        Since there is no Flask app context, ``weixin`` should be created
+        with a config dict or a Flask app instead of ``init_app``.
+        """
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        status, body, content_type = await self._asgi_respond(scope, receive)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', content_type),
+                (b'content-length', str(len(body)).encode('ascii')),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _acall_handler(self, func, ret):
+        session = self.open_session(ret)
+        if not isinstance(func, MemoizedReply):
+            text = await self._acall(func, ret, session)
+        else:
+            # run the wrapped handler itself, so a coroutine is awaited
+            # on this loop instead of a throwaway one in the executor
+            text = func.lookup(ret)
+            if text is None:
+                if callable(func.func):
+                    text = await self._acall(func.func, ret, session)
+                else:
+                    text = func.weixin._reply_plain(ret, func.func)
+                text = func.store(ret, text)
+        if session is not None:
+            session.save()
+        return text
+
+    async def _acall(self, func, ret, session):
+        call = functools.partial(_invoke, func, ret, session)
+        handler = func.func if isinstance(func, MessageRule) else func
+        if asyncio.iscoroutinefunction(handler):
+            return await call()
+        loop = asyncio.get_event_loop()
+        text = await loop.run_in_executor(self.executor, call)
+        if inspect.isawaitable(text):
+            text = await text
+        return text
+
+    async def _asgi_respond(self, scope, receive):
+        # path_params are set by routers like Starlette
+        name = (scope.get('path_params') or {}).get('account')
+        if name is None and not self._accounts:
+            return await self._asgi_view(scope, receive)
+
+        plain = b'text/plain; charset=utf-8'
+        chunks = None
+        if name is None and scope['method'] == 'POST':
+            try:
+                chunks = await _receive_chunks(receive, self.max_body_size)
+            except BodyTooLarge:
+                return 413, b'too large', plain
+            if chunks is None:
+                return 400, b'invalid', plain
+
+        body = None if chunks is None else b''.join(chunks)
+        account = self._resolve_account(name, body)
+        if account is not None:
+            return await account._asgi_view(scope, receive, chunks)
+        if name is None and self.token:
+            return await self._asgi_view(scope, receive, chunks)
+        return 404, b'unknown account', plain
+
+    async def _asgi_view(self, scope, receive, chunks=None):
+        plain = b'text/plain; charset=utf-8'
+        timer = PhaseTimer() if self._timing_hooks else None
+        query = scope.get('query_string', b'').decode('latin-1')
+        args = dict(parse_qsl(query))
+
+        signature = args.get('signature')
+        timestamp = args.get('timestamp')
+        nonce = args.get('nonce')
+        if not self.validate(signature, timestamp, nonce):
+            return 400, b'signature failed', plain
+        if timer is not None:
+            timer.mark('validate')
+
+        if scope['method'] == 'GET':
+            return 200, args.get('echostr', '').encode('utf-8'), plain
+        if scope['method'] != 'POST':
+            return 405, b'method not allowed', plain
+
+        max_size = self.max_body_size
+        if chunks is None:
+            try:
+                chunks = await _receive_chunks(receive, max_size)
+            except BodyTooLarge:
+                return 413, b'too large', plain
+            if chunks is None:
+                return 400, b'invalid', plain
+        elif max_size and sum(len(c) for c in chunks) > max_size:
+            return 413, b'too large', plain
+
+        encrypted = args.get('encrypt_type') == 'aes'
+        try:
+            if encrypted:
+                ret = self.parse_encrypted(
+                    b''.join(chunks), args.get('msg_signature'),
+                    timestamp, nonce)
             else:
-                func = 'failed'
+                ret = self._parse_chunks(chunks)
+        except ValueError:
+            return 400, b'invalid', plain
 
-        if callable(func):
-            text = func(**ret)
+        if timer is None:
+            return await self._arespond(ret, encrypted)
+
+        timer.mark('parse')
+        rv = await self._arespond(ret, encrypted, timer)
+        timer.emit(self._timing_hooks, ret.get('type'))
+        return rv
+
+    async def _arespond(self, ret, encrypted, timer=None):
+        if self._coalesce(ret):
+            return 200, b'success', b'text/plain; charset=utf-8'
+
+        dedup = self.dedup
+        if dedup is None:
+            return await self._ahandle_message(ret, None, encrypted, timer)
+
+        key = dedup.key(ret)
+        if not dedup.begin(key):
+            reply = await dedup.async_wait(key, self.deadline or 5)
+            return 200, reply or b'success', b'text/xml; charset=utf-8'
+
+        try:
+            return await self._ahandle_message(ret, key, encrypted, timer)
+        except Exception:
+            dedup.abort(key)
+            raise
+
+    async def _ahandle_message(self, ret, dedup_key=None, encrypted=False,
+                               timer=None):
+        func = self.match(ret)
+        if timer is not None:
+            timer.mark('match')
+            timer.rule = func
+
+        if not callable(func):
+            text = self._reply_plain(ret, func)
+        elif not self.deadline:
+            text = await self._acall_handler(func, ret)
         else:
-            # plain text
-            text = self.reply(
-                username=ret['sender'],
-                sender=ret['receiver'],
-                content=func,
-            )
+            task = asyncio.ensure_future(self._acall_handler(func, ret))
+            try:
+                text = await asyncio.wait_for(
+                    asyncio.shield(task), self.deadline)
+            except asyncio.TimeoutError:
+                task.add_done_callback(functools.partial(
+                    self._deliver_late_reply, ret, dedup_key, encrypted))
+                return 200, b'success', b'text/plain; charset=utf-8'
+
+        if timer is not None and callable(func):
+            timer.mark('handler')
+
+        if encrypted and text:
+            text = self.crypto.wrap(text)
+        body = _to_bytes(text or b'')
+        if dedup_key is not None:
+            self.dedup.finish(dedup_key, body)
+        if timer is not None:
+            timer.mark('render')
+        return 200, body, b'text/xml; charset=utf-8'
+
+
+class PhaseTimer(object):
+    """Measure the durations of the phases of a request."""
+
+    __slots__ = ('timings', 'rule', '_last')
+
+    def __init__(self):
+        self.timings = {}
+        self.rule = None
+        self._last = _timer()
+
+    def mark(self, phase):
+        """End a phase, which started at the end of the last one."""
+        now = _timer()
+        self.timings[phase] = now - self._last
+        self._last = now
+
+    def emit(self, hooks, message_type):
+        for hook in hooks:
+            try:
+                hook(self.timings, message_type, self.rule)
+            except Exception:
+                log.exception('Failed to call the timing hook %r', hook)
 
-        return Response(text, content_type='text/xml; charset=utf-8')
 
-    view_func.methods = ['GET', 'POST']
+def _rule_name(rule):
+    if callable(rule):
+        return getattr(rule, '__name__', repr(rule))
+    return rule
+
+
+class TimingHistogram(object):
+    """Aggregate the timings of :meth:`Weixin.on_timing` in memory.
+
+    Durations are counted in buckets growing by a factor of two from one
+    microsecond, per phase, message type and rule name, so the memory
+    doesn't grow with traffic.
+    """
+
+    #: upper bounds of the buckets in seconds, the last one is unbounded
+    bounds = tuple(1e-6 * 2 ** i for i in range(28))
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, timings, message_type, rule):
+        name = _rule_name(rule)
+        with self._lock:
+            for phase, seconds in timings.items():
+                key = (phase, message_type, name)
+                item = self._data.get(key)
+                if item is None:
+                    # count, total, buckets
+                    item = [0, 0.0, [0] * (len(self.bounds) + 1)]
+                    self._data[key] = item
+                item[0] += 1
+                item[1] += seconds
+                item[2][bisect.bisect_left(self.bounds, seconds)] += 1
+
+    def _merge(self, phase, message_type=None, rule=None):
+        count = 0
+        total = 0.0
+        buckets = [0] * (len(self.bounds) + 1)
+        with self._lock:
+            for (p, t, r), item in self._data.items():
+                if p != phase:
+                    continue
+                if message_type is not None and t != message_type:
+                    continue
+                if rule is not None and r != rule:
+                    continue
+                count += item[0]
+                total += item[1]
+                for i, n in enumerate(item[2]):
+                    buckets[i] += n
+        return count, total, buckets
+
+    def percentile(self, phase, p, message_type=None, rule=None):
+        """Estimate the ``p`` percentile of a phase in seconds, as the
+        upper bound of the bucket it falls in.
+        """
+        count, _, buckets = self._merge(phase, message_type, rule)
+        if not count:
+            return 0.0
+        rank = p / 100.0 * count
+        seen = 0
+        for i, n in enumerate(buckets):
+            seen += n
+            if seen >= rank and n:
+                if i < len(self.bounds):
+                    return self.bounds[i]
+                break
+        return float('inf')
+
+    def snapshot(self):
+        """Returns the statistics of every phase, type and rule."""
+        rv = []
+        with self._lock:
+            keys = list(self._data)
+        for phase, message_type, rule in sorted(keys, key=str):
+            count, total, _ = self._merge(phase, message_type, rule)
+            rv.append({
+                'phase': phase,
+                'type': message_type,
+                'rule': rule,
+                'count': count,
+                'mean': total / count if count else 0.0,
+                'p50': self.percentile(phase, 50, message_type, rule),
+                'p99': self.percentile(phase, 99, message_type, rule),
+            })
+        return rv
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def _signature(*values):
+    """The sha1 signature of weixin over the sorted ``values``."""
+    s = ''.join(sorted(str(v) for v in values))
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def _parse_xml(content):
+    raw = {}
+
+    try:
+        root = etree.fromstring(content)
+    except SyntaxError as e:
+        raise ValueError(*e.args)
+
+    for child in root:
+        raw[child.tag] = child.text
+    return raw
+
+
+_FLAT_ROOT = re.compile(r'\s*<(\w+)>')
+# a CDATA section stops at the first ``]]>``, so values split into
+# several sections don't match and fall back to etree, as does a ``]]>``
+# in plain text, which is not well-formed
+_FLAT_FIELD = re.compile(
+    r'\s*<(\w+)>(?:<!\[CDATA\[([^\]]*(?:\](?!\]>)[^\]]*)*)\]\]>'
+    r'|([^<&\]]*(?:\](?!\]>)[^<&\]]*)*))</\1>')
+_FLAT_END = re.compile(r'\s*</(\w+)>\s*$')
+
+
+def _scan_xml(content):
+    """Parse a flat xml body in a single pass without building a tree.
+
+    Only the shape weixin sends is scanned: a root element of children
+    with plain text or a single CDATA section. Anything else, like
+    declarations, attributes, nested elements, entities or carriage
+    returns, is parsed by :func:`_parse_xml` instead, so the result is
+    always the same.
+    """
+    text = content
+    if isinstance(text, bytes):
+        try:
+            text = text.decode('utf-8')
+        except UnicodeDecodeError:
+            return _parse_xml(content)
+
+    m = _FLAT_ROOT.match(text)
+    if m is None or '\r' in text:
+        return _parse_xml(content)
+    root = m.group(1)
+
+    raw = {}
+    pos = m.end()
+    match = _FLAT_FIELD.match
+    while True:
+        m = match(text, pos)
+        if m is None:
+            break
+        tag, cdata, value = m.groups()
+        if cdata is not None:
+            value = cdata
+        raw[tag] = value or None
+        pos = m.end()
+
+    m = _FLAT_END.match(text, pos)
+    if m is None or m.group(1) != root:
+        return _parse_xml(content)
+    return raw
+
+
+_CHUNK_SIZE = 4096
+_TO_USER_NAME = re.compile(
+    br'<ToUserName>\s*(?:<!\[CDATA\[)?(.*?)(?:\]\]>)?\s*</ToUserName>')
+_DISALLOWED = (b'<!DOCTYPE', b'<!ENTITY')
+
+
+class BodyTooLarge(ValueError):
+    """A request body is over the max size."""
+
+
+async def _receive_chunks(receive, max_size=0):
+    """Receive the body of an ASGI request, returns ``None`` if the client
+    is disconnected, raises :class:`BodyTooLarge` if it is over
+    ``max_size``.
+    """
+    chunks = []
+    size = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise BodyTooLarge('Body is too large')
+        chunks.append(chunk)
+        more_body = message.get('more_body', False)
+    return chunks
+
+
+def _read_chunks(stream, max_size=0, chunk_size=_CHUNK_SIZE):
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise BodyTooLarge('request body is too large')
+        yield chunk
+
+
+def _iterparse(chunks):
+    parser = etree.XMLPullParser(events=('start', 'end'))
+    raw = {}
+    depth = 0
+    tail = b''
+    try:
+        for chunk in chunks:
+            # keep a tail, so a declaration split by chunks is caught too
+            window = tail + chunk
+            for token in _DISALLOWED:
+                if token in window:
+                    raise ValueError('declaration is not allowed')
+            tail = window[-len(_DISALLOWED[0]):]
+
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1:
+                    raw[elem.tag] = elem.text
+                    elem.clear()
+        parser.close()
+    except SyntaxError as e:
+        raise ValueError(*e.args)
+    return raw
+
+
+class Message(object):
+    """Base class of the typed messages.
+
+    A typed message keeps its fields in ``__slots__``, and ``time`` is
+    computed from ``timestamp`` on access, so it takes much less memory
+    than the dict of :meth:`Weixin.parse`. It is a read-only mapping of
+    the same keys and values, so ``message['content']`` and
+    ``handler(**message)`` work as before.
+
+    :param raw: A dict of xml tags to text.
+    """
+
+    __slots__ = ('id', 'timestamp', 'receiver', 'sender', 'type')
+
+    def __init__(self, raw):
+        get = raw.get
+        self.id = get('MsgId')
+        self.timestamp = int(get('CreateTime', 0))
+        self.receiver = get('ToUserName')
+        self.sender = get('FromUserName')
+        self.type = get('MsgType')
+        self._decode(get)
+
+    def _decode(self, get):
+        pass
+
+    @property
+    def time(self):
+        return datetime.fromtimestamp(self.timestamp)
+
+    def keys(self):
+        return self._keys
+
+    def __getitem__(self, key):
+        if key in self._keyset:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self._keyset:
+            return getattr(self, key)
+        return default
+
+    def __contains__(self, key):
+        return key in self._keyset
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self._keys]
+
+    def values(self):
+        return [getattr(self, k) for k in self._keys]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (Message, dict)):
+            return self.copy() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        rv = self.__eq__(other)
+        if rv is NotImplemented:
+            return rv
+        return not rv
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.copy())
+
+    def __getstate__(self):
+        return [getattr(self, k) for k in self._slots]
+
+    def __setstate__(self, state):
+        for k, v in zip(self._slots, state):
+            setattr(self, k, v)
+
+
+def _message_class(name, msg_type=None):
+    fields = MESSAGE_SCHEMA.get(msg_type, ())
+    slots = tuple(key for key, _, _ in fields)
+    base_keys = ('id', 'timestamp', 'receiver', 'sender', 'type', 'time')
+    cls = type(name, (Message,), {
+        '__slots__': slots,
+        '__doc__': 'Typed message of %s.' % (msg_type or 'unknown types'),
+        '_decode': _compile_decoder(fields),
+    })
+    cls._keys = base_keys + slots
+    cls._keyset = frozenset(cls._keys)
+    cls._slots = Message.__slots__ + slots
+    return cls
+
+
+TextMessage = _message_class('TextMessage', 'text')
+ImageMessage = _message_class('ImageMessage', 'image')
+LocationMessage = _message_class('LocationMessage', 'location')
+LinkMessage = _message_class('LinkMessage', 'link')
+EventMessage = _message_class('EventMessage', 'event')
+VoiceMessage = _message_class('VoiceMessage', 'voice')
+VideoMessage = _message_class('VideoMessage', 'video')
+ShortVideoMessage = _message_class('ShortVideoMessage', 'shortvideo')
+UnknownMessage = _message_class('UnknownMessage')
+
+MESSAGE_CLASSES = {
+    'text': TextMessage,
+    'image': ImageMessage,
+    'location': LocationMessage,
+    'link': LinkMessage,
+    'event': EventMessage,
+    'voice': VoiceMessage,
+    'video': VideoMessage,
+    'shortvideo': ShortVideoMessage,
+}
+
+
+_ANY = object()
+_MISSING = object()
+
+
+class LazyMessage(dict):
+    """A message dict that decodes its fields on demand.
+
+    Only the routing fields (``receiver``, ``sender``, ``type``, ``id``,
+    ``timestamp``, and ``content`` or ``event``/``event_key``) are decoded
+    up front. The rest are filled in by the ``parse_<type>`` parser and
+    ``format`` the first time a missing key is looked up, or the message
+    is iterated. A key which isn't in ``keys`` is missing without decoding
+    anything.
+
+    :param raw: A dict of xml tags to text.
+    :param format: A function which formats the shared fields.
+    :param type_parser: A function which returns the parser of a type.
+    :param keys: All the keys of the message, or ``None`` if unknown.
+    """
+
+    __slots__ = ('_raw', '_loaders', '_keys')
+
+    def __init__(self, raw, format, type_parser, keys=None):
+        msg_type = raw.get('MsgType')
+        dict.__init__(
+            self,
+            receiver=raw.get('ToUserName'),
+            sender=raw.get('FromUserName'),
+            type=msg_type,
+            id=raw.get('MsgId'),
+            timestamp=int(raw.get('CreateTime', 0)),
+        )
+        if msg_type == 'text':
+            dict.__setitem__(self, 'content', raw.get('Content'))
+        elif msg_type == 'event':
+            dict.__setitem__(self, 'event', raw.get('Event'))
+            dict.__setitem__(self, 'event_key', raw.get('EventKey'))
+
+        self._raw = raw
+        self._loaders = [lambda raw: type_parser(msg_type)(raw), format]
+        self._keys = keys
+
+    def _absent(self, key):
+        keys = self._keys
+        return keys is not None and key not in keys
+
+    def _load(self, key=_MISSING):
+        """Decode fields until ``key`` is found, or everything is loaded."""
+        while self._loaders:
+            loader = self._loaders.pop(0)
+            for k, v in loader(self._raw).items():
+                if not dict.__contains__(self, k):
+                    dict.__setitem__(self, k, v)
+            if key is not _MISSING and dict.__contains__(self, key):
+                return
+
+    def __missing__(self, key):
+        if not self._absent(key):
+            self._load(key)
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        if self._absent(key):
+            return False
+        self._load(key)
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return dict.__getitem__(self, key)
+        return default
+
+    def __iter__(self):
+        self._load()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._load()
+        return dict.__len__(self)
+
+    def __eq__(self, other):
+        self._load()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        self._load()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        return (dict, (self.copy(),))
+
+    def keys(self):
+        self._load()
+        return dict.keys(self)
+
+    def values(self):
+        self._load()
+        return dict.values(self)
+
+    def items(self):
+        self._load()
+        return dict.items(self)
+
+    def copy(self):
+        self._load()
+        return dict(self)
+
+
+class MessageRule(object):
+    """A rule registered with ``message=True``.
+
+    The handler is called with the message itself instead of its fields as
+    keyword arguments, so a :class:`LazyMessage` only decodes the fields
+    the handler reads.
+
+    :param func: The handler function.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = getattr(func, '__name__', func)
+
+    def __repr__(self):
+        return '<MessageRule %r>' % (self.func,)
+
+    def __call__(self, message, **kwargs):
+        return self.func(message, **kwargs)
+
+
+class RuleIndex(object):
+    """Compiled lookup table for rules registered without a key.
+
+    Rules are bucketed by the values they require for ``type``, ``event``
+    and ``event_key``; a rule that doesn't limit one of them is filed under
+    a wildcard. A message only has to look at the (at most 8) buckets its
+    own values point to, so the cost doesn't grow with the number of rules.
+    The first registered rule still wins.
+
+    :param rules: A list of ``(func, limitation)`` pairs.
+    """
+
+    keys = ('type', 'event', 'event_key')
+
+    def __init__(self, rules):
+        self._size = len(rules)
+        self._buckets = {}
+
+        for order, (func, limitation) in enumerate(rules):
+            limits = dict(limitation)
+            bucket_key = tuple(limits.pop(k, _ANY) for k in self.keys)
+            bucket = self._buckets.setdefault(bucket_key, [])
+            bucket.append((order, func, tuple(limits.items())))
+
+    def __len__(self):
+        return self._size
+
+    def match(self, ret):
+        """Return the first registered function that matches ``ret``."""
+        buckets = self._buckets
+        if not buckets:
+            return None
+
+        values = [ret.get(k, _MISSING) for k in self.keys]
+        best = None
+        for t in (values[0], _ANY):
+            for e in (values[1], _ANY):
+                for k in (values[2], _ANY):
+                    bucket = buckets.get((t, e, k))
+                    if not bucket:
+                        continue
+                    for order, func, limits in bucket:
+                        if best is not None and order > best[0]:
+                            break
+                        if _satisfied(ret, limits):
+                            best = (order, func)
+                            break
+
+        if best is None:
+            return None
+        return best[1]
+
+
+def _satisfied(ret, limits):
+    for key, value in limits:
+        if key not in ret or ret[key] != value:
+            return False
+    return True
+
+
+class KeywordRouter(object):
+    """Compiled lookup tables for prefix and contained text keywords.
+
+    Prefixes are stored in a trie, walked from the start of the content
+    until it runs out of edges. Contained keywords are compiled into an
+    Aho-Corasick automaton, so every keyword is found within one pass over
+    the content. Neither cost grows with the number of keywords.
+
+    :param rules: A list of ``(match, keyword, func)`` tuples, where
+                  ``match`` is ``'prefix'`` or ``'contains'``.
+    """
+
+    def __init__(self, rules):
+        # trie nodes are ``[children, rule]``, a rule is ``(order, func)``
+        self._prefix = [{}, None]
+        # automaton states share the same index in the three lists
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None]
+
+        for order, (match, keyword, func) in enumerate(rules):
+            if not keyword:
+                continue
+            if match == 'prefix':
+                node = self._prefix
+                for char in keyword:
+                    node = node[0].setdefault(char, [{}, None])
+                node[1] = (order, func)
+            else:
+                self._add_contained(keyword, (order, func))
+
+        self._build_fail()
+
+    def _add_contained(self, keyword, rule):
+        goto = self._goto
+        state = 0
+        for char in keyword:
+            nxt = goto[state].get(char)
+            if nxt is None:
+                nxt = len(goto)
+                goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+                goto[state][char] = nxt
+            state = nxt
+        old = self._output[state]
+        if old is not None:
+            # the last registration of a keyword wins, in its first place
+            rule = (old[0], rule[1])
+        self._output[state] = rule
+
+    def _build_fail(self):
+        goto, fail, output = self._goto, self._fail, self._output
+        queue = list(goto[0].values())
+        for state in queue:
+            for char, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and char not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(char, 0)
+                if f == nxt:
+                    f = 0
+                fail[nxt] = f
+                # fold the outputs along the fail chain into each state,
+                # so the scan only looks at the state it ends up in
+                rule = output[f]
+                if rule is not None and (
+                        output[nxt] is None or rule[0] < output[nxt][0]):
+                    output[nxt] = rule
+
+    def match(self, content):
+        """Return the function registered for ``content``, or None."""
+        node = self._prefix
+        found = None
+        for char in content:
+            node = node[0].get(char)
+            if node is None:
+                break
+            if node[1] is not None:
+                found = node[1]
+        if found is not None:
+            return found[1]
+
+        goto, fail, output = self._goto, self._fail, self._output
+        if len(goto) == 1:
+            return None
+
+        state = 0
+        for char in content:
+            edges = goto[state]
+            while char not in edges and state:
+                state = fail[state]
+                edges = goto[state]
+            state = edges.get(char, 0)
+            rule = output[state]
+            if rule is not None and (found is None or rule[0] < found[0]):
+                found = rule
+        if found is None:
+            return None
+        return found[1]
+
+
+class MemoryCache(object):
+    """A thread safe in-process cache with LRU eviction and expiration.
+
+    It shares the interface of werkzeug/cachelib caches, so a shared
+    backend like ``cachelib.RedisCache`` can be used anywhere a
+    ``MemoryCache`` is accepted.
+
+    :param maxsize: Max number of items, the least recently used ones
+                    are evicted when it is full.
+    :param default_timeout: Default timeout in seconds, 0 means never
+                            expire.
+    """
+
+    def __init__(self, maxsize=1024, default_timeout=300):
+        self.maxsize = maxsize
+        self.default_timeout = default_timeout
+        #: When the newest unexpired item evicted to make room was set
+        self.evicted_at = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        if timeout:
+            return time.time() + timeout
+        return 0
+
+    def _get(self, key, now):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires = item[0]
+        if expires and expires <= now:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return item
+
+    def _set(self, key, value, timeout):
+        now = time.time()
+        self._data[key] = (self._expires(timeout), value, now)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            _, (expires, _, created) = self._data.popitem(last=False)
+            if (not expires or expires > now) and created > self.evicted_at:
+                self.evicted_at = created
+
+    def get(self, key):
+        with self._lock:
+            item = self._get(key, time.time())
+        if item is None:
+            return None
+        return item[1]
+
+    def has(self, key):
+        with self._lock:
+            return self._get(key, time.time()) is not None
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._set(key, value, timeout)
+        return True
+
+    def add(self, key, value, timeout=None):
+        """Set the value only if the key doesn't exist yet."""
+        with self._lock:
+            if self._get(key, time.time()) is not None:
+                return False
+            self._set(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+        return True
+
+
+class FileCache(object):
+    """A cache shared by processes on the same host, stored in files.
+
+    Every key is a file in ``path``, written atomically. :meth:`add`
+    creates the file exclusively, so it can be used as a lock between
+    processes. It shares the interface of :class:`MemoryCache`.
+
+    :param path: The directory for the cache files.
+    :param default_timeout: Default timeout in seconds, 0 means never
+                            expire.
+    """
+
+    def __init__(self, path, default_timeout=300):
+        self.path = path
+        self.default_timeout = default_timeout
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _filename(self, key):
+        name = hashlib.sha1(_to_bytes(key)).hexdigest()
+        return os.path.join(self.path, name)
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        if timeout:
+            return time.time() + timeout
+        return 0
+
+    def _read(self, filename):
+        """Returns ``(expires, value)``, or ``None`` if it is missing."""
+        try:
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # half written by add(), not ready yet
+            return (time.time() + 1, None)
+
+    def get(self, key):
+        item = self._read(self._filename(key))
+        if item is None:
+            return None
+        expires, value = item
+        if expires and expires <= time.time():
+            return None
+        return value
+
+    def has(self, key):
+        item = self._read(self._filename(key))
+        return item is not None and not (item[0] and item[0] <= time.time())
+
+    def set(self, key, value, timeout=None):
+        filename = self._filename(key)
+        tmp = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            pickle.dump((self._expires(timeout), value), f, -1)
+        os.rename(tmp, filename)
+        return True
+
+    def add(self, key, value, timeout=None):
+        """Set the value only if the key doesn't exist yet."""
+        filename = self._filename(key)
+        for _ in range(2):
+            try:
+                fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                item = self._read(filename)
+                if item is not None and not (item[0] and
+                                             item[0] <= time.time()):
+                    return False
+                # expired, remove it and try again
+                self._remove(filename)
+                continue
+
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((self._expires(timeout), value), f, -1)
+            return True
+        return False
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+            return True
+        except OSError:
+            return False
+
+    def delete(self, key):
+        return self._remove(self._filename(key))
+
+
+class WeixinSession(MutableMapping):
+    """The conversation state of a user, kept in a cache between messages.
+
+    It is loaded from the cache on first access, so handlers that don't
+    touch it cost nothing, and it is written back after the handler only
+    if it was changed. Changes inside mutable values are not detected,
+    set :attr:`modified` for them like with Flask sessions. An emptied
+    session is deleted from the cache.
+
+    :param cache: A :class:`MemoryCache`, or a shared cache like
+                  ``cachelib.RedisCache``.
+    :param key: The cache key of the session.
+    :param timeout: Seconds to keep an idle session.
+    """
+
+    def __init__(self, cache, key, timeout=None):
+        self.cache = cache
+        self.key = key
+        self.timeout = timeout
+        self.modified = False
+        self._data = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None:
+            data = self.cache.get(self.key)
+            # a copy, so the value in an in-process cache isn't changed
+            self._data = dict(data) if data else {}
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return '<WeixinSession %s %r>' % (self.key, self._data)
+
+    def save(self):
+        """Write the session back to the cache if it was changed."""
+        if not self.modified:
+            return
+        if self._data:
+            self.cache.set(self.key, dict(self._data), timeout=self.timeout)
+        else:
+            self.cache.delete(self.key)
+        self.modified = False
+
+
+class EventCoalescer(object):
+    """Buffer of the latest event per user, flushed to a bulk handler.
+
+    The buffer is a dict of senders to their latest message, so it never
+    holds more than ``max_size`` messages. When it is full, the batch is
+    handed to ``submit``; otherwise a timer flushes it ``interval``
+    seconds after the first message arrived.
+
+    :param func: The bulk handler, called with a list of messages.
+    :param max_size: Number of users to flush at.
+    :param interval: Max seconds to keep a message.
+    :param submit: A function to run the handler, like
+                   ``executor.submit``; it runs inline by default.
+    """
+
+    def __init__(self, func, max_size=1024, interval=5.0, submit=None):
+        self.func = func
+        self.__name__ = getattr(func, '__name__', repr(func))
+        self.max_size = max_size
+        self.interval = interval
+        self.submit = submit
+        self._buffer = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def add(self, message):
+        """Keep ``message`` if it is the latest one of its sender."""
+        sender = message['sender']
+        with self._lock:
+            old = self._buffer.get(sender)
+            if old is not None and old['timestamp'] > message['timestamp']:
+                # a late retry of an older event
+                return
+            self._buffer[sender] = message
+            if len(self._buffer) < self.max_size:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.interval, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            batch = self._swap()
+
+        if self.submit is None:
+            self._deliver(batch)
+        else:
+            self.submit(self._deliver, batch)
+
+    def flush(self):
+        """Hand the waiting messages to the handler now."""
+        with self._lock:
+            batch = self._swap()
+        if batch:
+            self._deliver(batch)
+
+    def _swap(self):
+        batch, self._buffer = self._buffer, {}
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _deliver(self, batch):
+        try:
+            self.func(list(batch.values()))
+        except Exception:
+            log.exception('Failed to handle %d coalesced events', len(batch))
+
+
+class MessageDedup(object):
+    """Run a handler only once for a message and its retries.
+
+    Weixin retries a message up to three times if the reply is slow. The
+    first request claims the message in the cache, and retries wait for
+    it to finish, then get the same reply bytes from the cache.
+
+    Messages are keyed on ``MsgId``, or ``FromUserName`` and
+    ``CreateTime`` for events that have no ``MsgId``.
+
+    :param cache: A :class:`MemoryCache` or a shared cachelib cache.
+    :param timeout: Seconds to keep a reply in the cache.
+    :param interval: Seconds between polls when waiting on a shared cache.
+    """
+
+    pending = 'weixin:pending'
+
+    def __init__(self, cache, timeout=30, interval=0.05):
+        self.cache = cache
+        self.timeout = timeout
+        self.interval = interval
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def key(self, ret):
+        msg_id = ret.get('id')
+        if msg_id:
+            return 'weixin:msg:%s' % msg_id
+        return 'weixin:msg:%s:%s' % (ret.get('sender'), ret.get('timestamp'))
+
+    def begin(self, key):
+        """Claim a message, returns ``False`` if it is claimed already."""
+        if not self.cache.add(key, self.pending, timeout=self.timeout):
+            return False
+        with self._lock:
+            self._events[key] = threading.Event()
+        return True
+
+    def finish(self, key, reply):
+        """Store the reply of a claimed message and wake up the retries."""
+        self.cache.set(key, _to_bytes(reply or b''), timeout=self.timeout)
+        self._release(key)
+
+    def abort(self, key):
+        """Release a claimed message without a reply."""
+        self.cache.delete(key)
+        self._release(key)
+
+    def _release(self, key):
+        with self._lock:
+            event = self._events.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def _poll(self, key):
+        value = self.cache.get(key)
+        if value == self.pending:
+            return False, None
+        return True, value
+
+    def wait(self, key, timeout):
+        """Wait for the reply of a message, ``None`` if it is not ready."""
+        with self._lock:
+            event = self._events.get(key)
+        if event is not None:
+            # claimed in this process, no need to poll
+            event.wait(timeout)
+            return self._poll(key)[1]
+
+        deadline = time.time() + timeout
+        while True:
+            done, value = self._poll(key)
+            if done or time.time() >= deadline:
+                return value
+            time.sleep(self.interval)
+
+    async def async_wait(self, key, timeout):
+        """Like :meth:`wait`, but for the event loop."""
+        deadline = time.time() + timeout
+        while True:
+            done, value = self._poll(key)
+            if done or time.time() >= deadline:
+                return value
+            await asyncio.sleep(self.interval)
+
+
+class APIError(RuntimeError):
+    """Error returned by the weixin API.
+
+    :param errcode: The ``errcode`` of the response.
+    :param errmsg: The ``errmsg`` of the response.
+    """
+
+    def __init__(self, errcode, errmsg=None):
+        super(APIError, self).__init__(errcode, errmsg)
+        self.errcode = errcode
+        self.errmsg = errmsg
+
+
+class TokenManager(object):
+    """Fetch and cache the ``access_token`` of an account.
+
+    The token is kept in a cache shared by workers, e.g. a
+    :class:`FileCache` or a redis cache, and refreshed ``refresh_ahead``
+    seconds before it expires. Only one worker refreshes it: the others
+    keep using the current token, or wait for the new one if there is
+    none::
+
+        tokens = TokenManager(appid, secret, FileCache('/tmp/weixin'))
+        access_token = tokens.get_token()
+
+    :param appid: The appid of the account.
+    :param secret: The app secret of the account.
+    :param cache: A shared cache, default is a :class:`MemoryCache`.
+    :param fetch: A function of ``fetch(appid, secret)`` which returns
+                  ``(access_token, expires_in)``, default is to request
+                  the weixin API at ``base_url``.
+    :param base_url: The base url of the weixin API.
+    :param refresh_ahead: Seconds to refresh before the token expires.
+    :param lock_timeout: Max seconds a refresh can hold the lock.
+    """
+
+    def __init__(self, appid, secret, cache=None, fetch=None,
+                 base_url=API_BASE_URL, refresh_ahead=300, lock_timeout=10):
+        self.appid = appid
+        self.secret = secret
+        self.cache = cache if cache is not None else MemoryCache()
+        self.fetch = fetch or self.fetch_token
+        self.base_url = base_url.rstrip('/')
+        self.refresh_ahead = refresh_ahead
+        self.lock_timeout = lock_timeout
+        self.key = 'weixin:access_token:%s' % appid
+        self._lock = threading.Lock()
+
+    def fetch_token(self, appid, secret):
+        """Request a new token from the weixin API."""
+        query = urlencode({
+            'grant_type': 'client_credential',
+            'appid': appid,
+            'secret': secret,
+        })
+        url = '%s/cgi-bin/token?%s' % (self.base_url, query)
+        resp = urlopen(url, timeout=self.lock_timeout)
+        try:
+            data = json.loads(resp.read().decode('utf-8'))
+        finally:
+            resp.close()
+        if 'access_token' not in data:
+            raise APIError(data.get('errcode'), data.get('errmsg'))
+        return data['access_token'], int(data.get('expires_in', 7200))
+
+    def _cached(self):
+        item = self.cache.get(self.key)
+        if item is None:
+            return None, 0
+        return item
+
+    def get_token(self):
+        """Returns a valid ``access_token``."""
+        token, expires = self._cached()
+        now = time.time()
+        if token and now < expires - self.refresh_ahead:
+            return token
+
+        with self._lock:
+            token, expires = self._cached()
+            now = time.time()
+            if token and now < expires - self.refresh_ahead:
+                return token
+
+            lock_key = self.key + ':lock'
+            if self.cache.add(lock_key, 1, timeout=self.lock_timeout):
+                try:
+                    return self._refresh()
+                finally:
+                    self.cache.delete(lock_key)
+
+            if token and now < expires:
+                # another worker is refreshing, the token is still valid
+                return token
+            return self._wait(lock_key)
+
+    def _refresh(self):
+        token, expires_in = self.fetch(self.appid, self.secret)
+        expires = time.time() + expires_in
+        self.cache.set(self.key, (token, expires), timeout=expires_in)
+        return token
+
+    def _wait(self, lock_key):
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(0.05)
+            token, expires = self._cached()
+            if token and time.time() < expires:
+                return token
+            if self.cache.add(lock_key, 1, timeout=self.lock_timeout):
+                # the other worker failed, take it over
+                try:
+                    return self._refresh()
+                finally:
+                    self.cache.delete(lock_key)
+        raise RuntimeError('Timeout waiting for the access_token')
+
+    def invalidate(self):
+        """Drop the cached token, e.g. when the API rejects it."""
+        self.cache.delete(self.key)
+
+
+#: Fields of the replies, per reply type. Each one is ``(wrapper tag,
+#: ((xml tag, key), ...))``. The templates of the reply helpers and of
+#: :class:`ReplyRenderer` are compiled from it.
+REPLY_SCHEMA = {
+    'text': (None, (
+        ('Content', 'content'),
+    )),
+    'music': ('Music', (
+        ('Title', 'title'),
+        ('Description', 'description'),
+        ('MusicUrl', 'music_url'),
+        ('HQMusicUrl', 'hq_music_url'),
+    )),
+    'image': ('Image', (
+        ('MediaId', 'media_id'),
+    )),
+    'voice': ('Voice', (
+        ('MediaId', 'media_id'),
+    )),
+    'video': ('Video', (
+        ('MediaId', 'media_id'),
+        ('Title', 'title'),
+        ('Description', 'description'),
+    )),
+    'article': ('item', (
+        ('Title', 'title'),
+        ('Description', 'description'),
+        ('PicUrl', 'picurl'),
+        ('Url', 'url'),
+    )),
+    'service_account': ('TransInfo', (
+        ('KfAccount', 'service_account'),
+    )),
+}
+
+
+def _reply_template(name):
+    wrapper, fields = REPLY_SCHEMA[name]
+    body = ''.join(
+        '<%s><![CDATA[%%(%s)s]]></%s>' % (tag, key, tag)
+        for tag, key in fields
+    )
+    if wrapper:
+        body = '<%s>%s</%s>' % (wrapper, body, wrapper)
+    return body
+
+
+#: ``%(key)s`` templates of the reply bodies, compiled from REPLY_SCHEMA
+REPLY_TEMPLATES = dict((k, _reply_template(k)) for k in REPLY_SCHEMA)
+
+_XML_TEMPLATES = dict(
+    (k, '<xml>%(shared)s' + v + '</xml>') for k, v in REPLY_TEMPLATES.items()
+)
+
+
+def _cdata(value):
+    """Escape ``value`` to be put in a CDATA section.
+
+    A ``]]>`` would end the section, so it is split into two sections
+    there. Text without it, which is nearly all of it, is returned as is.
+    """
+    if isinstance(value, str):
+        if ']]>' in value:
+            return value.replace(']]>', ']]]]><![CDATA[>')
+    elif isinstance(value, bytes):
+        if b']]>' in value:
+            return value.replace(b']]>', b']]]]><![CDATA[>')
+    return value
+
+
+def _cdata_dict(values):
+    return dict((k, _cdata(v)) for k, v in values.items())
+
+
+#: Number of ``]]>`` in each reply template. A rendered body with more of
+#: them has a value which needs :func:`_cdata`, checked in one pass.
+_CDATA_ENDS = dict((k, v.count(']]>')) for k, v in REPLY_TEMPLATES.items())
+
+
+def _render_body(type, values):
+    template = REPLY_TEMPLATES[type]
+    body = template % values
+    if body.count(']]>') != _CDATA_ENDS[type]:
+        body = template % _cdata_dict(values)
+    return body
 
 
 def text_reply(username, sender, content):
-    shared = _shared_reply(username, sender, 'text')
-    template = '<xml>%s<Content><![CDATA[%s]]></Content></xml>'
-    return template % (shared, content)
+    if ']]>' in str(content):
+        content = _cdata(content)
+    dct = {
+        'shared': _shared_reply(username, sender, 'text'),
+        'content': content,
+    }
+    return _XML_TEMPLATES['text'] % dct
 
 
 def music_reply(username, sender, **kwargs):
-    kwargs['shared'] = _shared_reply(username, sender, 'music')
-
-    template = (
-        '<xml>'
-        '%(shared)s'
-        '<Music>'
-        '<Title><![CDATA[%(title)s]]></Title>'
-        '<Description><![CDATA[%(description)s]]></Description>'
-        '<MusicUrl><![CDATA[%(music_url)s]]></MusicUrl>'
-        '<HQMusicUrl><![CDATA[%(hq_music_url)s]]></HQMusicUrl>'
-        '</Music>'
-        '</xml>'
+    return '<xml>%s%s</xml>' % (
+        _shared_reply(username, sender, 'music'),
+        _render_body('music', kwargs),
     )
-    return template % kwargs
 
 
 def news_reply(username, sender, *items):
-    item_template = (
-        '<item>'
-        '<Title><![CDATA[%(title)s]]></Title>'
-        '<Description><![CDATA[%(description)s]]></Description>'
-        '<PicUrl><![CDATA[%(picurl)s]]></PicUrl>'
-        '<Url><![CDATA[%(url)s]]></Url>'
-        '</item>'
-    )
-    articles = [item_template % o for o in items]
+    item_template = REPLY_TEMPLATES['article']
+    articles = ''.join([item_template % o for o in items])
+    if articles.count(']]>') != _CDATA_ENDS['article'] * len(items):
+        articles = ''.join([item_template % _cdata_dict(o) for o in items])
 
     template = (
         '<xml>'
@@ -415,7 +2695,7 @@ def news_reply(username, sender, *items):
     dct = {
         'shared': _shared_reply(username, sender, 'news'),
         'count': len(items),
-        'articles': ''.join(articles)
+        'articles': articles,
     }
     return template % dct
 
@@ -426,10 +2706,8 @@ def transfer_customer_service_reply(username, sender, service_account):
         '%(transfer_info)s</xml>')
     transfer_info = ''
     if service_account:
-        transfer_info = (
-            '<TransInfo>'
-            '<KfAccount>![CDATA[%s]]</KfAccount>'
-            '</TransInfo>') % service_account
+        transfer_info = _render_body(
+            'service_account', {'service_account': service_account})
 
     dct = {
         'shared': _shared_reply(username, sender,
@@ -440,34 +2718,35 @@ def transfer_customer_service_reply(username, sender, service_account):
 
 
 def image_reply(username, sender, media_id):
-    shared = _shared_reply(username, sender, 'image')
-    template = '<xml>%s<Image><MediaId><![CDATA[%s]]></MediaId></Image></xml>'
-    return template % (shared, media_id)
+    if ']]>' in str(media_id):
+        media_id = _cdata(media_id)
+    dct = {
+        'shared': _shared_reply(username, sender, 'image'),
+        'media_id': media_id,
+    }
+    return _XML_TEMPLATES['image'] % dct
 
 
 def voice_reply(username, sender, media_id):
-    shared = _shared_reply(username, sender, 'voice')
-    template = '<xml>%s<Voice><MediaId><![CDATA[%s]]></MediaId></Voice></xml>'
-    return template % (shared, media_id)
+    if ']]>' in str(media_id):
+        media_id = _cdata(media_id)
+    dct = {
+        'shared': _shared_reply(username, sender, 'voice'),
+        'media_id': media_id,
+    }
+    return _XML_TEMPLATES['voice'] % dct
 
 
 def video_reply(username, sender, **kwargs):
-    kwargs['shared'] = _shared_reply(username, sender, 'video')
-
-    template = (
-        '<xml>'
-        '%(shared)s'
-        '<Video>'
-        '<MediaId><![CDATA[%(media_id)s]]></MediaId>'
-        '<Title><![CDATA[%(title)s]]></Title>'
-        '<Description><![CDATA[%(description)s]]></Description>'
-        '</Video>'
-        '</xml>'
+    return '<xml>%s%s</xml>' % (
+        _shared_reply(username, sender, 'video'),
+        _render_body('video', kwargs),
     )
-    return template % kwargs
 
 
 def _shared_reply(username, sender, type):
+    if ']]>' in '%s%s' % (username, sender):
+        username, sender = _cdata(username), _cdata(sender)
     dct = {
         'username': username,
         'sender': sender,
@@ -481,3 +2760,1148 @@ def _shared_reply(username, sender, type):
         '<MsgType><![CDATA[%(type)s]]></MsgType>'
     )
     return template % dct
+
+
+def _invoke(func, ret, session=None):
+    args = ()
+    if isinstance(func, (MessageRule, MemoizedReply)):
+        args, kwargs = (ret,), {}
+    else:
+        kwargs = ret
+    if session is None:
+        return func(*args, **kwargs)
+    return func(*args, session=session, **kwargs)
+
+
+def _call_handler(func, ret, session=None):
+    text = _invoke(func, ret, session)
+    if inspect.isawaitable(text):
+        text = _run_coroutine(text)
+    if session is not None:
+        session.save()
+    return text
+
+
+def _run_coroutine(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, str):
+        value = str(value)
+    return value.encode('utf-8')
+
+
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s')
+
+
+def _compile_template(template):
+    """Compile a ``%(name)s`` template into ``(literal, name)`` segments.
+
+    The last segment has a name of ``None``.
+    """
+    segments = []
+    pos = 0
+    for m in _PLACEHOLDER.finditer(template):
+        segments.append((template[pos:m.start()].encode('utf-8'), m.group(1)))
+        pos = m.end()
+    segments.append((template[pos:].encode('utf-8'), None))
+    return tuple(segments)
+
+
+class ReplyRenderer(object):
+    """Render replies straight into bytes from precompiled templates.
+
+    Every reply type is compiled once into segments of bytes, and the
+    shared header for a ``(username, sender, type)`` is encoded once and
+    cached, so rendering a reply is only a few buffer writes. It accepts
+    the same parameters as :meth:`Weixin.reply`.
+
+    :param cache_size: Max number of cached headers, the least recently
+                       used ones are evicted when it is full.
+    """
+
+    templates = REPLY_TEMPLATES
+
+    defaults = {
+        'content': '',
+        'media_id': '',
+    }
+
+    def __init__(self, cache_size=1024):
+        self.cache_size = cache_size
+        self._compiled = dict(
+            (k, _compile_template(v)) for k, v in self.templates.items()
+        )
+        self._headers = OrderedDict()
+        self._lock = threading.Lock()
+        self._timestamp = (None, None)
+
+    def header(self, username, sender, type):
+        """Return the encoded header around ``CreateTime`` as a tuple."""
+        key = (username, sender, type)
+        with self._lock:
+            parts = self._headers.get(key)
+            if parts is not None:
+                self._headers.move_to_end(key)
+                return parts
+
+        parts = (
+            b''.join([
+                b'<xml><ToUserName><![CDATA[', _cdata(_to_bytes(username)),
+                b']]></ToUserName><FromUserName><![CDATA[',
+                _cdata(_to_bytes(sender)),
+                b']]></FromUserName><CreateTime>',
+            ]),
+            b''.join([
+                b'</CreateTime><MsgType><![CDATA[', _to_bytes(type),
+                b']]></MsgType>',
+            ]),
+        )
+        with self._lock:
+            self._headers[key] = parts
+            while len(self._headers) > self.cache_size:
+                self._headers.popitem(last=False)
+        return parts
+
+    def _now(self):
+        now = int(time.time())
+        cached, value = self._timestamp
+        if cached != now:
+            value = str(now).encode('ascii')
+            self._timestamp = (now, value)
+        return value
+
+    def _write(self, buf, name, values):
+        defaults = self.defaults
+        for literal, key in self._compiled[name]:
+            buf += literal
+            if key is not None:
+                # every placeholder is in a CDATA section
+                value = _to_bytes(values.get(key, defaults.get(key)))
+                if b']]>' in value:
+                    value = _cdata(value)
+                buf += value
+
+    def render(self, username, type='text', sender=None, **kwargs):
+        """Render a reply into bytes, ``None`` for unknown types."""
+        if type == 'customer_service':
+            msg_type = 'transfer_customer_service'
+        elif type in ('text', 'music', 'news', 'image', 'voice', 'video'):
+            msg_type = type
+        else:
+            return None
+
+        head, tail = self.header(username, sender, msg_type)
+        buf = bytearray(head)
+        buf += self._now()
+        buf += tail
+
+        if type == 'news':
+            articles = kwargs.get('articles', [])
+            buf += b'<ArticleCount>'
+            buf += str(len(articles)).encode('ascii')
+            buf += b'</ArticleCount><Articles>'
+            for article in articles:
+                self._write(buf, 'article', article)
+            buf += b'</Articles>'
+        elif type == 'customer_service':
+            if kwargs.get('service_account'):
+                self._write(buf, 'service_account', kwargs)
+        else:
+            self._write(buf, type, kwargs)
+
+        buf += b'</xml>'
+        return bytes(buf)
+
+
+_REPLY_HEADER = re.compile(
+    br'<xml><ToUserName><!\[CDATA\[(.*?)\]\]></ToUserName>'
+    br'(<FromUserName><!\[CDATA\[.*?\]\]></FromUserName><CreateTime>)'
+    br'\d+(</CreateTime>)', re.S)
+
+
+class ReplyCache(object):
+    """A thread safe LRU of rendered replies, for :class:`MemoizedReply`.
+
+    A reply is kept as the bytes around its ``ToUserName`` and
+    ``CreateTime``, so a hit is only a join of the new values.
+
+    :param maxsize: Max number of replies, the least recently used ones
+                    are evicted when it is full.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, username):
+        """Return the reply of ``key`` to ``username``, or ``None``."""
+        with self._lock:
+            parts = self._data.get(key)
+            if parts is None:
+                return None
+            self._data.move_to_end(key)
+        head, tail = parts
+        return b''.join([
+            b'<xml><ToUserName><![CDATA[', _cdata(_to_bytes(username)),
+            head, str(int(time.time())).encode('ascii'), tail,
+        ])
+
+    def set(self, key, username, reply):
+        """Keep a reply rendered for ``username``. Replies that aren't
+        addressed to ``username`` are not kept, returns whether it is.
+        """
+        if not reply:
+            return False
+        reply = _to_bytes(reply)
+        m = _REPLY_HEADER.match(reply)
+        if m is None or m.group(1) != _cdata(_to_bytes(username)):
+            return False
+
+        parts = (b']]></ToUserName>' + m.group(2), reply[m.start(3):])
+        with self._lock:
+            self._data[key] = parts
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class MemoizedReply(object):
+    """A rule registered with ``cache=True``.
+
+    The reply of the wrapped handler, or of the plain text, is rendered
+    once per receiver and then taken from :attr:`Weixin.reply_cache`.
+    Replies are always returned as bytes, whether they are cached or not.
+
+    :param weixin: The :class:`Weixin` it is registered to.
+    :param func: The handler function or the plain text.
+    """
+
+    def __init__(self, weixin, func):
+        self.weixin = weixin
+        self.func = func
+        self.__name__ = getattr(func, '__name__', func)
+
+    def __repr__(self):
+        return '<MemoizedReply %r>' % (self.func,)
+
+    def __call__(self, message, **kwargs):
+        reply = self.lookup(message)
+        if reply is not None:
+            return reply
+
+        if callable(self.func):
+            reply = _invoke(self.func, message, kwargs.get('session'))
+            if inspect.isawaitable(reply):
+                reply = _run_coroutine(reply)
+        else:
+            reply = self.weixin._reply_plain(message, self.func)
+        return self.store(message, reply)
+
+    def lookup(self, message):
+        """Return the cached reply to ``message``, or ``None``."""
+        return self.weixin.reply_cache.get(
+            (self, message.get('receiver')), message.get('sender'))
+
+    def store(self, message, reply):
+        """Cache the reply to ``message``, returns it as bytes."""
+        reply = _to_bytes(reply) if reply else b''
+        self.weixin.reply_cache.set(
+            (self, message.get('receiver')), message.get('sender'), reply)
+        return reply
+
+
+def _aes_tables():
+    def xtime(a):
+        a <<= 1
+        if a & 0x100:
+            a ^= 0x11b
+        return a
+
+    def mul(a, b):
+        rv = 0
+        while b:
+            if b & 1:
+                rv ^= a
+            a = xtime(a)
+            b >>= 1
+        return rv
+
+    exp = [0] * 255
+    log = [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x ^= xtime(x)
+
+    sbox = [0] * 256
+    inv_sbox = [0] * 256
+    for i in range(256):
+        b = exp[(255 - log[i]) % 255] if i else 0
+        s = b
+        for _ in range(4):
+            b = ((b << 1) | (b >> 7)) & 0xff
+            s ^= b
+        s ^= 0x63
+        sbox[i] = s
+        inv_sbox[s] = i
+
+    def ror(w):
+        return ((w >> 8) | (w << 24)) & 0xffffffff
+
+    te = [[0] * 256 for _ in range(4)]
+    td = [[0] * 256 for _ in range(4)]
+    for i in range(256):
+        s = sbox[i]
+        w = (mul(s, 2) << 24) | (s << 16) | (s << 8) | mul(s, 3)
+        t = inv_sbox[i]
+        v = (mul(t, 14) << 24) | (mul(t, 9) << 16) | \
+            (mul(t, 13) << 8) | mul(t, 11)
+        for j in range(4):
+            te[j][i] = w
+            td[j][i] = v
+            w = ror(w)
+            v = ror(v)
+    return sbox, inv_sbox, te, td
+
+
+_AES_TABLES = None
+_AES_BLOCK = struct.Struct('>4I')
+
+
+class PythonAES(object):
+    """AES in CBC mode, written in pure Python.
+
+    The key schedules are computed once, so an instance should be reused
+    for every message of an account.
+
+    :param key: A key of 16, 24 or 32 bytes.
+    :param iv: A 16 bytes initialization vector.
+    """
+
+    def __init__(self, key, iv):
+        global _AES_TABLES
+        if _AES_TABLES is None:
+            _AES_TABLES = _aes_tables()
+        sbox, _, _, td = _AES_TABLES
+
+        if len(key) not in (16, 24, 32):
+            raise ValueError('Invalid AES key size')
+        self.iv = _AES_BLOCK.unpack(iv)
+
+        nk = len(key) // 4
+        self.rounds = rounds = nk + 6
+        rk = list(struct.unpack('>%dI' % nk, key))
+        rcon = 1
+        for i in range(nk, 4 * (rounds + 1)):
+            w = rk[i - 1]
+            if i % nk == 0:
+                w = ((sbox[(w >> 16) & 0xff] << 24) |
+                     (sbox[(w >> 8) & 0xff] << 16) |
+                     (sbox[w & 0xff] << 8) | sbox[w >> 24]) ^ (rcon << 24)
+                rcon <<= 1
+                if rcon & 0x100:
+                    rcon ^= 0x11b
+            elif nk > 6 and i % nk == 4:
+                w = ((sbox[w >> 24] << 24) | (sbox[(w >> 16) & 0xff] << 16) |
+                     (sbox[(w >> 8) & 0xff] << 8) | sbox[w & 0xff])
+            rk.append(rk[i - nk] ^ w)
+        self._ek = rk
+
+        # round keys of the equivalent inverse cipher
+        dk = []
+        for r in range(rounds, -1, -1):
+            words = rk[4 * r:4 * r + 4]
+            if 0 < r < rounds:
+                words = [
+                    td[0][sbox[w >> 24]] ^ td[1][sbox[(w >> 16) & 0xff]] ^
+                    td[2][sbox[(w >> 8) & 0xff]] ^ td[3][sbox[w & 0xff]]
+                    for w in words
+                ]
+            dk.extend(words)
+        self._dk = dk
+
+    def encrypt(self, data):
+        if len(data) % 16:
+            raise ValueError('Data is not aligned to the block size')
+        s_, _, (te0, te1, te2, te3), _ = _AES_TABLES
+        rk = self._ek
+        rounds = self.rounds
+        out = bytearray(len(data))
+        c0, c1, c2, c3 = self.iv
+        for offset in range(0, len(data), 16):
+            p0, p1, p2, p3 = _AES_BLOCK.unpack_from(data, offset)
+            s0 = p0 ^ c0 ^ rk[0]
+            s1 = p1 ^ c1 ^ rk[1]
+            s2 = p2 ^ c2 ^ rk[2]
+            s3 = p3 ^ c3 ^ rk[3]
+            k = 4
+            for _ in range(rounds - 1):
+                t0 = (te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xff] ^
+                      te2[(s2 >> 8) & 0xff] ^ te3[s3 & 0xff] ^ rk[k])
+                t1 = (te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xff] ^
+                      te2[(s3 >> 8) & 0xff] ^ te3[s0 & 0xff] ^ rk[k + 1])
+                t2 = (te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xff] ^
+                      te2[(s0 >> 8) & 0xff] ^ te3[s1 & 0xff] ^ rk[k + 2])
+                t3 = (te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xff] ^
+                      te2[(s1 >> 8) & 0xff] ^ te3[s2 & 0xff] ^ rk[k + 3])
+                s0, s1, s2, s3 = t0, t1, t2, t3
+                k += 4
+            c0 = ((s_[s0 >> 24] << 24) | (s_[(s1 >> 16) & 0xff] << 16) |
+                  (s_[(s2 >> 8) & 0xff] << 8) | s_[s3 & 0xff]) ^ rk[k]
+            c1 = ((s_[s1 >> 24] << 24) | (s_[(s2 >> 16) & 0xff] << 16) |
+                  (s_[(s3 >> 8) & 0xff] << 8) | s_[s0 & 0xff]) ^ rk[k + 1]
+            c2 = ((s_[s2 >> 24] << 24) | (s_[(s3 >> 16) & 0xff] << 16) |
+                  (s_[(s0 >> 8) & 0xff] << 8) | s_[s1 & 0xff]) ^ rk[k + 2]
+            c3 = ((s_[s3 >> 24] << 24) | (s_[(s0 >> 16) & 0xff] << 16) |
+                  (s_[(s1 >> 8) & 0xff] << 8) | s_[s2 & 0xff]) ^ rk[k + 3]
+            _AES_BLOCK.pack_into(out, offset, c0, c1, c2, c3)
+        return bytes(out)
+
+    def decrypt(self, data):
+        if len(data) % 16:
+            raise ValueError('Data is not aligned to the block size')
+        _, si, _, (td0, td1, td2, td3) = _AES_TABLES
+        dk = self._dk
+        rounds = self.rounds
+        out = bytearray(len(data))
+        v0, v1, v2, v3 = self.iv
+        for offset in range(0, len(data), 16):
+            c0, c1, c2, c3 = _AES_BLOCK.unpack_from(data, offset)
+            s0 = c0 ^ dk[0]
+            s1 = c1 ^ dk[1]
+            s2 = c2 ^ dk[2]
+            s3 = c3 ^ dk[3]
+            k = 4
+            for _ in range(rounds - 1):
+                t0 = (td0[s0 >> 24] ^ td1[(s3 >> 16) & 0xff] ^
+                      td2[(s2 >> 8) & 0xff] ^ td3[s1 & 0xff] ^ dk[k])
+                t1 = (td0[s1 >> 24] ^ td1[(s0 >> 16) & 0xff] ^
+                      td2[(s3 >> 8) & 0xff] ^ td3[s2 & 0xff] ^ dk[k + 1])
+                t2 = (td0[s2 >> 24] ^ td1[(s1 >> 16) & 0xff] ^
+                      td2[(s0 >> 8) & 0xff] ^ td3[s3 & 0xff] ^ dk[k + 2])
+                t3 = (td0[s3 >> 24] ^ td1[(s2 >> 16) & 0xff] ^
+                      td2[(s1 >> 8) & 0xff] ^ td3[s0 & 0xff] ^ dk[k + 3])
+                s0, s1, s2, s3 = t0, t1, t2, t3
+                k += 4
+            p0 = ((si[s0 >> 24] << 24) | (si[(s3 >> 16) & 0xff] << 16) |
+                  (si[(s2 >> 8) & 0xff] << 8) | si[s1 & 0xff]) ^ dk[k]
+            p1 = ((si[s1 >> 24] << 24) | (si[(s0 >> 16) & 0xff] << 16) |
+                  (si[(s3 >> 8) & 0xff] << 8) | si[s2 & 0xff]) ^ dk[k + 1]
+            p2 = ((si[s2 >> 24] << 24) | (si[(s1 >> 16) & 0xff] << 16) |
+                  (si[(s0 >> 8) & 0xff] << 8) | si[s3 & 0xff]) ^ dk[k + 2]
+            p3 = ((si[s3 >> 24] << 24) | (si[(s2 >> 16) & 0xff] << 16) |
+                  (si[(s1 >> 8) & 0xff] << 8) | si[s0 & 0xff]) ^ dk[k + 3]
+            _AES_BLOCK.pack_into(
+                out, offset, p0 ^ v0, p1 ^ v1, p2 ^ v2, p3 ^ v3)
+            v0, v1, v2, v3 = c0, c1, c2, c3
+        return bytes(out)
+
+
+class CryptographyAES(object):
+    """AES in CBC mode, backed by the ``cryptography`` package."""
+
+    def __init__(self, key, iv):
+        from cryptography.hazmat.primitives.ciphers import (
+            Cipher, algorithms, modes
+        )
+        self._cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
+
+    def encrypt(self, data):
+        encryptor = self._cipher.encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+    def decrypt(self, data):
+        decryptor = self._cipher.decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+
+
+def _aes_backend(name):
+    if name == 'python':
+        return PythonAES
+    if name == 'cryptography':
+        return CryptographyAES
+    if name != 'auto':
+        raise ValueError('Unknown crypto backend: %s' % name)
+    try:
+        import cryptography  # noqa
+        return CryptographyAES
+    except ImportError:
+        log.warning(
+            'cryptography is not installed, falling back to the slow and '
+            'not constant-time PythonAES; install Flask-Weixin[crypto] or '
+            'set WEIXIN_CRYPTO_BACKEND to python'
+        )
+        return PythonAES
+
+
+class MessageCrypto(object):
+    """Encrypt and decrypt messages of the safe mode.
+
+    Messages are encrypted with AES-CBC, using the EncodingAESKey of the
+    account, and padded with PKCS#7 to 32 bytes blocks. The key material
+    and the cipher are prepared once, so an instance should be reused.
+
+    :param token: The token of the account.
+    :param aes_key: The 43 characters EncodingAESKey of the account.
+    :param appid: The appid of the account.
+    :param backend: ``python``, ``cryptography``, or ``auto`` to use the
+                    ``cryptography`` package if it is installed, with a
+                    warning when it falls back to ``python``.
+    """
+
+    block_size = 32
+
+    reply_template = (
+        '<xml>'
+        '<Encrypt><![CDATA[%(encrypt)s]]></Encrypt>'
+        '<MsgSignature><![CDATA[%(signature)s]]></MsgSignature>'
+        '<TimeStamp>%(timestamp)s</TimeStamp>'
+        '<Nonce><![CDATA[%(nonce)s]]></Nonce>'
+        '</xml>'
+    )
+
+    def __init__(self, token, aes_key, appid, backend='auto'):
+        key = base64.b64decode(_to_bytes(aes_key) + b'=')
+        if len(key) != 32:
+            raise ValueError('Invalid EncodingAESKey')
+        self.token = token
+        self.appid = _to_bytes(appid or b'')
+        self.cipher = _aes_backend(backend)(key, key[:16])
+
+    def signature(self, timestamp, nonce, encrypt):
+        return _signature(self.token, timestamp, nonce, encrypt)
+
+    def encrypt(self, text):
+        """Encrypt a text into the base64 string of weixin."""
+        text = _to_bytes(text)
+        size = 20 + len(text) + len(self.appid)
+        pad = self.block_size - size % self.block_size
+
+        buf = bytearray(os.urandom(16))
+        buf += struct.pack('>I', len(text))
+        buf += text
+        buf += self.appid
+        buf += bytes(bytearray([pad])) * pad
+        return base64.b64encode(self.cipher.encrypt(bytes(buf))).decode()
+
+    def decrypt(self, encrypt):
+        """Decrypt a base64 string of weixin into the message bytes."""
+        try:
+            data = base64.b64decode(_to_bytes(encrypt))
+            plain = self.cipher.decrypt(data)
+        except (TypeError, ValueError, binascii.Error):
+            raise ValueError('Invalid encrypted message')
+
+        pad = bytearray(plain[-1:])
+        if not pad or not 1 <= pad[0] <= self.block_size:
+            raise ValueError('Invalid padding')
+        end = len(plain) - pad[0]
+
+        if end < 20:
+            raise ValueError('Invalid encrypted message')
+        size, = struct.unpack_from('>I', plain, 16)
+        if 20 + size > end:
+            raise ValueError('Invalid encrypted message')
+        if self.appid and plain[20 + size:end] != self.appid:
+            raise ValueError('Invalid appid')
+        return plain[20:20 + size]
+
+    def wrap(self, reply, timestamp=None, nonce=None):
+        """Encrypt a reply into the xml of the safe mode."""
+        if timestamp is None:
+            timestamp = int(time.time())
+        if nonce is None:
+            nonce = binascii.hexlify(os.urandom(8)).decode()
+        encrypt = self.encrypt(reply)
+        return self.reply_template % {
+            'encrypt': encrypt,
+            'signature': self.signature(timestamp, nonce, encrypt),
+            'timestamp': timestamp,
+            'nonce': nonce,
+        }
+
+
+class ConnectionPool(object):
+    """A pool of keep-alive HTTP connections to a host.
+
+    :param base_url: The base url of the host, like ``https://host:port``.
+    :param maxsize: Max number of idle connections to keep.
+    :param timeout: Socket timeout in seconds.
+    """
+
+    #: methods which are safe to send again when no response came back
+    idempotent_methods = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, base_url, maxsize=10, timeout=10):
+        parsed = urlsplit(base_url)
+        if parsed.scheme == 'https':
+            self.connection_class = http_client.HTTPSConnection
+        else:
+            self.connection_class = http_client.HTTPConnection
+        self.host = parsed.netloc
+        self.prefix = parsed.path.rstrip('/')
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _get(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if not _is_dropped(conn):
+                return conn, True
+            conn.close()
+        conn = self.connection_class(self.host, timeout=self.timeout)
+        return conn, False
+
+    def _put(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, path, body=None, headers=None):
+        """Send a request, returns ``(status, headers, data)``."""
+        conn, resp = self.urlopen(method, path, body, headers)
+        try:
+            data = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        self.release(conn, resp)
+        return resp.status, resp.getheaders(), data
+
+    def urlopen(self, method, path, body=None, headers=None):
+        """Send a request, returns ``(connection, response)`` with the
+        body of the response unread, so it can be streamed. Hand the
+        connection back with :meth:`release` after reading it all, or
+        close it.
+
+        ``body`` can be an iterable of chunks with a ``Content-Length``
+        header; it is iterated again if the request is sent twice.
+
+        A request is only sent again over a new connection when a reused
+        one failed before the request was written whole, or when an
+        idempotent request got no response at all. Once a ``POST`` is
+        written it is never sent twice, so a read timeout is raised.
+        """
+        conn, reused = self._get()
+        try:
+            self._send(conn, method, path, body, headers)
+        except (http_client.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            # the idle connection was closed by the server, and a request
+            # that isn't written whole can't be handled, try again
+            conn, reused = self._new(method, path, body, headers)
+
+        try:
+            resp = conn.getresponse()
+        except (http_client.RemoteDisconnected, ConnectionResetError):
+            conn.close()
+            if not reused or method not in self.idempotent_methods:
+                raise
+            conn, _ = self._new(method, path, body, headers)
+            resp = self._getresponse(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn, resp
+
+    def release(self, conn, resp):
+        """Keep the connection of a fully read response alive."""
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put(conn)
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, self.prefix + path, body, headers or {})
+
+    def _new(self, method, path, body, headers):
+        conn = self.connection_class(self.host, timeout=self.timeout)
+        try:
+            self._send(conn, method, path, body, headers)
+        except Exception:
+            conn.close()
+            raise
+        return conn, False
+
+    def _getresponse(self, conn):
+        try:
+            return conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def _is_dropped(conn):
+    """Whether an idle connection was closed by the server. An idle
+    connection has nothing to read, unless it is at EOF.
+    """
+    sock = conn.sock
+    if sock is None:
+        return True
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (ValueError, socket.error):
+        return True
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(base_url, maxsize=10):
+    """Returns the shared :class:`ConnectionPool` of a base url."""
+    with _pools_lock:
+        pool = _pools.get(base_url)
+        if pool is None:
+            pool = ConnectionPool(base_url, maxsize)
+            _pools[base_url] = pool
+        return pool
+
+
+class _MultipartBody(object):
+    """The ``multipart/form-data`` body of a single file, iterated in
+    chunks of ``chunk_size`` straight from the file or buffer.
+    """
+
+    def __init__(self, source, name, filename, chunk_size):
+        self.boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.source = source
+        self.chunk_size = chunk_size
+
+        try:
+            # buffers like bytes or mmap, which are sent without copies
+            self.view = memoryview(source).cast('B')
+        except TypeError:
+            self.view = None
+
+        if self.view is not None:
+            self.offset = 0
+            self.size = self.view.nbytes
+        else:
+            self.offset = source.tell()
+            try:
+                size = os.fstat(source.fileno()).st_size
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                size = source.seek(0, os.SEEK_END)
+            self.size = size - self.offset
+
+        self.head = (
+            '--%s\r\n'
+            'Content-Disposition: form-data; name="%s"; filename="%s"; '
+            'filelength=%d\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'
+            % (self.boundary, name, filename, self.size)
+        ).encode('utf-8')
+        self.tail = ('\r\n--%s--\r\n' % self.boundary).encode('ascii')
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        size = self.chunk_size
+        view = self.view
+        if view is not None:
+            for i in range(0, len(view), size):
+                yield view[i:i + size]
+        else:
+            source = self.source
+            source.seek(self.offset)
+            while True:
+                chunk = source.read(size)
+                if not chunk:
+                    break
+                yield chunk
+        yield self.tail
+
+
+class MediaClient(object):
+    """Stream media files from and to the weixin API.
+
+    Downloads are written in chunks to a file, a file-like object or a
+    callable sink, and uploads are sent in chunks from a file or any
+    buffer like ``mmap``, so no file is read into memory at once. At most
+    ``concurrency`` transfers run at the same time, others wait::
+
+        media = weixin.media
+        media.download(message['media_id'], '/data/voice.amr')
+        media.download_url(message['picurl'], sink)
+        with open('cover.jpg', 'rb') as f:
+            media_id = media.upload(f, type='image')['media_id']
+
+    :param token_manager: A :class:`TokenManager` of the account.
+    :param base_url: The base url of the weixin API.
+    :param concurrency: Max number of transfers at the same time.
+    :param chunk_size: Bytes to read and write at a time.
+    """
+
+    #: ``errcode`` of invalid or expired access tokens
+    token_errors = (40001, 40014, 42001)
+
+    def __init__(self, token_manager, base_url=API_BASE_URL, concurrency=4,
+                 chunk_size=64 * 1024):
+        self.token_manager = token_manager
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        self.pool = get_pool(self.base_url, concurrency)
+
+    def download(self, media_id, dest):
+        """Download a temporary media, returns the number of bytes.
+
+        :param media_id: The ``media_id`` of a message.
+        :param dest: A file path, a file-like object or a callable
+                     receiving the chunks.
+        """
+        def read(conn, resp, sink):
+            return self._stream(self.pool, conn, resp, sink)
+
+        return self._download(dest, functools.partial(
+            self._call, 'GET', '/cgi-bin/media/get', {'media_id': media_id},
+            None, None, read))
+
+    def download_url(self, url, dest):
+        """Download a media url like the ``PicUrl`` of an image message,
+        returns the number of bytes.
+        """
+        parsed = urlsplit(url)
+        pool = get_pool('%s://%s' % (parsed.scheme, parsed.netloc),
+                        self.concurrency)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = '%s?%s' % (path, parsed.query)
+
+        def fetch(sink):
+            with self._semaphore:
+                conn, resp = pool.urlopen('GET', path)
+                return self._stream(pool, conn, resp, sink)
+
+        return self._download(dest, fetch)
+
+    def upload(self, source, type='image', filename=None):
+        """Upload a temporary media, returns the JSON response with the
+        ``media_id``.
+
+        :param source: A file path, a file object opened in binary mode,
+                       or a buffer like ``mmap`` or ``bytes``.
+        :param type: ``image``, ``voice``, ``video`` or ``thumb``.
+        :param filename: Name of the file, defaults to the name of a path
+                         or file object.
+        """
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                return self.upload(f, type, filename)
+
+        if filename is None:
+            filename = os.path.basename(getattr(source, 'name', None) or type)
+        body = _MultipartBody(source, 'media', filename, self.chunk_size)
+        headers = {
+            'Content-Type': body.content_type,
+            'Content-Length': str(len(body)),
+        }
+        return self._call('POST', '/cgi-bin/media/upload', {'type': type},
+                          body, headers, self._read_json)
+
+    def _download(self, dest, fetch):
+        if not isinstance(dest, str):
+            return fetch(getattr(dest, 'write', dest))
+
+        # write to a temporary file, so a failed download leaves nothing
+        tmp = dest + '.part'
+        try:
+            with open(tmp, 'wb') as f:
+                size = fetch(f.write)
+            os.rename(tmp, dest)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return size
+
+    def _call(self, method, path, query, body, headers, read, *args):
+        token_refreshed = False
+        while True:
+            query = dict(query, access_token=self.token_manager.get_token())
+            url = '%s?%s' % (path, urlencode(query))
+            with self._semaphore:
+                conn, resp = self.pool.urlopen(method, url, body, headers)
+                try:
+                    return read(conn, resp, *args)
+                except APIError as e:
+                    if e.errcode not in self.token_errors or token_refreshed:
+                        raise
+            self.token_manager.invalidate()
+            token_refreshed = True
+
+    def _read_json(self, conn, resp, pool=None):
+        try:
+            data = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        (pool or self.pool).release(conn, resp)
+        if resp.status >= 400:
+            raise http_client.HTTPException('HTTP %d' % resp.status)
+        rv = json.loads(data.decode('utf-8'))
+        if rv.get('errcode'):
+            raise APIError(rv['errcode'], rv.get('errmsg'))
+        return rv
+
+    def _stream(self, pool, conn, resp, sink):
+        content_type = resp.getheader('Content-Type', '')
+        if resp.status >= 400 or content_type.startswith(
+                ('application/json', 'text/plain')):
+            # an error of the weixin API instead of the media
+            self._read_json(conn, resp, pool)
+            raise APIError(-1, 'Unexpected response of %s' % content_type)
+
+        size = 0
+        chunk_size = self.chunk_size
+        try:
+            while True:
+                chunk = resp.read(chunk_size)
+                if not chunk:
+                    break
+                sink(chunk)
+                size += len(chunk)
+        except Exception:
+            conn.close()
+            raise
+        pool.release(conn, resp)
+        return size
+
+
+#: Child elements of the passive replies, as ``(xml tag, key)`` of the
+#: customer service message
+_REPLY_FIELDS = {
+    'Image': (('MediaId', 'media_id'),),
+    'Voice': (('MediaId', 'media_id'),),
+    'Video': (
+        ('MediaId', 'media_id'), ('Title', 'title'),
+        ('Description', 'description'),
+    ),
+    'Music': (
+        ('Title', 'title'), ('Description', 'description'),
+        ('MusicUrl', 'music_url'), ('HQMusicUrl', 'hq_music_url'),
+        ('ThumbMediaId', 'thumb_media_id'),
+    ),
+    'item': (
+        ('Title', 'title'), ('Description', 'description'),
+        ('PicUrl', 'picurl'), ('Url', 'url'),
+    ),
+}
+
+
+def _reply_message(reply):
+    """Turn a rendered passive reply into ``(openid, type, kwargs)`` of
+    :meth:`WeixinClient.message`.
+    """
+    try:
+        root = etree.fromstring(reply)
+    except SyntaxError as e:
+        raise ValueError(*e.args)
+
+    def fields(node):
+        return dict(
+            (key, node.findtext(tag))
+            for tag, key in _REPLY_FIELDS[node.tag]
+            if node.find(tag) is not None
+        )
+
+    type = root.findtext('MsgType')
+    kwargs = {}
+    if type == 'text':
+        kwargs['content'] = root.findtext('Content')
+    elif type == 'news':
+        kwargs['articles'] = [fields(o) for o in root.iter('item')]
+    elif type in ('image', 'voice', 'video', 'music'):
+        node = root.find(type.capitalize())
+        if node is not None:
+            kwargs = fields(node)
+    else:
+        raise ValueError('Reply of type %s can not be sent' % type)
+    return root.findtext('ToUserName'), type, kwargs
+
+
+class WeixinClient(object):
+    """Client of the weixin API for customer service and template messages.
+
+    Connections are kept alive in a pool shared by the clients of the same
+    ``base_url``. A request is retried with exponential backoff only when
+    it was never sent, like a refused connection, or when the API answers
+    a transient ``errcode``; after a read timeout the message may have
+    been delivered, so it is raised instead. An expired ``access_token``
+    is refreshed once::
+
+        client = WeixinClient(weixin.token_manager)
+        client.send(openid, content='hello')
+        client.send(openid, type='news', articles=[...])
+
+    Every method has an asyncio version prefixed by ``async_``, which runs
+    the request in the default executor of the event loop.
+
+    :param token_manager: A :class:`TokenManager` of the account.
+    :param base_url: The base url of the weixin API.
+    :param retries: Max times to retry a failed request.
+    :param backoff: Seconds to sleep before the first retry, doubled on
+                    every retry.
+    """
+
+    #: ``errcode`` of transient errors, like system busy
+    transient_errors = (-1, 45009)
+    #: ``errcode`` of invalid or expired access tokens
+    token_errors = (40001, 40014, 42001)
+
+    def __init__(self, token_manager, base_url=API_BASE_URL,
+                 retries=3, backoff=0.1):
+        self.token_manager = token_manager
+        self.base_url = base_url.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = get_pool(self.base_url)
+
+    def post(self, path, payload):
+        """Post a JSON payload to an API path, returns the JSON response."""
+        body = json.dumps(
+            payload, ensure_ascii=False, separators=(',', ':')
+        ).encode('utf-8')
+        headers = {'Content-Type': 'application/json; charset=utf-8'}
+
+        token_refreshed = False
+        attempt = 0
+        while True:
+            url = '%s?access_token=%s' % (
+                path, self.token_manager.get_token())
+            try:
+                status, _, data = self.pool.request('POST', url, body, headers)
+                try:
+                    rv = json.loads(data.decode('utf-8'))
+                except ValueError:
+                    raise http_client.HTTPException('HTTP %d' % status)
+                errcode = rv.get('errcode', 0)
+                if errcode in self.token_errors and not token_refreshed:
+                    self.token_manager.invalidate()
+                    token_refreshed = True
+                    continue
+                if errcode:
+                    raise APIError(errcode, rv.get('errmsg'))
+                if status >= 500:
+                    raise http_client.HTTPException('HTTP %d' % status)
+                return rv
+            except APIError as e:
+                if e.errcode not in self.transient_errors or \
+                        attempt >= self.retries:
+                    raise
+            except ConnectionRefusedError:
+                if attempt >= self.retries:
+                    raise
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    def message(self, openid, type='text', **kwargs):
+        """Build the payload of a customer service message.
+
+        It accepts the same parameters as :meth:`Weixin.reply`, the
+        ``video`` and ``music`` messages accept a ``thumb_media_id`` too.
+        """
+        if type == 'text':
+            body = {'content': kwargs.get('content', '')}
+        elif type in ('image', 'voice'):
+            body = {'media_id': kwargs.get('media_id', '')}
+        elif type == 'video':
+            body = dict(
+                (k, kwargs.get(k)) for k in
+                ('media_id', 'thumb_media_id', 'title', 'description')
+            )
+        elif type == 'music':
+            body = {
+                'title': kwargs.get('title'),
+                'description': kwargs.get('description'),
+                'musicurl': kwargs.get('music_url'),
+                'hqmusicurl': kwargs.get('hq_music_url'),
+                'thumb_media_id': kwargs.get('thumb_media_id'),
+            }
+        elif type == 'news':
+            body = {'articles': kwargs.get('articles', [])}
+        else:
+            raise ValueError('Unknown message type: %s' % type)
+        return {'touser': openid, 'msgtype': type, type: body}
+
+    def send(self, openid, type='text', **kwargs):
+        """Send a customer service message."""
+        payload = self.message(openid, type, **kwargs)
+        return self.post('/cgi-bin/message/custom/send', payload)
+
+    def send_reply(self, reply):
+        """Send a rendered passive reply, like the ``reply`` of a
+        :meth:`Weixin.late_reply` sink, as a customer service message to
+        its ``ToUserName``. Nothing is sent for an empty reply.
+        """
+        if not reply:
+            return None
+        openid, type, kwargs = _reply_message(reply)
+        return self.send(openid, type, **kwargs)
+
+    def send_template(self, openid, template_id, data, url=None):
+        """Send a template message.
+
+        :param data: A dict of template fields, each one is a dict of
+                     ``value`` and an optional ``color``.
+        """
+        payload = {'touser': openid, 'template_id': template_id, 'data': data}
+        if url:
+            payload['url'] = url
+        return self.post('/cgi-bin/message/template/send', payload)
+
+    async def _async(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(func, *args, **kwargs))
+
+    async def async_post(self, path, payload):
+        return await self._async(self.post, path, payload)
+
+    async def async_send(self, openid, type='text', **kwargs):
+        return await self._async(self.send, openid, type, **kwargs)
+
+    async def async_send_template(self, openid, template_id, data, url=None):
+        return await self._async(
+            self.send_template, openid, template_id, data, url)
@@ -34,9 +34,11 @@ setup(
     description='Weixin for Flask.',
     long_description=fread('README.rst'),
     license='BSD',
-    py_modules=['flask_weixin'],
+    py_modules=['flask_weixin', 'weixin_tools'],
     zip_safe=False,
     platforms='any',
+    python_requires='>=3.7',
+    extras_require={'crypto': ['cryptography']},
     tests_require=['nose', 'Flask'],
     test_suite='nose.collector',
     classifiers=[
@@ -46,6 +48,11 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
         'Topic :: Software Development :: Libraries :: Python Modules'
     ]
@@ -1,6 +1,11 @@
 # coding: utf-8
 
+import os
+import re
+import json
+
 from flask import Flask
+import flask_weixin
 from flask_weixin import Weixin
 from nose.tools import raises
 
@@ -446,3 +451,1750 @@ class TestKeyMatching(Base):
         rv = self.client.post(signature_url, data=data)
         assert rv.status_code == 200, rv.status_code
         assert b'@*' in rv.data
+
+
+class TestRuleIndex(Base):
+
+    def setup_weixin(self):
+        for i in range(500):
+            self.weixin.register(
+                type='event', event='CLICK', event_key='key_%d' % i,
+                func=lambda i=i, **kwargs: '@click:%d' % i,
+            )
+
+        @self.weixin.register(type='event', event='CLICK')
+        def any_click(**kwargs):
+            return '@click'
+
+        @self.weixin.register(type='event', event_key='key_3')
+        def shadowed(**kwargs):
+            return '@shadowed'
+
+        @self.weixin.register(type='event', event_key='other', ticket='T')
+        def with_ticket(**kwargs):
+            return '@ticket'
+
+    def test_event_key(self):
+        ret = {'type': 'event', 'event': 'CLICK', 'event_key': 'key_42'}
+        assert self.weixin.match(ret)() == '@click:42'
+
+    def test_first_registered_wins(self):
+        ret = {'type': 'event', 'event': 'CLICK', 'event_key': 'key_3'}
+        assert self.weixin.match(ret)() == '@click:3'
+
+        ret = {'type': 'event', 'event': 'CLICK', 'event_key': 'nope'}
+        assert self.weixin.match(ret)() == '@click'
+
+    def test_extra_limitation(self):
+        ret = {'type': 'event', 'event': 'VIEW', 'event_key': 'other'}
+        assert self.weixin.match(ret) == 'failed'
+
+        ret['ticket'] = 'T'
+        assert self.weixin.match(ret)() == '@ticket'
+
+    def test_register_rebuilds(self):
+        ret = {'type': 'link', 'title': 'hi'}
+        assert self.weixin.match(ret) == 'failed'
+        self.weixin.register(type='link', func=lambda **kwargs: '@link')
+        assert self.weixin.match(ret)() == '@link'
+
+
+class TestKeywordRouter(Base):
+
+    def setup_weixin(self):
+        for i in range(1000):
+            self.weixin.register(
+                'cmd%d' % i, match='prefix',
+                func=lambda i=i, **kwargs: '@cmd%d' % i,
+            )
+        self.weixin.register('cmd1', match='prefix',
+                             func=lambda **kwargs: '@short')
+        self.weixin.register('help', lambda **kwargs: '@help')
+        self.weixin.register('he', match='contains',
+                             func=lambda **kwargs: '@he')
+        self.weixin.register('she', match='contains',
+                             func=lambda **kwargs: '@she')
+        self.weixin.register('hers', match='contains',
+                             func=lambda **kwargs: '@hers')
+        self.weixin.register('*', lambda **kwargs: '@*')
+
+    def match(self, content):
+        return self.weixin.match({'type': 'text', 'content': content})()
+
+    def test_exact(self):
+        assert self.match('help') == '@help'
+
+    def test_longest_prefix(self):
+        assert self.match('cmd123 456') == '@cmd123'
+        assert self.match('cmd1') == '@short'
+        assert self.match('cmd1x') == '@short'
+        assert self.match('cm') == '@*'
+
+    def test_contains(self):
+        # "ushers" contains "she", "he" and "hers", "he" comes first
+        assert self.match('ushers') == '@he'
+        assert self.match('a shed') == '@he'
+        assert self.match('hers') == '@he'
+        assert self.match('nothing') == '@*'
+
+    def test_contains_last_wins(self):
+        self.weixin.register('he', match='contains',
+                             func=lambda **kwargs: '@he2')
+        assert self.match('ushers') == '@he2'
+        assert self.match('she') == '@he2'
+        assert self.match('hers') == '@he2'
+
+    def test_prefix_wins(self):
+        self.weixin.register('sh', match='prefix',
+                             func=lambda **kwargs: '@sh')
+        assert self.match('she') == '@sh'
+
+    def test_decorator(self):
+        @self.weixin(u'查询', match='prefix')
+        def query(**kwargs):
+            return '@query'
+
+        assert self.match(u'查询 123') == '@query'
+
+    @raises(ValueError)
+    def test_invalid_match(self):
+        self.weixin.register('x', lambda **kwargs: 'x', match='regex')
+
+
+class TestMultiAccount(Base):
+    text = TestReplyWeixin.__doc__
+
+    def setup_weixin(self):
+        self.app.add_url_rule(
+            '/a/<account>', view_func=self.weixin.view_func,
+            methods=['GET', 'POST'],
+        )
+        self.weixin.register('*', lambda **kwargs: '@default')
+        self.weixin.register('shared', lambda **kwargs: '@shared')
+
+        self.shop = self.weixin.add_account('shop', {
+            'WEIXIN_TOKEN': 'shop-token',
+            'WEIXIN_SENDER': 'gh_shop',
+        })
+        self.shop.register('hello', lambda **kwargs: '@shop')
+
+    def url(self, path, token):
+        import hashlib
+        values = [token, '1381389497', '1381909961']
+        signature = hashlib.sha1(''.join(sorted(values)).encode('utf-8'))
+        return '%s?signature=%s&timestamp=1381389497&nonce=1381909961' % (
+            path, signature.hexdigest())
+
+    def post(self, url, content, to_user='toUser'):
+        data = self.text.replace('toUser', to_user) % content
+        return self.client.post(url, data=data)
+
+    def test_by_url(self):
+        url = self.url('/a/shop', 'shop-token')
+        assert self.client.get(url).status_code == 200
+        assert b'@shop' in self.post(url, 'hello').data
+        assert b'@shared' in self.post(url, 'shared').data
+
+        rv = self.client.get(self.url('/a/shop', 'B0e8alq5ZmMjcnG5gwwLRPW2'))
+        assert rv.status_code == 400
+        rv = self.client.get(self.url('/a/nope', 'shop-token'))
+        assert rv.status_code == 404
+
+    def test_by_to_user_name(self):
+        url = self.url('/', 'shop-token')
+        rv = self.post(url, 'hello', to_user='gh_shop')
+        assert b'@shop' in rv.data
+
+        # unknown receivers are served by the default account
+        rv = self.post(signature_url, 'hello')
+        assert b'@default' in rv.data
+        rv = self.post(url, 'hello')
+        assert rv.status_code == 400
+
+    def test_config(self):
+        assert self.shop.token == 'shop-token'
+        assert self.shop.expires_in == 0
+        self.app.config['WEIXIN_EXPIRES_IN'] = 10
+        assert self.shop.expires_in == 10
+        assert self.shop.app.config is self.shop.app.config
+        assert self.weixin.get_account('shop') is self.shop
+        assert self.shop.executor is self.weixin.executor
+
+    def test_asgi(self):
+        weixin = Weixin({'WEIXIN_SENDER': 'sender'})
+        shop = weixin.add_account('shop', {
+            'WEIXIN_TOKEN': 'shop-token',
+            'WEIXIN_SENDER': 'gh_shop',
+        })
+        shop.register('hello', 'shop reply')
+
+        url = self.url('/', 'shop-token')
+        data = self.text.replace('toUser', 'gh_shop') % 'hello'
+        status, body = call_asgi(weixin.asgi_app, 'POST', url, data)
+        assert status == 200
+        assert b'shop reply' in body
+
+        status, body = call_asgi(weixin.asgi_app, 'GET', url)
+        assert status == 404
+
+
+class TestBodyLimit(Base):
+    text = '''
+    <xml>
+    <ToUserName><![CDATA[toUser]]></ToUserName>
+    <FromUserName><![CDATA[fromUser]]></FromUserName>
+    <CreateTime>1348831860</CreateTime>
+    <MsgType><![CDATA[text]]></MsgType>
+    <Content><![CDATA[%s]]></Content>
+    <MsgId>1234567890123456</MsgId>
+    </xml>
+    '''
+
+    def create_app(self):
+        app = Base.create_app(self)
+        app.config['WEIXIN_MAX_BODY_SIZE'] = 1024
+        app.config['WEIXIN_PARSER'] = 'iterparse'
+        return app
+
+    def setup_weixin(self):
+        self.weixin.register('*', lambda **kwargs: kwargs['content'])
+
+    def test_post_text(self):
+        rv = self.client.post(signature_url, data=self.text % 'hello')
+        assert rv.status_code == 200
+        assert rv.data == b'hello'
+
+    def test_too_large(self):
+        rv = self.client.post(signature_url, data=self.text % ('x' * 2048))
+        assert rv.status_code == 413
+
+    def test_stream_too_large(self):
+        from io import BytesIO
+        data = BytesIO((self.text % ('x' * 2048)).encode('utf-8'))
+        try:
+            self.weixin.parse_stream(data)
+        except flask_weixin.BodyTooLarge:
+            pass
+        else:
+            raise AssertionError('BodyTooLarge not raised')
+
+    def test_chunked_too_large(self):
+        from io import BytesIO
+        data = BytesIO((self.text % ('x' * 2048)).encode('utf-8'))
+        rv = self.client.post(
+            signature_url, input_stream=data,
+            environ_overrides={
+                'wsgi.input_terminated': True, 'CONTENT_LENGTH': '',
+            },
+        )
+        assert rv.status_code == 413
+
+    def test_doctype(self):
+        data = (
+            '<!DOCTYPE xml [<!ENTITY a "aaaaaaaaaa">]>'
+            '<xml><MsgType>text</MsgType><Content>&a;&a;</Content></xml>'
+        )
+        rv = self.client.post(signature_url, data=data)
+        assert rv.status_code == 400
+
+
+class TestLazyMessage(Base):
+    text = '''
+    <xml>
+    <ToUserName><![CDATA[toUser]]></ToUserName>
+    <FromUserName><![CDATA[fromUser]]></FromUserName>
+    <CreateTime>1351776360</CreateTime>
+    <MsgType><![CDATA[location]]></MsgType>
+    <Location_X>23.134521</Location_X>
+    <Location_Y>113.358803</Location_Y>
+    <Scale>20</Scale>
+    <Label><![CDATA[city-name]]></Label>
+    <MsgId>1234567890123456</MsgId>
+    </xml>
+    '''
+
+    def create_app(self):
+        app = Base.create_app(self)
+        app.config['WEIXIN_MESSAGE_MODE'] = 'lazy'
+        return app
+
+    def setup_weixin(self):
+        @self.weixin.register(type='location')
+        def location(sender, receiver, label, scale, time, **kwargs):
+            return '%s:%s:%d:%d' % (sender, label, scale, time.year)
+
+    def test_lazy_fields(self):
+        ret = self.weixin.parse(self.text)
+        assert dict.__len__(ret) == 5
+        assert ret['sender'] == 'fromUser'
+        assert ret.get('scale') == 20
+        assert ret['timestamp'] == 1351776360
+        assert 'missing' not in ret
+        expected = Weixin({'WEIXIN_TOKEN': 'x'}).parse(self.text)
+        assert ret == expected
+        assert sorted(ret.keys()) == sorted(expected.keys())
+
+    def test_handler(self):
+        rv = self.client.post(signature_url, data=self.text)
+        assert rv.data == b'fromUser:city-name:20:2012'
+
+    def test_message_handler(self):
+        messages = []
+
+        @self.weixin.register('hello', message=True)
+        def hello(message):
+            messages.append(message)
+            return '%s:%s' % (message['sender'], message['content'])
+
+        text = TestReplyWeixin.__doc__ % 'hello'
+        rv = self.client.post(signature_url, data=text)
+        assert b'fromUser:hello' in rv.data
+        assert dict.__len__(messages[0]) == 6
+        dedup = flask_weixin.MessageDedup(flask_weixin.MemoryCache())
+        assert dedup.key(messages[0]) == 'weixin:msg:1234567890123456'
+        assert dict.__len__(messages[0]) == 6
+
+    def test_attribute_rules(self):
+        messages = []
+
+        @self.weixin.register('*', message=True)
+        def reply_all(message):
+            messages.append(message)
+            return message['content']
+
+        text = TestReplyWeixin.__doc__ % 'other'
+        ret = self.weixin.parse(text)
+        assert self.weixin.match(ret) is not None
+        assert ret.get('event') is None
+        assert 'event_key' not in ret
+        assert not dict.__contains__(ret, 'time')
+
+        rv = self.client.post(signature_url, data=text)
+        assert b'other' in rv.data
+        assert dict.__len__(messages[0]) == 6
+
+    def test_overridden_format(self):
+        class MyWeixin(Weixin):
+            def format(self, kwargs):
+                rv = Weixin.format(self, kwargs)
+                rv['extra'] = 'x'
+                return rv
+
+        weixin = MyWeixin({
+            'WEIXIN_TOKEN': 'x', 'WEIXIN_MESSAGE_MODE': 'lazy',
+        })
+        ret = weixin.parse(self.text)
+        assert ret.get('extra') == 'x'
+        assert ret['label'] == 'city-name'
+
+
+class TestFastParser(TestReplyWeixin):
+    __doc__ = TestReplyWeixin.__doc__
+
+    def create_app(self):
+        app = Base.create_app(self)
+        app.config['WEIXIN_PARSER'] = 'fast'
+        return app
+
+    def test_same_as_etree(self):
+        from flask_weixin import _scan_xml, _parse_xml
+        bodies = [
+            self.__doc__ % 'hello',
+            (self.__doc__ % u'中文 > ]] text').encode('utf-8'),
+            '<xml><A><![CDATA[]]></A><B></B><C> </C><D>1</D></xml>',
+            # these fall back to etree
+            '<?xml version="1.0"?><xml><A>a</A></xml>',
+            '<xml><A>a &amp; b</A></xml>',
+            '<xml><A>a\r\nb</A></xml>',
+            '<xml><A x="1">a</A></xml>',
+            '<xml><A><B>b</B></A><C>c</C></xml>',
+            '<xml><A><![CDATA[a]]>b</A></xml>',
+            '<xml><Content><![CDATA[a]]]]><![CDATA[>b]]></Content>'
+            '</xml>',
+            '<xml><A><![CDATA[a]]]]><![CDATA[>b]]></A><B>c</B></xml>',
+            '<xml><A>a]b]]c</A></xml>',
+        ]
+        for body in bodies:
+            assert _scan_xml(body) == _parse_xml(body), body
+
+        # a ]]> in plain text is not well-formed
+        for body in ('<xml><A>a]]>b</A></xml>', '<xml><A>]]></A></xml>'):
+            for parse in (_scan_xml, _parse_xml):
+                try:
+                    parse(body)
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError('ValueError not raised: %s' % body)
+
+    @raises(ValueError)
+    def test_invalid(self):
+        self.weixin.parse('<xml><A>a</B></xml>')
+
+
+class TestCompiledReply(TestReplyWeixin):
+    __doc__ = TestReplyWeixin.__doc__
+
+    def create_app(self):
+        app = Base.create_app(self)
+        app.config['WEIXIN_COMPILED_REPLY'] = True
+        return app
+
+    def test_same_as_helpers(self):
+        from flask_weixin import ReplyRenderer
+        renderer = ReplyRenderer()
+        weixin = Weixin({'WEIXIN_TOKEN': 'x', 'WEIXIN_SENDER': 'me'})
+        articles = [
+            {'title': 'a', 'description': 'b', 'picurl': 'c', 'url': 'd'},
+            {'title': u'中文', 'description': 'f', 'picurl': 'g', 'url': 'h'},
+        ]
+        replies = [
+            {'content': u'你好'},
+            {'content': 'a]]>b]]>'},
+            {'type': 'music', 'title': 't', 'description': 'd',
+             'music_url': 'u', 'hq_music_url': 'hq'},
+            {'type': 'news', 'articles': articles},
+            {'type': 'customer_service'},
+            {'type': 'customer_service', 'service_account': 'kf@test'},
+            {'type': 'image', 'media_id': 'm'},
+            {'type': 'voice', 'media_id': 'm'},
+            {'type': 'video', 'media_id': 'm', 'title': 't'},
+        ]
+        for kwargs in replies:
+            for _ in range(2):
+                rv = renderer.render('user', sender='me', **kwargs)
+                expected = weixin.reply('user', **kwargs).encode('utf-8')
+                pattern = re.compile(br'<CreateTime>\d+</CreateTime>')
+                assert pattern.sub(b'', rv) == pattern.sub(b'', expected)
+
+
+    def test_header_eviction(self):
+        from flask_weixin import ReplyRenderer
+        renderer = ReplyRenderer(cache_size=2)
+        first = renderer.header('u1', 'me', 'text')
+        renderer.header('u2', 'me', 'text')
+        assert renderer.header('u1', 'me', 'text') is first
+        renderer.header('u3', 'me', 'text')
+        assert renderer.header('u1', 'me', 'text') is first
+        assert list(renderer._headers) == [
+            ('u3', 'me', 'text'), ('u1', 'me', 'text'),
+        ]
+
+
+class TestCdata(object):
+    def test_escape(self):
+        from flask_weixin import _cdata
+        assert _cdata('hello') == 'hello'
+        assert _cdata('a]]>b') == 'a]]]]><![CDATA[>b'
+        assert _cdata(b'a]]>b') == b'a]]]]><![CDATA[>b'
+        assert _cdata(None) is None
+
+    def test_round_trip(self):
+        from flask_weixin import _parse_xml, ReplyRenderer
+        weixin = Weixin({'WEIXIN_TOKEN': 'x', 'WEIXIN_SENDER': 'me]]>'})
+        content = u'<![CDATA[x]]> ]]>]]> 中文'
+        for rv in (weixin.reply('user', content=content),
+                   ReplyRenderer().render('user', 'text', 'me]]>',
+                                          content=content)):
+            raw = _parse_xml(rv)
+            assert raw['Content'] == content
+            assert raw['FromUserName'] == 'me]]>'
+
+        rv = weixin.reply('user', type='music', title='t]]>',
+                          description='d', music_url='u', hq_music_url='h')
+        assert '<Title><![CDATA[t]]]]><![CDATA[>]]></Title>' in rv
+
+    def test_customer_service(self):
+        from flask_weixin import _parse_xml
+        from flask_weixin import transfer_customer_service_reply
+        rv = transfer_customer_service_reply('user', 'me', 'kf@test')
+        assert '<KfAccount><![CDATA[kf@test]]></KfAccount>' in rv
+        assert _parse_xml(rv)['MsgType'] == 'transfer_customer_service'
+
+
+replay_weixin = Weixin({'WEIXIN_TOKEN': 'x', 'WEIXIN_SENDER': 'me'})
+replay_weixin.register('help', 'help text')
+
+
+@replay_weixin.register(type='event')
+def replay_event(**kwargs):
+    raise RuntimeError('broken handler')
+
+
+class TestReplay(object):
+    text = TestReplyWeixin.__doc__
+
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+        bodies = [self.text % 'help'] * 5 + [self.text % 'other'] * 2 + [
+            self.text.replace('text', 'event'), '<xml>broken',
+        ]
+        for i, body in enumerate(bodies):
+            name = 'sub' if i % 2 else ''
+            folder = os.path.join(self.path, name)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(os.path.join(folder, '%d.xml' % i), 'w') as f:
+                f.write(body)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def check(self, report):
+        assert report['messages'] == 9
+        assert report['errors'] == 2
+        rules = report['rules']
+        assert rules['help text']['count'] == 5
+        assert rules['failed']['count'] == 2
+        assert rules['replay_event']['errors'] == 1
+        assert rules['invalid']['errors'] == 1
+        assert rules['help text']['p99_ms'] >= rules['help text']['p50_ms']
+
+    def test_in_process(self):
+        from weixin_tools import replay
+        self.check(replay(replay_weixin, [self.path], processes=0))
+
+    def test_pool(self):
+        from weixin_tools import replay
+        self.check(replay('test_weixin:replay_weixin', [self.path], 2))
+
+    def test_command(self):
+        from weixin_tools import main
+        output = os.path.join(self.path, 'report.json')
+        main(['replay', 'test_weixin:replay_weixin', self.path,
+              '-j', '0', '-o', output])
+        self.check(json.load(open(output)))
+
+
+class TestNonceCache(Base):
+    def create_app(self):
+        from flask_weixin import MemoryCache
+        app = Base.create_app(self)
+        app.config['WEIXIN_NONCE_CACHE'] = MemoryCache(maxsize=2)
+        return app
+
+    def signed_url(self, nonce, age=0):
+        import time
+        timestamp = str(int(time.time()) - age)
+        signature = flask_weixin._signature(
+            self.weixin.token, timestamp, nonce)
+        return '/?signature=%s&echostr=1&timestamp=%s&nonce=%s' % (
+            signature, timestamp, nonce)
+
+    def test_replay(self):
+        url = self.signed_url('1')
+        rv = self.client.get(url)
+        assert rv.status_code == 200
+        rv = self.client.get(url)
+        assert rv.status_code == 400
+
+    def test_expired(self):
+        assert self.weixin.expires_in == 0
+        rv = self.client.get(signature_url)
+        assert rv.status_code == 400
+        rv = self.client.get(self.signed_url('1', age=290))
+        assert rv.status_code == 200
+
+    def test_evicted(self):
+        url = self.signed_url('1', age=10)
+        assert self.client.get(url).status_code == 200
+        assert self.client.get(self.signed_url('2')).status_code == 200
+        assert self.client.get(self.signed_url('3')).status_code == 200
+        # the nonce of the first request is evicted
+        assert self.client.get(url).status_code == 400
+
+    def test_invalid_signature_not_stored(self):
+        url = self.signed_url('1').replace('signature=', 'signature=0')
+        rv = self.client.get(url)
+        assert rv.status_code == 400
+        assert len(self.app.config['WEIXIN_NONCE_CACHE']) == 0
+
+
+class TestMemoryCache(object):
+    def test_lru(self):
+        from flask_weixin import MemoryCache
+        cache = MemoryCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert not cache.add('c', 4)
+        assert cache.get('c') == 3
+        assert cache.evicted_at > 0
+
+    def test_expires(self):
+        from flask_weixin import MemoryCache
+        cache = MemoryCache(default_timeout=-1)
+        cache.set('a', 1)
+        assert cache.get('a') is None
+        assert cache.add('a', 2, timeout=0)
+        assert cache.get('a') == 2
+        assert cache.delete('a')
+        assert not cache.has('a')
+
+
+def call_asgi(app, method, url, body=b'', linger=0):
+    import asyncio
+    path, _, query = url.partition('?')
+    scope = {
+        'type': 'http', 'method': method, 'path': path,
+        'query_string': query.encode('latin-1'),
+    }
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(app(scope, receive, send))
+        # let pending tasks finish, like a running server would
+        loop.run_until_complete(asyncio.sleep(linger))
+    finally:
+        loop.close()
+    return sent[0]['status'], sent[1]['body']
+
+
+class TestAsgi(object):
+    text = TestReplyWeixin.__doc__
+
+    def setUp(self):
+        self.weixin = Weixin({
+            'WEIXIN_TOKEN': 'B0e8alq5ZmMjcnG5gwwLRPW2',
+            'WEIXIN_SENDER': 'sender',
+        })
+
+        @self.weixin.register('async')
+        async def reply_async(sender, receiver, **kwargs):
+            return self.weixin.reply(sender, content='async reply')
+
+        @self.weixin.register('sync')
+        def reply_sync(sender, receiver, **kwargs):
+            return self.weixin.reply(sender, content='sync reply')
+
+        self.weixin.register('plain', 'plain reply')
+
+    def test_get(self):
+        status, body = call_asgi(self.weixin.asgi_app, 'GET', signature_url)
+        assert status == 200
+        assert body == b'5935258128547730623'
+
+        status, body = call_asgi(self.weixin.asgi_app, 'GET', '/')
+        assert status == 400
+
+    def test_handlers(self):
+        for key in ('async', 'sync', 'plain'):
+            status, body = call_asgi(
+                self.weixin.asgi_app, 'POST', signature_url, self.text % key)
+            assert status == 200
+            assert ('%s reply' % key).encode('utf-8') in body
+
+    def test_async_handler_in_view_func(self):
+        app = Flask(__name__)
+        app.config['WEIXIN_TOKEN'] = 'B0e8alq5ZmMjcnG5gwwLRPW2'
+        app.add_url_rule('/', view_func=self.weixin.view_func)
+        rv = app.test_client().post(signature_url, data=self.text % 'async')
+        assert b'async reply' in rv.data
+
+
+class TestDeadline(Base):
+    text = TestReplyWeixin.__doc__
+
+    def create_app(self):
+        app = Base.create_app(self)
+        app.config['WEIXIN_DEADLINE'] = 0.05
+        app.config['WEIXIN_SENDER'] = 'sender'
+        return app
+
+    def setup_weixin(self):
+        import threading
+        self.late = []
+        self.delivered = threading.Event()
+
+        @self.weixin.register('slow')
+        def slow(sender, **kwargs):
+            import time
+            time.sleep(0.2)
+            return self.weixin.reply(sender, content='slow reply')
+
+        @self.weixin.register('fast')
+        def fast(sender, **kwargs):
+            return self.weixin.reply(sender, content='fast reply')
+
+        @self.weixin.late_reply
+        def late_reply(message, reply):
+            self.late.append((message['content'], reply))
+            self.delivered.set()
+
+    def test_fast(self):
+        rv = self.client.post(signature_url, data=self.text % 'fast')
+        assert b'fast reply' in rv.data
+        assert not self.late
+
+    def test_slow(self):
+        rv = self.client.post(signature_url, data=self.text % 'slow')
+        assert rv.data == b'success'
+        assert self.delivered.wait(2)
+        content, reply = self.late[0]
+        assert content == 'slow'
+        assert 'slow reply' in reply
+
+    def test_slow_asgi(self):
+        status, body = call_asgi(
+            self.weixin.asgi_app, 'POST', signature_url, self.text % 'slow',
+            linger=0.5)
+        assert body == b'success'
+        assert self.delivered.wait(2)
+
+
+class TestMessageDedup(Base):
+    text = TestReplyWeixin.__doc__
+
+    def create_app(self):
+        from flask_weixin import MemoryCache
+        app = Base.create_app(self)
+        app.config['WEIXIN_MSG_CACHE'] = MemoryCache()
+        app.config['WEIXIN_SENDER'] = 'sender'
+        return app
+
+    def setup_weixin(self):
+        self.calls = []
+
+        @self.weixin.register('*')
+        def reply(sender, content, **kwargs):
+            import time
+            self.calls.append(content)
+            time.sleep(0.1)
+            return self.weixin.reply(sender, content='%s reply' % content)
+
+    def test_retry(self):
+        rv = self.client.post(signature_url, data=self.text % 'hello')
+        assert b'hello reply' in rv.data
+        retry = self.client.post(signature_url, data=self.text % 'hello')
+        assert retry.data == rv.data
+        assert self.calls == ['hello']
+
+    def test_concurrent_retry(self):
+        import threading
+        results = []
+
+        def post():
+            client = self.app.test_client()
+            rv = client.post(signature_url, data=self.text % 'hello')
+            results.append(rv.data)
+
+        threads = [threading.Thread(target=post) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert self.calls == ['hello']
+        assert len(results) == 3
+        assert len(set(results)) == 1
+        assert b'hello reply' in results[0]
+
+    def test_event_key(self):
+        dedup = self.weixin.dedup
+        key = dedup.key({'sender': 'user', 'timestamp': 1348831860})
+        assert key == 'weixin:msg:user:1348831860'
+        assert dedup.key({'id': '123'}) == 'weixin:msg:123'
+
+    def test_asgi_retry(self):
+        app = self.weixin.asgi_app
+        _, body = call_asgi(app, 'POST', signature_url, self.text % 'hi')
+        _, retry = call_asgi(app, 'POST', signature_url, self.text % 'hi')
+        assert b'hi reply' in body
+        assert retry == body
+        assert self.calls == ['hi']
+
+
+class TestSafeMode(Base):
+    aes_key = 'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG'
+    text = TestReplyWeixin.__doc__
+
+    def create_app(self):
+        app = Base.create_app(self)
+        app.config['WEIXIN_AES_KEY'] = self.aes_key
+        app.config['WEIXIN_APPID'] = 'wx1234567890'
+        app.config['WEIXIN_CRYPTO_BACKEND'] = 'python'
+        return app
+
+    def setup_weixin(self):
+        @self.weixin.register('*')
+        def reply(sender, receiver, content, **kwargs):
+            return self.weixin.reply(
+                sender, sender=receiver, content='%s reply' % content)
+
+    def encrypted_request(self, content):
+        crypto = self.weixin.crypto
+        encrypt = crypto.encrypt(self.text % content)
+        msg_signature = crypto.signature('1381389497', '1381909961', encrypt)
+        url = '%s&encrypt_type=aes&msg_signature=%s' % (
+            signature_url, msg_signature)
+        data = (
+            '<xml><ToUserName><![CDATA[toUser]]></ToUserName>'
+            '<Encrypt><![CDATA[%s]]></Encrypt></xml>'
+        ) % encrypt
+        return url, data
+
+    def test_crypto(self):
+        from flask_weixin import MessageCrypto
+        crypto = self.weixin.crypto
+        encrypt = crypto.encrypt(u'中文 message')
+        assert crypto.decrypt(encrypt) == u'中文 message'.encode('utf-8')
+
+        other = MessageCrypto('token', self.aes_key, 'wx1234567890', 'auto')
+        assert other.decrypt(encrypt) == u'中文 message'.encode('utf-8')
+
+        other = MessageCrypto('token', self.aes_key, 'wx0000000000')
+        try:
+            other.decrypt(encrypt)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ValueError not raised')
+
+    def test_auto_backend(self):
+        import sys
+        import logging
+        from flask_weixin import _aes_backend, PythonAES
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        log = logging.getLogger('flask_weixin')
+        log.addHandler(handler)
+        saved = sys.modules.get('cryptography')
+        sys.modules['cryptography'] = None
+        try:
+            assert _aes_backend('auto') is PythonAES
+            assert _aes_backend('python') is PythonAES
+        finally:
+            if saved is None:
+                del sys.modules['cryptography']
+            else:
+                sys.modules['cryptography'] = saved
+            log.removeHandler(handler)
+        assert len(records) == 1
+        assert 'PythonAES' in records[0].getMessage()
+
+    def test_encrypted_message(self):
+        url, data = self.encrypted_request('hello')
+        rv = self.client.post(url, data=data)
+        assert rv.status_code == 200
+
+        reply = flask_weixin._parse_xml(rv.data)
+        crypto = self.weixin.crypto
+        signature = crypto.signature(
+            reply['TimeStamp'], reply['Nonce'], reply['Encrypt'])
+        assert signature == reply['MsgSignature']
+        assert b'hello reply' in crypto.decrypt(reply['Encrypt'])
+
+    def test_invalid_msg_signature(self):
+        url, data = self.encrypted_request('hello')
+        url = url.replace('msg_signature=', 'msg_signature=0')
+        rv = self.client.post(url, data=data)
+        assert rv.status_code == 400
+
+    def test_validate(self):
+        weixin = self.weixin
+        encrypt = weixin.crypto.encrypt('hello')
+        msg_signature = weixin.crypto.signature(
+            '1381389497', '1381909961', encrypt)
+        signature = '16f39f0c528790d3a448a8a7a65cc81ceddd82bb'
+        assert weixin.validate(
+            signature, '1381389497', '1381909961', msg_signature, encrypt)
+        assert not weixin.validate(
+            signature, '1381389497', '1381909961', msg_signature, 'x')
+
+
+class TestTokenManager(object):
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def fetch(self, appid, secret):
+        import time
+        self.calls.append((appid, secret))
+        time.sleep(0.1)
+        return 'token-%d' % len(self.calls), 7200
+
+    def test_single_flight(self):
+        import threading
+        from flask_weixin import TokenManager, FileCache
+
+        # every manager is like a worker process, sharing the file cache
+        managers = [
+            TokenManager('appid', 'secret', FileCache(self.path), self.fetch)
+            for _ in range(4)
+        ]
+        tokens = []
+
+        def get_token(manager):
+            tokens.append(manager.get_token())
+
+        threads = [
+            threading.Thread(target=get_token, args=(m,))
+            for m in managers for _ in range(3)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert self.calls == [('appid', 'secret')]
+        assert tokens == ['token-1'] * 12
+
+    def test_refresh_ahead(self):
+        from flask_weixin import TokenManager
+        manager = TokenManager(
+            'appid', 'secret', fetch=self.fetch, refresh_ahead=7200)
+        assert manager.get_token() == 'token-1'
+        assert manager.get_token() == 'token-2'
+        manager.refresh_ahead = 0
+        assert manager.get_token() == 'token-2'
+        manager.invalidate()
+        assert manager.get_token() == 'token-3'
+
+    def test_file_cache(self):
+        from flask_weixin import FileCache
+        cache = FileCache(self.path)
+        assert cache.get('a') is None
+        assert cache.add('a', {'b': 1})
+        assert not cache.add('a', 2)
+        assert cache.get('a') == {'b': 1}
+        cache.set('a', 3, timeout=-1)
+        assert not cache.has('a')
+        assert cache.add('a', 4)
+        assert cache.delete('a')
+        assert not cache.delete('a')
+
+
+class StubServer(object):
+    """A local stand-in of the weixin API server."""
+
+    def __init__(self, handle):
+        import threading
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.respond()
+
+            def do_POST(self):
+                self.respond()
+
+            def respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                rv = handle(self.command, self.path, body)
+                status, data = rv[:2]
+                stub.clients.add(self.client_address)
+                self.send_response(status)
+                for key, value in (rv[2] if len(rv) > 2 else {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                if stub.drop:
+                    # close the keep-alive connection without telling
+                    self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        stub = self
+        self.drop = False
+        self.clients = set()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestAccessToken(Base):
+    def create_app(self):
+        app = Base.create_app(self)
+        app.config['WEIXIN_APPID'] = 'wx1234567890'
+        app.config['WEIXIN_APP_SECRET'] = 'secret'
+        return app
+
+    def setUp(self):
+        self.requests = []
+
+        def handle(method, path, body):
+            self.requests.append(path)
+            return 200, b'{"access_token": "TOKEN", "expires_in": 7200}'
+
+        self.server = StubServer(handle)
+        Base.setUp(self)
+        self.app.config['WEIXIN_API_BASE_URL'] = self.server.url
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_access_token(self):
+        assert self.weixin.access_token == 'TOKEN'
+        assert self.weixin.access_token == 'TOKEN'
+        assert len(self.requests) == 1
+        assert 'appid=wx1234567890' in self.requests[0]
+
+
+class TestWeixinClient(Base):
+    def create_app(self):
+        app = Base.create_app(self)
+        app.config['WEIXIN_APPID'] = 'wx1234567890'
+        app.config['WEIXIN_APP_SECRET'] = 'secret'
+        return app
+
+    def setUp(self):
+        import json
+        import time
+        self.sent = []
+        self.errors = []
+        self.tokens = []
+        self.delay = 0
+
+        def handle(method, path, body):
+            if path.startswith('/cgi-bin/token'):
+                self.tokens.append(path)
+                data = {'access_token': 'T%d' % len(self.tokens),
+                        'expires_in': 7200}
+                return 200, json.dumps(data).encode('utf-8')
+            if self.errors:
+                status, errcode = self.errors.pop(0)
+                data = {'errcode': errcode, 'errmsg': 'error'}
+                return status, json.dumps(data).encode('utf-8')
+            time.sleep(self.delay)
+            self.sent.append((path, json.loads(body.decode('utf-8'))))
+            return 200, b'{"errcode": 0, "errmsg": "ok"}'
+
+        self.server = StubServer(handle)
+        Base.setUp(self)
+        self.app.config['WEIXIN_API_BASE_URL'] = self.server.url
+        self.client = self.weixin.client
+        self.client.backoff = 0
+
+    def tearDown(self):
+        self.client.pool.close()
+        self.server.close()
+
+    def test_send(self):
+        self.client.send('openid', content=u'你好')
+        self.client.send('openid', type='news', articles=[{'title': 'a'}])
+        path, payload = self.sent[0]
+        assert path == '/cgi-bin/message/custom/send?access_token=T1'
+        assert payload == {
+            'touser': 'openid', 'msgtype': 'text',
+            'text': {'content': u'你好'},
+        }
+        assert self.sent[1][1]['news'] == {'articles': [{'title': 'a'}]}
+
+        # one connection for the token, one kept alive for the messages
+        assert len(self.server.clients) == 2
+
+    def test_send_template(self):
+        data = {'first': {'value': 'hello', 'color': '#173177'}}
+        self.client.send_template('openid', 'tid', data, url='http://a')
+        path, payload = self.sent[0]
+        assert path.startswith('/cgi-bin/message/template/send')
+        assert payload['template_id'] == 'tid'
+        assert payload['data'] == data
+
+    def test_retry(self):
+        self.errors = [(503, -1), (200, -1), (200, 42001)]
+        self.client.send('openid', content='hello')
+        assert len(self.sent) == 1
+        assert self.sent[0][0].endswith('access_token=T2')
+
+    def test_send_reply(self):
+        from flask_weixin import ReplyRenderer
+        weixin = Weixin({'WEIXIN_TOKEN': 'x', 'WEIXIN_SENDER': 'me'})
+        articles = [{'title': 'a]]>', 'description': 'b',
+                     'picurl': 'c', 'url': 'd'}]
+        self.client.send_reply(weixin.reply('u1', content=u'你好'))
+        self.client.send_reply(ReplyRenderer().render(
+            'u2', sender='me', type='news', articles=articles))
+        self.client.send_reply(weixin.reply(
+            'u3', type='music', title='t', description='d',
+            music_url='m', hq_music_url='hq'))
+        self.client.send_reply(weixin.reply(
+            'u4', type='image', media_id='m1'))
+        assert self.client.send_reply('') is None
+
+        payloads = [payload for _, payload in self.sent]
+        assert payloads[0] == {
+            'touser': 'u1', 'msgtype': 'text', 'text': {'content': u'你好'},
+        }
+        assert payloads[1]['touser'] == 'u2'
+        assert payloads[1]['news'] == {'articles': articles}
+        assert payloads[2]['music'] == {
+            'title': 't', 'description': 'd', 'musicurl': 'm',
+            'hqmusicurl': 'hq', 'thumb_media_id': None,
+        }
+        assert payloads[3]['image'] == {'media_id': 'm1'}
+
+        reply = weixin.reply('u5', type='customer_service')
+        try:
+            self.client.send_reply(reply)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ValueError not raised')
+        assert len(self.sent) == 4
+
+    def test_no_retry_after_sent(self):
+        import time
+        import socket
+        self.errors = [(503, 0)]
+        try:
+            self.client.send('openid', content='hello')
+        except flask_weixin.http_client.HTTPException:
+            pass
+        else:
+            raise AssertionError('HTTPException not raised')
+
+        self.client.pool.timeout = 0.2
+        self.client.pool.close()
+        self.delay = 0.5
+        try:
+            self.client.send('openid', content='hello')
+        except socket.timeout:
+            pass
+        else:
+            raise AssertionError('socket.timeout not raised')
+        time.sleep(0.6)
+        assert len(self.sent) == 1
+
+    def test_stale_connection(self):
+        self.server.drop = True
+        self.client.send('openid', content='hello')
+        self.client.send('openid', content='hello')
+        assert len(self.sent) == 2
+        assert len(self.server.clients) == 3
+
+    def test_connection_refused(self):
+        import socket
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        client = flask_weixin.WeixinClient(
+            self.weixin.token_manager, 'http://127.0.0.1:%d' % port,
+            retries=2, backoff=0)
+        calls = []
+        connect = client.pool.connection_class.connect
+
+        def refused(conn):
+            calls.append(conn)
+            connect(conn)
+
+        client.pool.connection_class = type(
+            'Connection', (client.pool.connection_class,),
+            {'connect': refused})
+        try:
+            client.send('openid', content='hello')
+        except ConnectionRefusedError:
+            pass
+        else:
+            raise AssertionError('ConnectionRefusedError not raised')
+        assert len(calls) == 3
+
+    def test_error(self):
+        from flask_weixin import APIError
+        self.errors = [(200, 40003)]
+        try:
+            self.client.send('openid', content='hello')
+        except APIError as e:
+            assert e.errcode == 40003
+        else:
+            raise AssertionError('APIError not raised')
+
+    def test_async_send(self):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            rv = loop.run_until_complete(
+                self.client.async_send('openid', content='hello'))
+        finally:
+            loop.close()
+        assert rv['errmsg'] == 'ok'
+        assert self.sent[0][1]['text'] == {'content': 'hello'}
+
+
+class TestTiming(Base):
+    text = TestReplyWeixin.__doc__
+
+    def setup_weixin(self):
+        from flask_weixin import TimingHistogram
+        self.timings = []
+        self.histogram = self.weixin.on_timing(TimingHistogram())
+
+        @self.weixin.on_timing
+        def collect(timings, message_type, rule):
+            self.timings.append((timings, message_type, rule))
+
+        @self.weixin.register('hello')
+        def hello(sender, receiver, **kwargs):
+            return self.weixin.reply(sender, sender=receiver, content='hi')
+
+    def test_phases(self):
+        self.client.post(signature_url, data=self.text % 'hello')
+        timings, message_type, rule = self.timings[0]
+        assert message_type == 'text'
+        assert rule.__name__ == 'hello'
+        phases = ('validate', 'parse', 'match', 'handler', 'render')
+        assert sorted(timings) == sorted(phases)
+
+        self.client.post(signature_url, data=self.text % 'other')
+        timings, _, rule = self.timings[1]
+        assert rule == 'failed'
+        assert 'handler' not in timings
+
+    def test_histogram(self):
+        for _ in range(3):
+            self.client.post(signature_url, data=self.text % 'hello')
+        p99 = self.histogram.percentile('handler', 99, rule='hello')
+        assert 0 < p99 < 1
+        stats = [
+            item for item in self.histogram.snapshot()
+            if item['phase'] == 'parse'
+        ]
+        assert stats[0]['count'] == 3
+        assert stats[0]['type'] == 'text'
+
+    def test_asgi(self):
+        call_asgi(self.weixin.asgi_app, 'POST', signature_url,
+                  self.text % 'hello')
+        timings, message_type, rule = self.timings[0]
+        assert 'handler' in timings
+        assert rule.__name__ == 'hello'
+
+
+class TestTypedMessage(Base):
+    messages = [
+        TestSimpleWeixin.test_post_text.__doc__,
+        TestSimpleWeixin.test_post_image.__doc__,
+        TestSimpleWeixin.test_post_location.__doc__,
+        TestSimpleWeixin.test_post_link.__doc__,
+        TestSimpleWeixin.test_post_event.__doc__,
+        TestSimpleWeixin.test_post_voice.__doc__,
+        TestSimpleWeixin.test_post_no_type.__doc__,
+    ]
+
+    def create_app(self):
+        app = Base.create_app(self)
+        app.config['WEIXIN_MESSAGE_MODE'] = 'typed'
+        return app
+
+    def setup_weixin(self):
+        @self.weixin.register(type='location')
+        def location(sender, label, scale, time, **kwargs):
+            return '%s:%s:%d:%d' % (sender, label, scale, time.year)
+
+    def test_same_as_dict(self):
+        import pickle
+        weixin = Weixin({'WEIXIN_TOKEN': 'x'})
+        for text in self.messages:
+            message = self.weixin.parse(text)
+            expected = weixin.parse(text)
+            assert not hasattr(message, '__dict__')
+            assert message == expected, message
+            assert sorted(message.keys()) == sorted(expected.keys())
+            assert dict(**message) == expected
+            assert pickle.loads(pickle.dumps(message)) == expected
+
+    def test_classes(self):
+        from flask_weixin import EventMessage, UnknownMessage
+        message = self.weixin.parse(self.messages[4])
+        assert isinstance(message, EventMessage)
+        assert message.event == message['event'] == 'subscribe'
+        assert message.get('content') is None
+        assert 'content' not in message
+        message = self.weixin.parse(self.messages[-1])
+        assert isinstance(message, UnknownMessage)
+
+    def test_handler(self):
+        rv = self.client.post(signature_url, data=self.messages[2])
+        assert rv.data == b'fromUser:location:20:2012'
+
+
+class TestMessageSchema(object):
+    def setUp(self):
+        self.weixin = Weixin({'WEIXIN_TOKEN': 'x'})
+
+    def test_fields(self):
+        ret = self.weixin.parse(TestSimpleWeixin.test_post_voice.__doc__)
+        assert ret['media_id'] == 'media_id'
+        ret = self.weixin.parse(TestSimpleWeixin.test_post_link.__doc__)
+        assert ret['url'] == 'url'
+
+    def test_video(self):
+        from flask_weixin import VideoMessage
+        text = '''
+        <xml>
+        <ToUserName><![CDATA[toUser]]></ToUserName>
+        <FromUserName><![CDATA[fromUser]]></FromUserName>
+        <CreateTime>1357290913</CreateTime>
+        <MsgType><![CDATA[shortvideo]]></MsgType>
+        <MediaId><![CDATA[media_id]]></MediaId>
+        <ThumbMediaId><![CDATA[thumb_media_id]]></ThumbMediaId>
+        <MsgId>1234567890123456</MsgId>
+        </xml>
+        '''
+        ret = self.weixin.parse(text)
+        assert ret['thumb_media_id'] == 'thumb_media_id'
+        text = text.replace('shortvideo', 'video')
+        weixin = Weixin({'WEIXIN_TOKEN': 'x', 'WEIXIN_MESSAGE_MODE': 'typed'})
+        message = weixin.parse(text)
+        assert isinstance(message, VideoMessage)
+        assert message == self.weixin.parse(text)
+
+    def test_override_parser(self):
+        class MyWeixin(Weixin):
+            def parse_text(self, raw):
+                return {'content': raw.get('Content').upper()}
+
+        weixin = MyWeixin({'WEIXIN_TOKEN': 'x'})
+        ret = weixin.parse(TestSimpleWeixin.test_post_text.__doc__)
+        assert ret['content'] == 'THIS IS A TEST'
+
+
+class TestLoad(Base):
+    def create_app(self):
+        from flask_weixin import MemoryCache
+        app = Base.create_app(self)
+        app.config['WEIXIN_NONCE_CACHE'] = MemoryCache()
+        app.config['WEIXIN_MSG_CACHE'] = MemoryCache()
+        return app
+
+    def setup_weixin(self):
+        self.weixin.register('*', lambda **kwargs: 'hello')
+        self.weixin.register(type='event', func=lambda **kwargs: 'event')
+
+    def test_sample_message(self):
+        from weixin_tools import sample_message
+        for msg_type in flask_weixin.MESSAGE_SCHEMA:
+            ret = self.weixin.parse(sample_message(msg_type, sender='u'))
+            assert ret['type'] == msg_type
+            assert ret['sender'] == 'u'
+
+        body = sample_message('event', Event='subscribe', Ticket='t')
+        ret = self.weixin.parse(body)
+        assert ret['event'] == 'subscribe'
+        assert ret['ticket'] == 't'
+
+    def test_wsgi(self):
+        from weixin_tools import load
+        report = load(self.app, mix={'text': 3, 'event': 1}, requests=200,
+                      concurrency=4, seed=1)
+        assert report['count'] == 200
+        assert report['statuses'] == {'200': 200}
+        assert set(report['types']) == set(['text', 'event'])
+        assert report['p99_ms'] >= report['p50_ms'] > 0
+
+    def test_rate(self):
+        from weixin_tools import load
+        report = load(self.app, rate=200, duration=0.2, concurrency=2)
+        assert 20 <= report['count'] <= 41
+        assert report['errors'] == 0
+
+    def test_http(self):
+        from weixin_tools import load
+        from urllib.parse import urlsplit, parse_qsl
+        paths = []
+
+        def handle(method, path, body):
+            url = urlsplit(path)
+            args = dict(parse_qsl(url.query))
+            paths.append(url.path)
+            ok = self.weixin.validate(
+                args['signature'], args['timestamp'], args['nonce'])
+            return (200, b'ok') if ok else (400, b'failed')
+
+        stub = StubServer(handle)
+        try:
+            report = load(stub.url + '/weixin', token=self.weixin.token,
+                          requests=50, concurrency=4)
+        finally:
+            stub.close()
+        assert report['statuses'] == {'200': 50}
+        assert set(paths) == set(['/weixin'])
+
+
+class TestSession(Base):
+    text = TestReplyWeixin.__doc__
+
+    def create_app(self):
+        from flask_weixin import MemoryCache
+
+        class CountingCache(MemoryCache):
+            calls = []
+
+            def get(self, key):
+                self.calls.append(('get', key))
+                return MemoryCache.get(self, key)
+
+            def set(self, key, value, timeout=None):
+                self.calls.append(('set', key))
+                return MemoryCache.set(self, key, value, timeout)
+
+        self.cache = CountingCache()
+        app = Base.create_app(self)
+        app.config['WEIXIN_SESSION_CACHE'] = self.cache
+        return app
+
+    def setup_weixin(self):
+        @self.weixin.register('next')
+        def next_step(session, **kwargs):
+            session['step'] = session.get('step', 0) + 1
+            return 'step %d' % session['step']
+
+        @self.weixin.register('peek')
+        def peek(session, **kwargs):
+            return 'step %d' % session.get('step', 0)
+
+        @self.weixin.register('reset')
+        def reset(session, **kwargs):
+            session.clear()
+            return 'reset'
+
+        self.weixin.register('*', lambda **kwargs: 'nothing')
+
+    def post(self, content, sender='fromUser'):
+        data = self.text.replace('fromUser', sender) % content
+        return self.client.post(signature_url, data=data).data
+
+    def test_steps(self):
+        assert b'step 1' in self.post('next')
+        assert b'step 2' in self.post('next')
+        assert b'step 1' in self.post('next', sender='other')
+        assert b'step 2' in self.post('peek')
+        assert b'reset' in self.post('reset')
+        assert b'step 0' in self.post('peek')
+
+    def test_lazy_and_unchanged(self):
+        del self.cache.calls[:]
+        self.post('other')
+        assert self.cache.calls == []
+
+        self.post('peek')
+        assert [c[0] for c in self.cache.calls] == ['get']
+
+        self.post('next')
+        assert [c[0] for c in self.cache.calls] == ['get', 'get', 'set']
+
+    def test_dispatch(self):
+        ret = self.weixin.parse(self.text % 'next')
+        assert self.weixin.dispatch(ret)[1] == 'step 1'
+        assert self.weixin.dispatch(ret)[1] == 'step 2'
+
+    def test_asgi(self):
+        weixin = Weixin({
+            'WEIXIN_TOKEN': 'B0e8alq5ZmMjcnG5gwwLRPW2',
+            'WEIXIN_SESSION_CACHE': self.cache,
+        })
+
+        @weixin.register('next')
+        async def next_step(session, **kwargs):
+            session['step'] = session.get('step', 0) + 1
+            return 'step %d' % session['step']
+
+        for i in (1, 2):
+            status, body = call_asgi(
+                weixin.asgi_app, 'POST', signature_url, self.text % 'next')
+            assert ('step %d' % i).encode('utf-8') in body
+
+
+class TestMemoizedReply(Base):
+    text = TestReplyWeixin.__doc__
+
+    def setup_weixin(self):
+        self.calls = []
+
+        @self.weixin.register('news', cache=True)
+        def news(sender, receiver, **kwargs):
+            self.calls.append(sender)
+            return self.weixin.reply(
+                sender, type='news', sender=receiver,
+                articles=[{'title': 'a]]>', 'description': 'b',
+                           'picurl': 'c', 'url': 'd'}],
+            )
+
+        self.weixin.register('help', 'help text', cache=True)
+
+        @self.weixin.register('empty', cache=True)
+        def empty(**kwargs):
+            self.calls.append('empty')
+            return ''
+
+    def post(self, content, sender='fromUser'):
+        data = self.text.replace('fromUser', sender) % content
+        return self.client.post(signature_url, data=data).data
+
+    def test_restamp(self):
+        from flask_weixin import _parse_xml
+        first = self.post('news')
+        rv = self.post('news', sender='other]]]]><![CDATA[>')
+        assert self.calls == ['fromUser']
+        raw = _parse_xml(rv)
+        assert raw['ToUserName'] == 'other]]>'
+        assert raw['FromUserName'] == 'toUser'
+        assert raw['MsgType'] == 'news'
+        pattern = re.compile(br'<CreateTime>\d+</CreateTime>')
+        assert pattern.sub(b'', rv).replace(
+            b'other]]]]><![CDATA[>', b'fromUser') == pattern.sub(b'', first)
+
+        rv = self.post('help', sender='u1')
+        rv = self.post('help', sender='u2')
+        assert _parse_xml(rv)['Content'] == 'help text'
+        assert _parse_xml(rv)['ToUserName'] == 'u2'
+
+    def test_not_cached(self):
+        self.post('empty')
+        self.post('empty')
+        assert self.calls == ['empty', 'empty']
+
+    def test_bytes(self):
+        rule = self.weixin._registry['help']
+        message = {'sender': 'u', 'receiver': 'toUser'}
+        assert isinstance(rule(message), bytes)
+        assert isinstance(rule(message), bytes)
+
+    def test_async_on_server_loop(self):
+        import asyncio
+        loops = []
+
+        @self.weixin.register('async', cache=True)
+        async def reply_async(sender, receiver, **kwargs):
+            loops.append(asyncio.get_event_loop())
+            return self.weixin.reply(sender, sender=receiver, content='hi')
+
+        async def app(scope, receive, send):
+            loops.append(asyncio.get_event_loop())
+            await self.weixin.asgi_app(scope, receive, send)
+
+        data = self.text % 'async'
+        status, body = call_asgi(app, 'POST', signature_url, data)
+        assert status == 200
+        assert b'hi' in body
+        assert loops[0] is loops[1]
+        status, cached = call_asgi(app, 'POST', signature_url, data)
+        assert len(loops) == 3
+        assert type(cached) is type(body)
+
+    def test_eviction(self):
+        from flask_weixin import ReplyCache
+        self.weixin.reply_cache = ReplyCache(maxsize=1)
+        self.post('news')
+        self.post('help')
+        self.post('news')
+        assert self.calls == ['fromUser', 'fromUser']
+        assert len(self.weixin.reply_cache) == 1
+
+
+class TestMediaClient(Base):
+    media = bytes(bytearray(range(256))) * 1000
+
+    def create_app(self):
+        app = Base.create_app(self)
+        app.config['WEIXIN_APPID'] = 'wx1234567890'
+        app.config['WEIXIN_APP_SECRET'] = 'secret'
+        app.config['WEIXIN_MEDIA_CONCURRENCY'] = 2
+        return app
+
+    def setUp(self):
+        import threading
+        self.tokens = []
+        self.uploads = []
+        self.errors = []
+        self.active = [0, 0]
+        lock = threading.Lock()
+
+        def handle(method, path, body):
+            if path.startswith('/cgi-bin/token'):
+                self.tokens.append(path)
+                data = {'access_token': 'T%d' % len(self.tokens),
+                        'expires_in': 7200}
+                return 200, json.dumps(data).encode('utf-8')
+            if self.errors:
+                data = {'errcode': self.errors.pop(0), 'errmsg': 'error'}
+                return (200, json.dumps(data).encode('utf-8'),
+                        {'Content-Type': 'text/plain'})
+            if path.startswith('/cgi-bin/media/upload'):
+                self.uploads.append((path, body))
+                return 200, b'{"type": "image", "media_id": "M1"}'
+
+            with lock:
+                self.active[0] += 1
+                self.active[1] = max(self.active)
+            import time
+            time.sleep(0.02)
+            with lock:
+                self.active[0] -= 1
+            return 200, self.media, {'Content-Type': 'image/jpeg'}
+
+        self.server = StubServer(handle)
+        Base.setUp(self)
+        self.app.config['WEIXIN_API_BASE_URL'] = self.server.url
+        self.media_client = self.weixin.media
+        self.media_client.chunk_size = 4096
+
+    def tearDown(self):
+        self.media_client.pool.close()
+        self.server.close()
+
+    def test_download(self):
+        import io
+        import tempfile
+        chunks = []
+        size = self.media_client.download('M1', chunks.append)
+        assert size == len(self.media)
+        assert max(len(c) for c in chunks) <= 4096
+        assert b''.join(chunks) == self.media
+
+        f = io.BytesIO()
+        self.media_client.download_url(self.server.url + '/a.jpg?x=1', f)
+        assert f.getvalue() == self.media
+
+        path = os.path.join(tempfile.mkdtemp(), 'a.jpg')
+        self.media_client.download('M1', path)
+        with open(path, 'rb') as f:
+            assert f.read() == self.media
+
+    def test_token_refresh(self):
+        self.errors = [42001]
+        chunks = []
+        self.media_client.download('M1', chunks.append)
+        assert b''.join(chunks) == self.media
+        assert len(self.tokens) == 2
+
+    def test_error(self):
+        import tempfile
+        from flask_weixin import APIError
+        self.errors = [40007]
+        path = os.path.join(tempfile.mkdtemp(), 'a.jpg')
+        try:
+            self.media_client.download('nope', path)
+        except APIError as e:
+            assert e.errcode == 40007
+        else:
+            raise AssertionError('APIError not raised')
+        assert not os.listdir(os.path.dirname(path))
+
+    def test_upload(self):
+        import mmap
+        import tempfile
+        with tempfile.TemporaryFile() as f:
+            f.write(self.media)
+            f.seek(0)
+            rv = self.media_client.upload(f, filename='a.jpg')
+            assert rv['media_id'] == 'M1'
+
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.media_client.upload(m, type='voice', filename='b.amr')
+            finally:
+                m.close()
+
+        for (path, body), name in zip(self.uploads, ('a.jpg', 'b.amr')):
+            assert 'access_token=T1' in path
+            assert ('filename="%s"' % name).encode('utf-8') in body
+            assert self.media in body
+            assert body.endswith(b'--\r\n')
+        assert 'type=voice' in self.uploads[1][0]
+
+    def test_concurrency(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(6) as executor:
+            sizes = list(executor.map(
+                lambda i: self.media_client.download('M1', lambda c: None),
+                range(6)))
+        assert sizes == [len(self.media)] * 6
+        assert self.active[1] == 2
+
+
+class TestCoalesce(Base):
+    location = '''
+    <xml>
+    <ToUserName><![CDATA[toUser]]></ToUserName>
+    <FromUserName><![CDATA[%s]]></FromUserName>
+    <CreateTime>%d</CreateTime>
+    <MsgType><![CDATA[event]]></MsgType>
+    <Event><![CDATA[LOCATION]]></Event>
+    <Latitude>%s</Latitude>
+    <Longitude>113.358803</Longitude>
+    <Precision>119.385040</Precision>
+    </xml>
+    '''
+
+    def setup_weixin(self):
+        import threading
+        self.batches = []
+        self.flushed = threading.Event()
+
+        @self.weixin.coalesce('LOCATION', max_size=3, interval=0.05)
+        def save_locations(messages):
+            self.batches.append(sorted(
+                (m['sender'], m['latitude']) for m in messages))
+            self.flushed.set()
+
+        self.weixin.register(type='event', func=lambda **kwargs: 'event')
+
+    def post(self, sender, timestamp, latitude):
+        data = self.location % (sender, timestamp, latitude)
+        return self.client.post(signature_url, data=data)
+
+    def test_size_trigger(self):
+        self.weixin._coalescers['location'].interval = 60
+        rv = self.post('a', 1, '1')
+        assert rv.data == b'success'
+        self.post('a', 3, '3')
+        self.post('a', 2, '2')
+        self.post('b', 1, '1')
+        assert self.batches == []
+        self.post('c', 1, '1')
+        assert self.flushed.wait(1)
+        assert self.batches == [[('a', '3'), ('b', '1'), ('c', '1')]]
+
+    def test_time_trigger(self):
+        self.post('a', 1, '1')
+        assert self.flushed.wait(1)
+        assert self.batches == [[('a', '1')]]
+
+    def test_other_events(self):
+        data = self.location.replace('LOCATION', 'CLICK') % ('a', 1, '1')
+        rv = self.client.post(signature_url, data=data)
+        assert b'event' in rv.data
+        assert self.batches == []
+
+    def test_flush_and_dispatch(self):
+        ret = self.weixin.parse(self.location % ('a', 1, '1'))
+        rule, reply = self.weixin.dispatch(ret)
+        assert rule.__name__ == 'save_locations'
+        assert reply == 'success'
+        self.weixin.flush_events()
+        assert self.batches == [[('a', '1')]]
@@ -0,0 +1,473 @@
+# coding: utf-8
+"""
+    weixin_tools
+    ~~~~~~~~~~~~
+
+    Tools to measure a flask_weixin deployment, kept out of the library.
+
+    Replay archived messages through the handlers of a Weixin, or send
+    signed traffic to an app::
+
+        $ python -m weixin_tools replay myapp:weixin archive/
+        $ python -m weixin_tools load myapp:app --mix text=8,event=2
+
+    :copyright: (c) 2013 - 2015 by Hsiaoming Yang and its contributors.
+    :license: BSD, see LICENSE for more detail.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+import itertools
+import threading
+from urllib.parse import urlencode, urlsplit
+
+from flask_weixin import MESSAGE_SCHEMA, ConnectionPool
+from flask_weixin import _cdata, _rule_name, _signature, _timer
+
+
+log = logging.getLogger('weixin_tools')
+
+
+def _import_string(name):
+    """Import an object by ``'package.module:attribute'``."""
+    module, _, attr = name.partition(':')
+    obj = __import__(module, fromlist=['__name__'])
+    for part in attr.split('.') if attr else ():
+        obj = getattr(obj, part)
+    return obj
+
+
+def _iter_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                yield os.path.join(root, name)
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+_replay_weixin = None
+
+
+def _replay_init(target):
+    global _replay_weixin
+    if isinstance(target, str):
+        target = _import_string(target)
+    _replay_weixin = target
+
+
+def _replay_one(path):
+    weixin = _replay_weixin
+    with open(path, 'rb') as f:
+        body = f.read()
+
+    start = _timer()
+    try:
+        ret = weixin.parse(body)
+    except ValueError:
+        return 'invalid', _timer() - start, False
+    try:
+        rule, _ = weixin.dispatch(ret)
+    except Exception:
+        rule = weixin.match(ret)
+        log.exception('Failed to replay %s', path)
+        return _rule_name(rule), _timer() - start, False
+    return _rule_name(rule), _timer() - start, True
+
+
+def replay(target, paths, processes=None, chunksize=16):
+    """Replay archived xml bodies through the handlers of a :class:`Weixin`.
+
+    Every file is parsed and dispatched like :meth:`Weixin.view_func`
+    does, on a pool of ``processes`` worker processes, and the latency
+    of each message is recorded by its matched rule::
+
+        report = replay('myapp:weixin', ['archive/2014-06-01'])
+        report['rules']['print_help']['p99_ms']
+
+    Files are listed lazily, and each one is read by the worker that
+    replays it.
+
+    :param target: ``'module:attribute'`` of the :class:`Weixin` that
+                   each worker imports, or a :class:`Weixin` to replay
+                   in this process when ``processes`` is 0.
+    :param paths: Files of xml bodies, or directories of them.
+    :param processes: Number of worker processes, defaults to the number
+                      of CPUs, 0 to replay in this process.
+    :param chunksize: Number of files sent to a worker at once.
+    """
+    files = _iter_files(paths)
+    latencies = {}
+    errors = {}
+
+    start = _timer()
+    if processes == 0:
+        _replay_init(target)
+        results = map(_replay_one, files)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, _replay_init, (target,))
+        results = pool.imap_unordered(_replay_one, files, chunksize)
+
+    try:
+        for rule, seconds, ok in results:
+            latencies.setdefault(rule, []).append(seconds)
+            if not ok:
+                errors[rule] = errors.get(rule, 0) + 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    elapsed = _timer() - start
+
+    rules = {}
+    total = 0
+    for rule, values in latencies.items():
+        values.sort()
+        total += len(values)
+        rules[rule] = {
+            'count': len(values),
+            'errors': errors.get(rule, 0),
+            'p50_ms': _percentile(values, 50) * 1e3,
+            'p95_ms': _percentile(values, 95) * 1e3,
+            'p99_ms': _percentile(values, 99) * 1e3,
+        }
+    return {
+        'messages': total,
+        'errors': sum(errors.values()),
+        'seconds': elapsed,
+        'throughput': total / elapsed if elapsed else 0.0,
+        'rules': rules,
+    }
+
+
+#: values of the generated messages, by xml tag
+SAMPLE_VALUES = {
+    'Content': 'hello',
+    'PicUrl': 'http://example.com/a.jpg',
+    'MediaId': 'media_id',
+    'Location_X': '23.134521',
+    'Location_Y': '113.358803',
+    'Scale': '20',
+    'Label': 'location',
+    'Title': 'title',
+    'Description': 'description',
+    'Url': 'http://example.com/',
+    'Event': 'CLICK',
+    'EventKey': 'key',
+    'Format': 'amr',
+    'Recognition': 'hello',
+    'ThumbMediaId': 'thumb_media_id',
+}
+
+
+def sample_message(msg_type, sender='fromUser', receiver='toUser',
+                   msg_id=1, **values):
+    """Generate the xml body of a message of ``msg_type``.
+
+    Fields of the type in :data:`MESSAGE_SCHEMA` are filled with
+    :data:`SAMPLE_VALUES`, ``values`` of xml tags override them.
+    """
+    parts = [
+        '<xml>',
+        '<ToUserName><![CDATA[%s]]></ToUserName>' % _cdata(receiver),
+        '<FromUserName><![CDATA[%s]]></FromUserName>' % _cdata(sender),
+        '<CreateTime>%d</CreateTime>' % int(time.time()),
+        '<MsgType><![CDATA[%s]]></MsgType>' % msg_type,
+    ]
+    for _, tag, _ in MESSAGE_SCHEMA.get(msg_type, ()):
+        value = values.pop(tag, SAMPLE_VALUES.get(tag))
+        if value is not None:
+            parts.append('<%s><![CDATA[%s]]></%s>' % (tag, _cdata(value), tag))
+    for tag, value in values.items():
+        parts.append('<%s><![CDATA[%s]]></%s>' % (tag, _cdata(value), tag))
+    if msg_type != 'event':
+        parts.append('<MsgId>%d</MsgId>' % msg_id)
+    parts.append('</xml>')
+    return ''.join(parts).encode('utf-8')
+
+
+def _call_wsgi(app, path, query, body):
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'CONTENT_TYPE': 'text/xml',
+        'CONTENT_LENGTH': str(len(body)),
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    status = []
+
+    def start_response(value, headers, exc_info=None):
+        status.append(int(value.split(' ', 1)[0]))
+
+    iterable = app(environ, start_response)
+    try:
+        data = b''.join(iterable)
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+    return status[0], data
+
+
+def load(target, token=None, mix=None, rate=0, concurrency=8,
+         requests=1000, duration=None, users=1000, seed=None, path='/'):
+    """Generate signed weixin traffic and measure the latency.
+
+    Messages are generated by :func:`sample_message`, each one signed
+    with a fresh timestamp and nonce and a unique ``MsgId``, so nonce
+    caches and deduplication don't reject them::
+
+        report = load(app, mix={'text': 8, 'event': 2}, rate=500)
+        report['p99_ms']
+
+    With a ``rate``, requests are scheduled at fixed intervals and the
+    latency is measured from the scheduled time, so a stalled server is
+    not hidden by the load backing off.
+
+    :param target: A WSGI app to call in this process, or the url of an
+                   http endpoint like ``http://127.0.0.1:5000/weixin``.
+    :param token: ``WEIXIN_TOKEN`` to sign with, defaults to the one in
+                  the config of the WSGI app.
+    :param mix: A dict of message types to weights, text only by default.
+    :param rate: Requests per second, 0 sends as fast as possible.
+    :param concurrency: Number of requests in flight.
+    :param requests: Number of requests to send.
+    :param duration: Seconds to send for, instead of ``requests``.
+    :param users: Number of distinct senders.
+    :param seed: Seed of the random message types and senders.
+    :param path: Path of the view in the WSGI app.
+    """
+    import random
+
+    if token is None:
+        token = getattr(target, 'config', {}).get('WEIXIN_TOKEN')
+    if not token:
+        raise RuntimeError('WEIXIN_TOKEN is missing')
+
+    types = sorted((mix or {'text': 1}).items())
+    weights = []
+    total = 0
+    for _, weight in types:
+        total += weight
+        weights.append(total)
+    rnd = random.Random(seed)
+
+    if isinstance(target, str):
+        url = urlsplit(target)
+        pool = ConnectionPool(
+            '%s://%s' % (url.scheme, url.netloc), maxsize=concurrency)
+        path = url.path or '/'
+
+        def send(query, body):
+            status, _, data = pool.request('POST', '%s?%s' % (path, query),
+                                           body, {'Content-Type': 'text/xml'})
+            return status
+    else:
+        pool = None
+
+        def send(query, body):
+            return _call_wsgi(target, path, query, body)[0]
+
+    lock = threading.Lock()
+    counter = itertools.count()
+    # unique message ids and nonces across runs
+    run_id = int(time.time() * 1000)
+    latencies = {}
+    statuses = {}
+    start = _timer()
+    deadline = start + duration if duration else None
+
+    def next_request():
+        with lock:
+            i = next(counter)
+            if deadline is None and i >= requests:
+                return None
+            msg_type = types[bisect.bisect(weights, rnd.random() * total)][0]
+            sender = 'user%d' % rnd.randrange(users)
+        scheduled = start + i / float(rate) if rate else None
+        return i, msg_type, sender, scheduled
+
+    def worker():
+        while True:
+            item = next_request()
+            if item is None:
+                return
+            i, msg_type, sender, scheduled = item
+            if scheduled is not None:
+                delay = scheduled - _timer()
+                if delay > 0:
+                    time.sleep(delay)
+            if deadline is not None and _timer() >= deadline:
+                return
+
+            timestamp = str(int(time.time()))
+            nonce = '%d%d' % (run_id, i)
+            query = urlencode({
+                'signature': _signature(token, timestamp, nonce),
+                'timestamp': timestamp,
+                'nonce': nonce,
+            })
+            body = sample_message(
+                msg_type, sender=sender, msg_id=run_id * 1000000 + i)
+
+            t = _timer() if scheduled is None else scheduled
+            try:
+                status = send(query, body)
+            except Exception:
+                log.exception('Request failed')
+                status = 0
+            seconds = _timer() - t
+            with lock:
+                latencies.setdefault(msg_type, []).append(seconds)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = _timer() - start
+    if pool is not None:
+        pool.close()
+
+    def stats(values):
+        values.sort()
+        return {
+            'count': len(values),
+            'p50_ms': _percentile(values, 50) * 1e3,
+            'p95_ms': _percentile(values, 95) * 1e3,
+            'p99_ms': _percentile(values, 99) * 1e3,
+        }
+
+    every = []
+    for values in latencies.values():
+        every.extend(values)
+    report = stats(every)
+    report.update({
+        'seconds': elapsed,
+        'throughput': len(every) / elapsed if elapsed else 0.0,
+        'errors': sum(v for k, v in statuses.items() if k != 200),
+        'statuses': dict((str(k), v) for k, v in statuses.items()),
+        'types': dict((k, stats(v)) for k, v in latencies.items()),
+    })
+    return report
+
+
+def _print_load(report):
+    print('%d requests in %.2fs, %.0f req/s, %d errors' % (
+        report['count'], report['seconds'], report['throughput'],
+        report['errors']))
+    header = '%-16s %8s %10s %10s %10s' % (
+        'type', 'count', 'p50 ms', 'p95 ms', 'p99 ms')
+    print(header)
+    print('-' * len(header))
+    rows = sorted(report['types'].items()) + [('all', report)]
+    for name, stats in rows:
+        print('%-16s %8d %10.3f %10.3f %10.3f' % (
+            name, stats['count'], stats['p50_ms'], stats['p95_ms'],
+            stats['p99_ms']))
+
+
+def _parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def _print_replay(report):
+    print('%d messages in %.2fs, %.0f msg/s, %d errors' % (
+        report['messages'], report['seconds'], report['throughput'],
+        report['errors']))
+    header = '%-32s %8s %8s %10s %10s %10s' % (
+        'rule', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms')
+    print(header)
+    print('-' * len(header))
+    for rule, stats in sorted(report['rules'].items()):
+        print('%-32s %8d %8d %10.3f %10.3f %10.3f' % (
+            rule[:32], stats['count'], stats['errors'],
+            stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+
+
+def main(argv=None):
+    """Command line tools of flask_weixin::
+
+        $ python -m weixin_tools replay myapp:weixin archive/
+        $ python -m weixin_tools load myapp:app --mix text=8,event=2
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m weixin_tools')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    cmd = commands.add_parser(
+        'replay', help='replay archived messages through the handlers')
+    cmd.add_argument('target', help='module:attribute of the Weixin')
+    cmd.add_argument('paths', nargs='+', help='files or directories')
+    cmd.add_argument('-j', '--processes', type=int, default=None,
+                     help='worker processes, 0 to run in this process')
+    cmd.add_argument('-o', '--output', help='save the report as JSON')
+
+    cmd = commands.add_parser(
+        'load', help='send signed traffic to a WSGI app or an endpoint')
+    cmd.add_argument('target', help='module:attribute of the WSGI app, '
+                     'or the url of an endpoint')
+    cmd.add_argument('--token', help='WEIXIN_TOKEN to sign with')
+    cmd.add_argument('--mix', type=_parse_mix, default=None,
+                     help='weights of message types, like text=8,event=2')
+    cmd.add_argument('-r', '--rate', type=float, default=0,
+                     help='requests per second, 0 for no limit')
+    cmd.add_argument('-c', '--concurrency', type=int, default=8)
+    cmd.add_argument('-n', '--requests', type=int, default=1000)
+    cmd.add_argument('-d', '--duration', type=float, default=None,
+                     help='seconds to run, instead of a number of requests')
+    cmd.add_argument('-o', '--output', help='save the report as JSON')
+
+    args = parser.parse_args(argv)
+    # the target is imported from the working directory
+    sys.path.insert(0, os.getcwd())
+    if args.command == 'load':
+        target = args.target
+        if '://' not in target:
+            target = _import_string(target)
+        report = load(target, args.token, args.mix, args.rate,
+                      args.concurrency, args.requests, args.duration)
+        _print_load(report)
+    else:
+        report = replay(args.target, args.paths, args.processes)
+        _print_replay(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+if __name__ == '__main__':
+    main()